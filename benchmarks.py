@@ -0,0 +1,1078 @@
+"""Benchmarks for the Text-to-SQL bot.
+
+Every benchmark prints one JSON object per measurement on stdout, so runs can
+be diffed between releases:
+
+    python benchmarks.py ingest --rows 1000000 --compare
+    python benchmarks.py stages --rows 10000,1000000
+    python benchmarks.py load --users 50 --concurrent-updates 32
+    python benchmarks.py engines --rows 1000000
+    python benchmarks.py stream --token-delay 0.02
+    python benchmarks.py isolation
+    python benchmarks.py export
+    python benchmarks.py rules
+"""
+import argparse
+import asyncio
+import csv
+import io
+import json
+import logging
+import multiprocessing
+import os
+import random
+import re
+import resource
+import string
+import subprocess
+import sys
+import tempfile
+import time
+import warnings
+from functools import partial
+from datetime import date, timedelta
+
+DEPARTMENTS = {
+    'IT': ['Software Engineer', 'Team Lead', 'DevOps Engineer', 'QA Engineer'],
+    'Marketing': ['Content Manager', 'SEO Specialist', 'Marketing Manager'],
+    'Finance': ['Accountant', 'Financial Analyst', 'Controller'],
+    'HR': ['Recruiter', 'HR Manager'],
+    'Sales': ['Sales Representative', 'Account Manager', 'Sales Director'],
+}
+FIRST_NAMES = ['Chad', 'Jaime', 'Hayley', 'Terri', 'Maria', 'John', 'Olga', 'Ivan', 'Emma', 'Liam', 'Ava', 'Noah']
+LAST_NAMES = ['Smith', 'Harding', 'Huff', 'Sanchez', 'Ivanova', 'Brown', 'Petrov', 'Garcia', 'Lee', 'Wilson']
+STATUSES = ['active', 'inactive', 'terminated', 'on_leave']
+EMPLOYEE_COLUMNS = ['first_name', 'last_name', 'department', 'position', 'hire_date',
+                    'salary', 'email', 'phone', 'status', 'manager_id']
+
+def synthetic_employee_rows(rows, seed=42):
+    """Yield employee rows shaped like file_18.csv"""
+    rng = random.Random(seed)
+    start = date(2010, 1, 1)
+    departments = list(DEPARTMENTS)
+    for i in range(rows):
+        department = rng.choice(departments)
+        first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+        yield [
+            first,
+            last,
+            department,
+            rng.choice(DEPARTMENTS[department]),
+            (start + timedelta(days=rng.randrange(5400))).strftime('%Y/%m/%d'),
+            round(rng.uniform(2000, 10000), 2),
+            f"{first.lower()}.{last.lower()}{i}@example.org",
+            f"{rng.randrange(200, 999)}.{rng.randrange(100, 999)}.{rng.randrange(1000, 9999)}",
+            rng.choice(STATUSES),
+            rng.randrange(1, max(2, rows // 20)) if rng.random() < 0.7 else '',
+        ]
+
+def write_synthetic_csv(path, rows, seed=42):
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(EMPLOYEE_COLUMNS)
+        writer.writerows(synthetic_employee_rows(rows, seed))
+    return path
+
+def peak_rss_mb():
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def _ingest_worker(method, csv_path, db_path, results):
+    import bot
+    baseline = peak_rss_mb()
+    started = time.perf_counter()
+    if method == 'chunked':
+        rows = bot.ingest_csv(csv_path, db_path, 'employees')
+    else:
+        # The pre-streaming path: whole file in memory, then to_sql and COUNT(*)
+        import sqlite3
+        df = bot.pd.read_csv(csv_path)
+        conn = sqlite3.connect(db_path)
+        df.to_sql('employees', conn, if_exists='replace', index=False)
+        rows = conn.execute("SELECT COUNT(*) FROM employees").fetchone()[0]
+        conn.close()
+    elapsed = time.perf_counter() - started
+    results.put({
+        'benchmark': 'ingest',
+        'method': method,
+        'rows': rows,
+        'seconds': round(elapsed, 3),
+        'rows_per_sec': round(rows / elapsed) if elapsed else None,
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+        'baseline_rss_mb': round(baseline, 1),
+    })
+
+def bench_ingest(args):
+    methods = ['chunked', 'legacy'] if args.compare else ['chunked']
+    with tempfile.TemporaryDirectory() as tmp:
+        csv_path = write_synthetic_csv(os.path.join(tmp, 'employees.csv'), args.rows)
+        # Each method runs in a fresh process so peak RSS is not shared
+        ctx = multiprocessing.get_context('spawn')
+        for method in methods:
+            results = ctx.Queue()
+            db_path = os.path.join(tmp, f'{method}.db')
+            proc = ctx.Process(target=_ingest_worker, args=(method, csv_path, db_path, results))
+            proc.start()
+            result = results.get()
+            proc.join()
+            result['file_mb'] = round(os.path.getsize(csv_path) / 2**20, 1)
+            print(json.dumps(result), flush=True)
+
+def _legacy_metadata_message(db_path, user_id):
+    # What every message cost before MetadataStore: a fresh connection per helper
+    import sqlite3
+    conn = sqlite3.connect(db_path)
+    conn.execute("SELECT language FROM user_settings WHERE user_id=?", (user_id,)).fetchone()
+    conn.close()
+    conn = sqlite3.connect(db_path)
+    conn.execute("SELECT db_name, db_path, table_name FROM user_databases WHERE user_id=? ORDER BY created_at DESC",
+                 (user_id,)).fetchall()
+    conn.close()
+
+def bench_metadata(args):
+    import bot
+    with tempfile.TemporaryDirectory() as tmp:
+        store = bot.MetadataStore(os.path.join(tmp, 'bot_data.db'))
+        for user_id in range(args.users):
+            store.save_user_language(user_id, 'en' if user_id % 2 else 'ru')
+            for n in range(3):
+                store.save_user_database(user_id, f'db{n}', f'/data/{user_id}_{n}.db', 'data', ['id', 'name'])
+        rng = random.Random(1)
+        user_ids = [rng.randrange(args.users) for _ in range(args.messages)]
+        
+        def store_message(user_id):
+            store.get_user_language(user_id)
+            store.get_user_databases(user_id)
+        
+        for method, fn in [('legacy', partial(_legacy_metadata_message, store.db_path)), ('store', store_message)]:
+            started = time.perf_counter()
+            for user_id in user_ids:
+                fn(user_id)
+            elapsed = time.perf_counter() - started
+            print(json.dumps({
+                'benchmark': 'metadata',
+                'method': method,
+                'users': args.users,
+                'messages': args.messages,
+                'us_per_message': round(elapsed / args.messages * 1e6, 1),
+            }), flush=True)
+        store.close()
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def _python(code, cwd, *flags):
+    env = dict(os.environ, PYTHONPATH=REPO_DIR + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    return subprocess.run([sys.executable, *flags, '-c', code], cwd=cwd, env=env,
+                          capture_output=True, text=True, check=True)
+
+def parse_importtime(stderr):
+    """Cumulative import time (ms) of bot and of each module bot imports directly"""
+    children = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        _, cumulative_us, name = line.split('|')
+        depth = len(name) - len(name.lstrip())
+        # -X importtime prints children before their parent, indented two more spaces
+        if depth == 3:
+            children[name.strip()] = round(int(cumulative_us) / 1000, 2)
+        elif depth == 1:
+            if name.strip() == 'bot':
+                children['bot'] = round(int(cumulative_us) / 1000, 2)
+                return children
+            children = {}
+    return children
+
+def bench_startup(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        # Warm the bytecode cache so we measure imports, not compilation
+        _python('import bot', tmp)
+        for run in range(args.runs):
+            started = time.perf_counter()
+            result = _python('import bot', tmp, '-X', 'importtime')
+            wall = time.perf_counter() - started
+            modules = parse_importtime(result.stderr)
+            init = _python('import time, bot\n'
+                           't = time.perf_counter(); bot.initialize(); print(time.perf_counter() - t)', tmp)
+            print(json.dumps({
+                'benchmark': 'startup',
+                'run': run,
+                'process_wall_ms': round(wall * 1000, 1),
+                'import_bot_ms': modules.pop('bot', None),
+                'initialize_ms': round(float(init.stdout.strip()) * 1000, 2),
+                'heavy_loaded': sorted(m for m in ('pandas', 'numpy', 'matplotlib', 'tabulate') if m in modules),
+                'imports_ms': dict(sorted(modules.items(), key=lambda item: -item[1])[:args.top]),
+            }), flush=True)
+
+STAGE_QUERIES = [
+    ('count', "SELECT COUNT(*) AS employees FROM employees", 'ai_generated'),
+    ('first_10', "SELECT * FROM employees LIMIT 10", 'limited_table'),
+    ('group_avg', "SELECT department, AVG(salary) AS avg_salary FROM employees GROUP BY department", 'ai_generated'),
+    ('filter', "SELECT first_name, last_name, salary FROM employees WHERE status = 'active' AND salary > 9500 LIMIT 200",
+     'ai_generated'),
+    ('salary_column', "SELECT salary FROM employees", 'ai_generated'),
+]
+STUB_SQL = "```sql\nSELECT department, AVG(salary) FROM data GROUP BY department\n```"
+
+def _timings(fn, repeat):
+    seconds = []
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        seconds.append(time.perf_counter() - started)
+    return seconds, result
+
+def _stage_record(rows, stage, case, seconds, **extra):
+    ordered = sorted(seconds)
+    return json.dumps({
+        'benchmark': 'stages',
+        'rows': rows,
+        'stage': stage,
+        'case': case,
+        'runs': len(seconds),
+        'ms_median': round(ordered[len(ordered) // 2] * 1000, 3),
+        'ms_min': round(ordered[0] * 1000, 3),
+        **extra,
+    })
+
+def _stub_llm(latency):
+    async def call_openrouter(prompt, *args, **kwargs):
+        await asyncio.sleep(latency)
+        return STUB_SQL
+    return call_openrouter
+
+def _random_question(rng):
+    # Letters only, so no two questions share a template shape or cache key
+    words = [''.join(rng.choice(string.ascii_lowercase) for _ in range(6)) for _ in range(4)]
+    return 'average salary for ' + ' '.join(words)
+
+def bench_stages(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        # Keep the bot's own metadata and caches out of the working directory
+        os.environ['BOT_DB_PATH'] = os.path.join(tmp, 'bot_data.db')
+        os.environ['TRANSLATION_CACHE_DB'] = os.path.join(tmp, 'translation_cache.db')
+        import bot
+        bot.call_openrouter = _stub_llm(args.llm_latency)
+        # Chart titles carry emoji the default font lacks; keep stderr readable
+        warnings.filterwarnings('ignore', message='Glyph')
+        rng = random.Random(7)
+        
+        for rows in args.rows:
+            repeat = args.repeat if rows <= 1_000_000 else max(1, args.repeat // 3)
+            csv_path = write_synthetic_csv(os.path.join(tmp, f'employees_{rows}.csv'), rows)
+            csv_mb = round(os.path.getsize(csv_path) / 2**20, 1)
+            db_path = os.path.join(tmp, f'employees_{rows}.db')
+            
+            # Same calls handle_document makes for an uploaded CSV
+            profiler = bot.ColumnProfiler()
+            seconds, _ = _timings(partial(bot.ingest_csv, csv_path, db_path, 'employees', profiler=profiler), 1)
+            bot.save_table_profile(db_path, 'employees', profiler.result())
+            print(_stage_record(rows, 'ingest', 'csv', seconds, file_mb=csv_mb,
+                                rows_per_sec=round(rows / seconds[0])), flush=True)
+            os.remove(csv_path)
+            
+            def schema_cold():
+                bot.SCHEMA_CACHE.invalidate(db_path)
+                return bot.get_database_info(db_path)
+            seconds, schema = _timings(schema_cold, repeat)
+            print(_stage_record(rows, 'schema', 'cold', seconds), flush=True)
+            seconds, _ = _timings(partial(bot.get_database_info, db_path), repeat)
+            print(_stage_record(rows, 'schema', 'warm', seconds), flush=True)
+            
+            columns = schema['employees']['columns']
+            schema_info = str(schema)
+            seconds, prompt = _timings(partial(bot.build_schema_info, db_path, 'employees', columns,
+                                               'average salary by department'), repeat)
+            print(_stage_record(rows, 'schema', 'prompt', seconds, tokens=bot.estimate_tokens(prompt)), flush=True)
+            
+            def translate(question, columns=columns):
+                return asyncio.run(bot.generate_sql_with_visualization(schema_info, question, 'employees', 'en', columns))
+            seconds, _ = _timings(lambda: translate(_random_question(rng), None), repeat)
+            print(_stage_record(rows, 'translate', 'llm_stub', seconds, llm_latency_ms=args.llm_latency * 1000),
+                  flush=True)
+            # Outside the rule-based grammar, so these reach the cache and the template store
+            translate('average salary by department last year')
+            seconds, _ = _timings(partial(translate, 'average salary by department last year'), repeat)
+            print(_stage_record(rows, 'translate', 'cached', seconds), flush=True)
+            seconds, _ = _timings(partial(translate, 'average salary by position last year'), repeat)
+            print(_stage_record(rows, 'translate', 'template', seconds), flush=True)
+            seconds, _ = _timings(partial(translate, 'average salary by position'), repeat)
+            print(_stage_record(rows, 'translate', 'rule_based', seconds), flush=True)
+            profile = bot.get_table_profile(db_path, 'employees')
+            seconds, _ = _timings(lambda: asyncio.run(bot.generate_sql_with_visualization(
+                schema_info, 'average salary', 'employees', 'en', columns, profile)), repeat)
+            print(_stage_record(rows, 'translate', 'profile', seconds), flush=True)
+            
+            for case, sql, query_type in STAGE_QUERIES:
+                seconds, df = _timings(partial(bot.run_sql_query, db_path, sql), repeat)
+                print(_stage_record(rows, 'sql', case, seconds, result_rows=len(df)), flush=True)
+                
+                seconds, result = _timings(
+                    partial(bot.create_enhanced_visualization, df, query_type, 'employees'), repeat)
+                chart = result.get('chart') if isinstance(result, dict) else None
+                print(_stage_record(rows, 'visualize', case, seconds,
+                                    output=chart['kind'] if chart else 'text'), flush=True)
+                if chart:
+                    seconds, (png, _) = _timings(partial(bot.render_chart_png, chart), repeat)
+                    print(_stage_record(rows, 'chart', case, seconds, kind=chart['kind'],
+                                        png_kb=round(len(png) / 1024, 1)), flush=True)
+            
+            for page in (0, 100):
+                pagination = bot.new_pagination(db_path, "SELECT * FROM employees", 'employees', 'full_table', 'bench')
+                pagination['page'] = page
+                # Keyset pages start after the last rowid of the previous page
+                pagination['keys'] = [None] + [(p + 1) * pagination['page_size'] for p in range(page)]
+                seconds, _ = _timings(partial(bot.fetch_result_page, pagination), repeat)
+                print(_stage_record(rows, 'sql', f'full_table_page_{page}', seconds), flush=True)
+
+            # First reply to a suggested query: translate, fetch and render vs. the warm-up's prepared page
+            async def first_reply_cold(question):
+                sql, query_type = await bot.generate_sql_with_visualization(
+                    schema_info, question, 'employees', 'en', columns, profile)
+                pagination = bot.new_pagination(db_path, sql, 'employees', query_type, 1)
+                df, has_next = await bot.fetch_page(pagination)
+                return bot.render_result_page(df, pagination, has_next, bot.LANGUAGES['en'])
+            seconds, _ = _timings(partial(asyncio.run, bot.warm_up(db_path, 'employees', 'en', 1)), 1)
+            print(_stage_record(rows, 'warmup', 'upload', seconds,
+                                questions=len(bot.SUGGESTED_QUERIES) + len(bot.WARMUP_QUESTIONS)), flush=True)
+            for question in bot.SUGGESTED_QUERIES:
+                case = question.lower().replace(' ', '_')
+                seconds, _ = _timings(lambda: asyncio.run(first_reply_cold(question)), repeat)
+                print(_stage_record(rows, 'first_reply', f'{case}_cold', seconds), flush=True)
+                seconds, warm = _timings(partial(bot.WARM_RESULTS.get, db_path, 'employees', 'en', question), repeat)
+                print(_stage_record(rows, 'first_reply', f'{case}_warm', seconds, prepared=warm is not None),
+                      flush=True)
+
+            export_dir = os.path.join(tmp, 'export')
+            os.makedirs(export_dir, exist_ok=True)
+            seconds, paths = _timings(partial(bot.export_query_results, db_path, "SELECT * FROM employees",
+                                              export_dir, 'employees', 'csv.gz'), 1)
+            export_mb = sum(os.path.getsize(path) for path in paths) / 2**20
+            print(_stage_record(rows, 'export', 'csv.gz', seconds, parts=len(paths), file_mb=round(export_mb, 1),
+                                rows_per_sec=round(rows / seconds[0])), flush=True)
+            for path in paths:
+                os.remove(path)
+            bot.SCHEMA_CACHE.invalidate(db_path)
+            os.remove(db_path)
+            os.remove(bot.profile_path(db_path))
+
+LOAD_QUESTIONS = [
+    'Show first 10 records',
+    'average salary by department',
+    'average salary by position',
+    'how many employees are active',
+    'how many employees are on_leave',
+    'employees with salary above 9000',
+    'employees with salary above 9500',
+    'top 5 departments by headcount',
+]
+
+def _stub_sql_for(prompt):
+    question = prompt.split('generate an SQL query for:', 1)[-1].lower()
+    if 'average' in question:
+        sql = "SELECT department, AVG(salary) AS avg_salary FROM data GROUP BY department"
+    elif 'how many' in question:
+        sql = "SELECT COUNT(*) AS employees FROM data WHERE status = 'active'"
+    elif 'headcount' in question:
+        sql = "SELECT department, COUNT(*) AS headcount FROM data GROUP BY department ORDER BY headcount DESC LIMIT 5"
+    elif 'slow report' in question:
+        # A couple of seconds of SQLite work however small the table is
+        sql = "WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < 5000000) SELECT COUNT(*) FROM n"
+    else:
+        sql = "SELECT first_name, last_name, salary FROM data WHERE salary > 9000 LIMIT 20"
+    return f"```sql\n{sql}\n```"
+
+class StubLLMServer:
+    """Minimal HTTP/1.1 server answering chat completions after a fixed delay.
+
+    Streaming requests get the same answer as a single server-sent event.
+    """
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = 0
+        self.prompts = []  # in the order requests arrived
+        self._server = None
+        self._handlers = set()
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._serve, '127.0.0.1', 0)
+        host, port = self._server.sockets[0].getsockname()[:2]
+        return f"http://{host}:{port}/v1/chat/completions"
+
+    async def _serve(self, reader, writer):
+        self._handlers.add(asyncio.current_task())
+        try:
+            while True:
+                head = await reader.readuntil(b'\r\n\r\n')
+                length = 0
+                for line in head.split(b'\r\n'):
+                    name, _, value = line.partition(b':')
+                    if name.strip().lower() == b'content-length':
+                        length = int(value)
+                payload = json.loads(await reader.readexactly(length)) if length else {}
+                self.calls += 1
+                self.prompts.append(payload.get('messages', [{}])[0].get('content', ''))
+                await self._respond(reader, writer, payload)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+            self._handlers.discard(asyncio.current_task())
+
+    async def _respond(self, reader, writer, payload):
+        await asyncio.sleep(self.latency)
+        prompt = payload.get('messages', [{}])[0].get('content', '')
+        usage = {'prompt_tokens': len(prompt) // 4, 'completion_tokens': 30}
+        if payload.get('stream'):
+            body = (_sse_event({'choices': [{'delta': {'content': _stub_sql_for(prompt)}}], 'usage': usage})
+                    + b'data: [DONE]\n\n')
+            content_type = b'text/event-stream'
+        else:
+            body = json.dumps({
+                'choices': [{'message': {'role': 'assistant', 'content': _stub_sql_for(prompt)}}],
+                'usage': usage,
+            }).encode()
+            content_type = b'application/json'
+        writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: ' + content_type + b'\r\n'
+                     b'Content-Length: ' + str(len(body)).encode() + b'\r\n\r\n' + body)
+        await writer.drain()
+
+    async def stop(self):
+        self._server.close()
+        # Let handlers notice their clients hung up rather than cancelling them mid-write
+        if self._handlers:
+            await asyncio.wait(self._handlers, timeout=5)
+        await self._server.wait_closed()
+
+def _sse_event(data):
+    return b'data: ' + json.dumps(data).encode() + b'\n\n'
+
+# Answer shapes seen from chat models: the SQL, then usually some explanation
+STREAM_SQL = "SELECT department, AVG(salary) AS avg_salary FROM employees GROUP BY department ORDER BY avg_salary DESC"
+STREAM_EXPLANATION = (" This query groups the employees table by department, computes the average salary "
+                      "of each group with AVG, and sorts the departments from the highest average salary to "
+                      "the lowest so the best paid departments come first. You can add a WHERE clause to "
+                      "restrict it to active employees, or use ROUND to limit the decimals shown.") * 2
+STREAM_ANSWERS = [
+    ('fenced_explained', f"```sql\n{STREAM_SQL}\n```\n\n{STREAM_EXPLANATION}"),
+    ('semicolon_explained', f"{STREAM_SQL};\n\n{STREAM_EXPLANATION}"),
+    ('fenced_only', f"```sql\n{STREAM_SQL}\n```"),
+]
+
+class StreamingLLMServer(StubLLMServer):
+    """Stub that generates a fixed answer token by token at a steady rate.
+
+    Streaming requests receive each token as a server-sent event in a
+    chunked response; blocking requests get the whole answer once the last
+    token would have been generated, as a real server does.
+    """
+    def __init__(self, latency, token_delay, answer):
+        super().__init__(latency)
+        self.token_delay = token_delay
+        self.tokens = re.findall(r'\S+\s*|\s+', answer)
+        self.sent_tokens = 0
+
+    async def _respond(self, reader, writer, payload):
+        await asyncio.sleep(self.latency)
+        if not payload.get('stream'):
+            await asyncio.sleep(self.token_delay * len(self.tokens))
+            self.sent_tokens += len(self.tokens)
+            body = json.dumps({'choices': [{'message': {'role': 'assistant', 'content': ''.join(self.tokens)}}],
+                               'usage': {'prompt_tokens': 100, 'completion_tokens': len(self.tokens)}}).encode()
+            writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n'
+                         b'Content-Length: ' + str(len(body)).encode() + b'\r\n\r\n' + body)
+            await writer.drain()
+            return
+        writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nTransfer-Encoding: chunked\r\n\r\n')
+        events = [_sse_event({'choices': [{'delta': {'content': token}}]}) for token in self.tokens]
+        events.append(b'data: [DONE]\n\n')
+        for event in events:
+            await asyncio.sleep(self.token_delay)
+            # The client hung up once it had the SQL
+            if reader.at_eof():
+                return
+            writer.write(f"{len(event):x}\r\n".encode() + event + b'\r\n')
+            await writer.drain()
+            self.sent_tokens += 1
+        writer.write(b'0\r\n\r\n')
+        await writer.drain()
+
+def _fake_bot_transport(files, latency):
+    """A BaseRequest that answers Bot API calls locally and counts them"""
+    from telegram.request import BaseRequest
+    
+    class FakeBotRequest(BaseRequest):
+        def __init__(self):
+            self.calls = {}
+            self.replies = []
+            self._message_id = 0
+
+        @property
+        def read_timeout(self):
+            return None
+
+        async def initialize(self):
+            pass
+
+        async def shutdown(self):
+            pass
+
+        def _message(self, params, **extra):
+            self._message_id += 1
+            chat_id = int(params.get('chat_id', 0))
+            return {'message_id': self._message_id, 'date': int(time.time()),
+                    'chat': {'id': chat_id, 'type': 'private'}, **extra}
+
+        async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                             connect_timeout=None, pool_timeout=None):
+            if latency:
+                await asyncio.sleep(latency)
+            if method == 'GET':
+                # File download: the last path component is the file_path from getFile
+                return 200, files[url.rsplit('/', 1)[-1]]
+            endpoint = url.rsplit('/', 1)[-1]
+            self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+            params = request_data.parameters if request_data else {}
+            if endpoint == 'getMe':
+                result = {'id': 1, 'is_bot': True, 'first_name': 'Load', 'username': 'load_test_bot'}
+            elif endpoint == 'getFile':
+                file_id = params['file_id']
+                result = {'file_id': file_id, 'file_unique_id': file_id, 'file_path': f'documents/{file_id}',
+                          'file_size': len(files[file_id])}
+            elif endpoint in ('sendMessage', 'editMessageText'):
+                self.replies.append(params.get('text', ''))
+                result = self._message(params, text=params.get('text', ''))
+            elif endpoint in ('sendPhoto', 'sendDocument'):
+                result = self._message(params, caption=params.get('caption', ''))
+            else:
+                result = True
+            return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+    return FakeBotRequest()
+
+def _percentiles(seconds):
+    ordered = sorted(seconds)
+    pick = lambda q: round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000, 1)
+    return {'count': len(ordered), 'p50_ms': pick(0.5), 'p95_ms': pick(0.95), 'p99_ms': pick(0.99),
+            'max_ms': round(ordered[-1] * 1000, 1)}
+
+async def _measure_loop_lag(samples, interval=0.05):
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        samples.append(time.perf_counter() - started - interval)
+
+def _employee_upload(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EMPLOYEE_COLUMNS)
+    writer.writerows(synthetic_employee_rows(rows))
+    return buffer.getvalue().encode()
+
+async def _start_application(bot, transport, concurrent_updates):
+    """The Application main() runs, on the fake Bot API; None for concurrent_updates means main()'s setting"""
+    if concurrent_updates is None:
+        concurrent_updates = bot.UPDATE_CONCURRENCY
+    application = bot.build_application('0:load-test', request=transport, concurrent_updates=concurrent_updates)
+    await application.initialize()
+    return application
+
+def _update_sender(application, latencies=None):
+    """send(handler, user_id, **message) feeds one message through the update processor, like polling does"""
+    from telegram import Update
+    update_ids = iter(range(1, 1 << 62))
+    
+    async def send(handler, user_id, **message):
+        message.update({
+            'message_id': next(update_ids),
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f'user{user_id}'},
+        })
+        update = Update.de_json({'update_id': message['message_id'], 'message': message}, application.bot)
+        started = time.perf_counter()
+        # Same path as polling: the update processor enforces concurrent_updates
+        await application.update_processor.process_update(update, application.process_update(update))
+        elapsed = time.perf_counter() - started
+        if latencies is not None:
+            latencies.setdefault(handler, []).append(elapsed)
+        return elapsed
+    return send
+
+async def _open_session(send, bot, user_id, files, upload, first=True):
+    """/start, pick English, enter text-to-SQL mode and upload the employees table"""
+    en = bot.LANGUAGES['en']
+    await send('start', user_id, text='/start', entities=[{'type': 'bot_command', 'offset': 0, 'length': 6}])
+    if first:
+        await send('language_handler', user_id, text='English 🇺🇸')
+    await send('main_menu_handler', user_id, text=en['text_to_sql_mode'])
+    file_id = f'employees_{user_id}_{len(files)}.csv'
+    files[file_id] = upload
+    await send('handle_document', user_id, document={
+        'file_id': file_id, 'file_unique_id': file_id, 'file_name': 'employees.csv',
+        'mime_type': 'text/csv', 'file_size': len(upload)})
+
+async def _run_load(args, tmp):
+    llm = StubLLMServer(args.llm_latency)
+    # bot reads its configuration at import time
+    os.environ.update({
+        'OPENROUTER_API_URL': await llm.start(),
+        'OPENROUTER_API_KEY': 'load-test',
+        'BOT_DB_PATH': os.path.join(tmp, 'bot_data.db'),
+        'TRANSLATION_CACHE_DB': os.path.join(tmp, 'translation_cache.db'),
+        'METRICS_PORT': '0',
+    })
+    import bot
+    # Per-request INFO logging would dominate the measurement
+    logging.getLogger().setLevel(logging.WARNING)
+    warnings.filterwarnings('ignore', message='Glyph')
+    
+    upload = _employee_upload(args.upload_rows)
+    files = {}
+    transport = _fake_bot_transport(files, args.telegram_latency)
+    
+    bot.initialize()
+    application = await _start_application(bot, transport, args.concurrent_updates)
+    await application.post_init(application)
+    en = bot.LANGUAGES['en']
+    latencies = {}
+    send = _update_sender(application, latencies)
+    
+    async def simulate_user(user_id):
+        rng = random.Random(user_id)
+        await asyncio.sleep(rng.uniform(0, args.ramp_up))
+        for loop in range(args.loops):
+            await _open_session(send, bot, user_id, files, upload, first=loop == 0)
+            for _ in range(args.queries):
+                await send('process_query', user_id, text=rng.choice(LOAD_QUESTIONS))
+                await asyncio.sleep(rng.uniform(0, args.think_time))
+    
+    lag = []
+    monitor = asyncio.create_task(_measure_loop_lag(lag))
+    started = time.perf_counter()
+    await asyncio.gather(*(simulate_user(1000 + n) for n in range(args.users)))
+    wall = time.perf_counter() - started
+    monitor.cancel()
+    
+    await application.shutdown()
+    await application.post_shutdown(application)
+    await llm.stop()
+    
+    errors = sum(text in (en['error_general'], en['error_query']) for text in transport.replies)
+    updates = sum(len(v) for v in latencies.values())
+    print(json.dumps({
+        'benchmark': 'load',
+        'users': args.users,
+        'concurrent_updates': bot.UPDATE_CONCURRENCY if args.concurrent_updates is None else args.concurrent_updates,
+        'llm_latency_ms': args.llm_latency * 1000,
+        'seconds': round(wall, 2),
+        'updates': updates,
+        'updates_per_sec': round(updates / wall, 1),
+        'errors': errors,
+        'llm_calls': llm.calls,
+        'bot_api_calls': transport.calls,
+        'loop_lag': _percentiles(lag or [0.0]),
+        'handlers': {name: _percentiles(seconds) for name, seconds in latencies.items()},
+    }), flush=True)
+
+def bench_load(args):
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        # Uploaded files are downloaded into the working directory
+        os.chdir(tmp)
+        try:
+            asyncio.run(_run_load(args, tmp))
+        finally:
+            os.chdir(cwd)
+
+ENGINE_QUERIES = [
+    "SELECT department, AVG(salary) AS avg_salary FROM employees GROUP BY department",
+    "SELECT department, position, COUNT(*) FROM employees GROUP BY department, position",
+    "SELECT COUNT(*) FROM employees WHERE status = 'active'",
+    "SELECT status, MIN(salary), MAX(salary), SUM(salary) FROM employees GROUP BY status ORDER BY SUM(salary) DESC",
+    "SELECT manager_id, COUNT(*) AS reports FROM employees GROUP BY manager_id ORDER BY reports DESC, manager_id LIMIT 10",
+    "SELECT COUNT(DISTINCT last_name) AS surnames FROM employees",
+    "SELECT department, ROUND(AVG(salary), 2) FROM employees WHERE hire_date >= '2015/01/01' "
+    "GROUP BY department HAVING COUNT(*) > 10",
+    "SELECT AVG(manager_id), COUNT(manager_id) FROM employees",
+    "SELECT hire_date, COUNT(*) FROM employees GROUP BY hire_date ORDER BY 2 DESC, 1 LIMIT 5",
+    "SELECT first_name, COUNT(*) FROM employees WHERE salary BETWEEN 4000 AND 5000 GROUP BY first_name",
+    # Group key after the aggregate: rows still come back in group key order
+    "SELECT AVG(salary), department FROM employees GROUP BY department",
+    "SELECT COUNT(*), status, department FROM employees GROUP BY department, status HAVING COUNT(*) > 1",
+    # Integer sums stay integers
+    "SELECT department, SUM(manager_id IS NULL) AS unmanaged, SUM(LENGTH(email)) FROM employees GROUP BY department",
+    # Not routed: point lookups and SQLite-specific semantics stay on SQLite
+    "SELECT * FROM employees WHERE email = 'maria.lee10@example.org'",
+    "SELECT department, COUNT(*) FROM employees WHERE last_name LIKE 's%' GROUP BY department",
+]
+
+def bench_engines(args):
+    """Run the query corpus on SQLite and on the columnar copy and compare results"""
+    import sqlite3
+    import pandas as pd
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ['BOT_DB_PATH'] = os.path.join(tmp, 'bot_data.db')
+        os.environ['COLUMNAR_MIN_ROWS'] = '0'
+        import bot
+        if not bot.columnar_available():
+            sys.exit("duckdb and pyarrow are required for this benchmark")
+        csv_path = write_synthetic_csv(os.path.join(tmp, 'employees.csv'), args.rows)
+        db_path = os.path.join(tmp, 'employees.db')
+        bot.ingest_csv(csv_path, db_path, 'employees')
+        started = time.perf_counter()
+        bot.write_columnar_copy(db_path, 'employees')
+        print(json.dumps({'benchmark': 'engines', 'rows': args.rows, 'stage': 'parquet_copy',
+                          'seconds': round(time.perf_counter() - started, 2),
+                          'parquet_mb': round(os.path.getsize(bot.columnar_path(db_path, 'employees')) / 2**20, 1)}),
+              flush=True)
+        
+        mismatches = 0
+        conn = sqlite3.connect(db_path)
+        for sql in ENGINE_QUERIES:
+            seconds, expected = _timings(partial(pd.read_sql_query, sql, conn), args.repeat)
+            route = bot.columnar_route(db_path, sql)
+            record = {'benchmark': 'engines', 'rows': args.rows, 'query': sql, 'routed': route is not None,
+                      'sqlite_ms': round(sorted(seconds)[len(seconds) // 2] * 1000, 1)}
+            if route:
+                columns = [d[0] for d in conn.execute(f"SELECT * FROM ({sql}) LIMIT 0").description]
+                seconds, actual = _timings(
+                    partial(bot.run_columnar_query, route[1], route[0], sql, columns), args.repeat)
+                record['columnar_ms'] = round(sorted(seconds)[len(seconds) // 2] * 1000, 1)
+                record['speedup'] = round(record['sqlite_ms'] / record['columnar_ms'], 1)
+                try:
+                    pd.testing.assert_frame_equal(expected.reset_index(drop=True), actual.reset_index(drop=True),
+                                                  check_exact=False, rtol=1e-9)
+                    record['equal'] = True
+                except AssertionError as e:
+                    mismatches += 1
+                    record['equal'] = False
+                    record['difference'] = str(e).splitlines()[:6]
+            print(json.dumps(record), flush=True)
+        conn.close()
+        if mismatches:
+            sys.exit(f"{mismatches} queries returned different results on the two engines")
+
+async def _two_users(slow, fast, delay=0.1):
+    """Seconds each user waits when the fast one writes while the slow one's update is running"""
+    async def later():
+        await asyncio.sleep(delay)
+        return await fast()
+    return await asyncio.gather(slow(), later())
+
+def _llm_question(user_id, n=0):
+    # Nothing local can translate this, so it waits for the stub LLM; the user id keeps caches out of it
+    return f"which employees earn unusually well, case {user_id} question {n}"
+
+def _waits(slow, fast):
+    return {'slow_user_ms': round(slow * 1000, 1), 'fast_user_ms': round(fast * 1000, 1), 'ok': fast < slow / 4}
+
+async def _isolation_llm(h, slow_user, fast_user, args):
+    return _waits(*await _two_users(lambda: h.send('process_query', slow_user, text=_llm_question(slow_user)),
+                                    lambda: h.send('process_query', fast_user, text="show all")))
+
+async def _isolation_fair_queue(h, first_user, second_user, args):
+    """With a single LLM slot, two users asking several questions each take turns and the waiting one is told"""
+    async def ask(user_id):
+        for n in range(args.questions):
+            await h.send('process_query', user_id, text=_llm_question(user_id, n))
+    
+    seen, replies = len(h.llm.prompts), len(h.transport.replies)
+    h.bot.LLM_SCHEDULER.max_concurrency = 1
+    try:
+        await _two_users(partial(ask, first_user), partial(ask, second_user))
+    finally:
+        h.bot.LLM_SCHEDULER.max_concurrency = h.bot.OPENROUTER_MAX_CONCURRENCY
+    order = [int(m.group(1)) for m in (re.search(r'case (\d+)', p) for p in h.llm.prompts[seen:]) if m]
+    queued = sum('in the queue' in text for text in h.transport.replies[replies:])
+    alternating = all(a != b for a, b in zip(order, order[1:]))
+    return {'dispatch_order': ['first' if u == first_user else 'second' for u in order],
+            'queue_position_messages': queued, 'ok': alternating and queued > 0}
+
+async def _isolation_slow_sql(h, slow_user, fast_user, args):
+    # The fast user writes once the slow user's LLM answer is in and its query is running
+    return _waits(*await _two_users(lambda: h.send('process_query', slow_user, text=f"slow report, case {slow_user}"),
+                                    lambda: h.send('process_query', fast_user, text="show all"),
+                                    delay=args.llm_latency + 0.5))
+
+async def _isolation_chart(h, chart_user, text_user, args):
+    """A text answer doesn't wait for someone else's chart, and the chart replaces the processing message"""
+    deleted, renders = h.transport.calls.get('deleteMessage', 0), h.bot.CHART_RENDERER.renders
+    record = _waits(*await _two_users(lambda: h.send('process_query', chart_user, text="average salary by department"),
+                                      lambda: h.send('process_query', text_user, text="show all")))
+    record['charts_sent'] = h.bot.CHART_RENDERER.renders - renders
+    record['processing_messages_deleted'] = h.transport.calls.get('deleteMessage', 0) - deleted
+    record['ok'] = record['ok'] and record['charts_sent'] == record['processing_messages_deleted'] == 1
+    return record
+
+# Case -> coroutine(harness, first user, second user, args) returning the record's measurements and 'ok'
+ISOLATION_CASES = {
+    'llm': _isolation_llm,
+    'fair_queue': _isolation_fair_queue,
+    'slow_sql': _isolation_slow_sql,
+    'chart': _isolation_chart,
+}
+
+async def _run_isolation(args, tmp):
+    llm = StubLLMServer(args.llm_latency)
+    os.environ.update({
+        'OPENROUTER_API_URL': await llm.start(),
+        'OPENROUTER_API_KEY': 'isolation',
+        'BOT_DB_PATH': os.path.join(tmp, 'bot_data.db'),
+        'TRANSLATION_CACHE_DB': os.path.join(tmp, 'translation_cache.db'),
+        'METRICS_PORT': '0',
+        # Background warm-up LLM calls would share the stub with the cases
+        'WARMUP': '0',
+    })
+    import bot
+    from types import SimpleNamespace
+    logging.getLogger().setLevel(logging.WARNING)
+    warnings.filterwarnings('ignore', message='Glyph')
+    bot.initialize()
+    upload = _employee_upload(args.upload_rows)
+    files = {}
+    transport = _fake_bot_transport(files, 0)
+    user_ids = iter(range(2000, 1 << 30))
+    failures = 0
+    application = None
+    for case in args.cases:
+        # One update at a time first, for comparison, then as main() runs
+        for concurrent_updates in (0, None):
+            application = await _start_application(bot, transport, concurrent_updates)
+            h = SimpleNamespace(bot=bot, send=_update_sender(application), llm=llm, transport=transport)
+            users = next(user_ids), next(user_ids)
+            for user_id in users:
+                await _open_session(h.send, bot, user_id, files, upload)
+            record = {'benchmark': 'isolation', 'case': case,
+                      'concurrent_updates': bot.UPDATE_CONCURRENCY if concurrent_updates is None else 0,
+                      **await ISOLATION_CASES[case](h, *users, args)}
+            # One update at a time is only the baseline
+            if concurrent_updates is None:
+                failures += not record['ok']
+            else:
+                del record['ok']
+            print(json.dumps(record), flush=True)
+            await application.shutdown()
+    await bot.shutdown_services(application)
+    await llm.stop()
+    return failures
+
+def bench_isolation(args):
+    """Two users through the real Application: one user's slow update must not hold up the other's"""
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        # Uploaded files are downloaded into the working directory
+        os.chdir(tmp)
+        try:
+            failures = asyncio.run(_run_isolation(args, tmp))
+        finally:
+            os.chdir(cwd)
+    if failures:
+        sys.exit(f"{failures} isolation cases failed")
+
+# Columns whose storage class changes between export chunks: NULL first then integers,
+# integers then reals, numbers then text
+EXPORT_COLUMNS = "id INTEGER, manager_id INTEGER, amount, code, note TEXT"
+
+def _export_rows(rows, chunk_rows):
+    for i in range(rows):
+        late = i >= chunk_rows
+        yield (i, i % 50 if late else None, i + 0.5 if late and i % 2 else i, f"c{i}" if late else i,
+               None if i % 7 == 0 else f"row {i}")
+
+def bench_export(args):
+    """Export a result whose column types change across chunks in every format and read it back"""
+    import sqlite3
+    import pandas as pd
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ['BOT_DB_PATH'] = os.path.join(tmp, 'bot_data.db')
+        import bot
+        db_path = os.path.join(tmp, 'mixed.db')
+        conn = sqlite3.connect(db_path)
+        conn.execute(f"CREATE TABLE mixed ({EXPORT_COLUMNS})")
+        conn.executemany("INSERT INTO mixed VALUES (?, ?, ?, ?, ?)", _export_rows(args.rows, args.chunk_rows))
+        conn.commit()
+        sql = "SELECT *, amount * 2 AS doubled, COUNT(*) OVER () AS total FROM mixed ORDER BY id"
+        expected = pd.read_sql_query(sql, conn)
+        conn.close()
+        
+        failures = 0
+        for fmt in ('csv.gz', 'zip', 'parquet'):
+            out_dir = os.path.join(tmp, fmt)
+            os.makedirs(out_dir)
+            record = {'benchmark': 'export', 'format': fmt, 'rows': args.rows, 'chunk_rows': args.chunk_rows}
+            try:
+                seconds, paths = _timings(partial(bot.export_query_results, db_path, sql, out_dir, 'mixed', fmt,
+                                                  chunk_rows=args.chunk_rows), 1)
+                if fmt == 'parquet':
+                    actual = pd.concat([pd.read_parquet(path) for path in paths], ignore_index=True)
+                    # code mixes numbers and text, so it comes back as text; the rest must match exactly
+                    pd.testing.assert_frame_equal(expected.astype({'code': str}), actual.astype({'code': str}),
+                                                  check_dtype=False)
+                else:
+                    actual = pd.concat([pd.read_csv(path) for path in paths], ignore_index=True)
+                    assert len(actual) == len(expected), f"{len(actual)} rows read back, {len(expected)} expected"
+                record.update(ms=round(seconds[0] * 1000, 1), parts=len(paths), ok=True)
+            except Exception as e:
+                failures += 1
+                record.update(ok=False, error=f"{type(e).__name__}: {e}".splitlines()[:6])
+            print(json.dumps(record), flush=True)
+        if failures:
+            sys.exit(f"{failures} export formats failed")
+
+# Question -> SQL the rule-based translator must produce; None means the question goes to the LLM
+RULE_CASES = [
+    ("average salary by department", "SELECT department, AVG(salary) FROM employees GROUP BY department"),
+    ("how many employees", "SELECT COUNT(*) FROM employees"),
+    ("how many different departments", "SELECT COUNT(DISTINCT department) FROM employees"),
+    ("top 5 employees by salary", "SELECT * FROM employees ORDER BY salary DESC LIMIT 5"),
+    ("top 3 salaries", "SELECT salary FROM employees ORDER BY salary DESC LIMIT 3"),
+    ("топ 5 зарплат", "SELECT salary FROM employees ORDER BY salary DESC LIMIT 5"),
+    ("top 10 highest salaries", "SELECT salary FROM employees ORDER BY salary DESC LIMIT 10"),
+    ("first 5 lowest salaries", "SELECT salary FROM employees ORDER BY salary ASC LIMIT 5"),
+    ("top 5 employees with the highest salary", "SELECT * FROM employees ORDER BY salary DESC LIMIT 5"),
+    ("employee with the highest salary",
+     "SELECT * FROM employees WHERE salary = (SELECT MAX(salary) FROM employees)"),
+    ("сотрудники с зарплатой больше 5000", "SELECT * FROM employees WHERE salary > 5000"),
+    ("count of salary", None),
+    ("top 3 average salary", None),
+    ("first 10 employees with salary > 5000", None),
+    ("first 10", None),
+]
+
+def bench_rules(args):
+    """Check the rule-based translator against RULE_CASES and time it"""
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ['BOT_DB_PATH'] = os.path.join(tmp, 'bot_data.db')
+        import bot
+        failures = 0
+        for question, expected in RULE_CASES:
+            seconds, sql = _timings(partial(bot.rule_based_sql, question, 'employees', EMPLOYEE_COLUMNS), args.repeat)
+            if sql != expected:
+                failures += 1
+            print(json.dumps({'benchmark': 'rules', 'question': question, 'sql': sql, 'ok': sql == expected,
+                              'us_median': round(sorted(seconds)[len(seconds) // 2] * 1e6, 1)},
+                             ensure_ascii=False), flush=True)
+        if failures:
+            sys.exit(f"{failures} questions were translated differently than expected")
+
+async def _time_to_sql(args, case, answer):
+    import bot
+    server = StreamingLLMServer(args.llm_latency, args.token_delay, answer)
+    bot.OPENROUTER_API_URL = await server.start()
+    records = {}
+    for streaming in (False, True):
+        bot.LLM_STREAM = streaming
+        seconds = []
+        sql = None
+        server.sent_tokens = 0
+        for i in range(args.repeat):
+            started = time.perf_counter()
+            # A distinct question per run, so single-flight and caches never answer
+            sql, _ = await bot.generate_sql_with_visualization(
+                "Table employees: department, salary", f"average salary by department ({case}, {streaming}, run {i})",
+                'employees', 'en')
+            seconds.append(time.perf_counter() - started)
+        records['streaming' if streaming else 'blocking'] = {
+            'ms_median': round(sorted(seconds)[len(seconds) // 2] * 1000, 1),
+            'tokens_sent': round(server.sent_tokens / args.repeat),
+            'sql_ok': sql.strip() == STREAM_SQL,
+        }
+    await bot.OPENROUTER_CLIENT.aclose()
+    await server.stop()
+    return records
+
+def bench_stream(args):
+    """Time from request to runnable SQL, blocking completion vs streaming with early stop"""
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ['BOT_DB_PATH'] = os.path.join(tmp, 'bot_data.db')
+        os.environ['TRANSLATION_CACHE_DB'] = os.path.join(tmp, 'translation_cache.db')
+        os.environ.setdefault('OPENROUTER_API_KEY', 'bench')
+        logging.getLogger('bot').setLevel(logging.WARNING)
+        logging.getLogger('httpx').setLevel(logging.WARNING)
+        import bot
+        failures = 0
+        for case, answer in STREAM_ANSWERS:
+            records = asyncio.run(_time_to_sql(args, case, answer))
+            blocking, streaming = records['blocking'], records['streaming']
+            failures += not (blocking['sql_ok'] and streaming['sql_ok'])
+            print(json.dumps({
+                'benchmark': 'stream', 'case': case, 'answer_tokens': len(re.findall(r'\S+\s*|\s+', answer)),
+                'token_delay_ms': args.token_delay * 1000, 'blocking': blocking, 'streaming': streaming,
+                'speedup': round(blocking['ms_median'] / streaming['ms_median'], 2),
+            }), flush=True)
+        if failures:
+            sys.exit(f"{failures} answer shapes did not yield the expected SQL")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest='command', required=True)
+    
+    ingest = sub.add_parser('ingest', help='CSV ingestion throughput and peak RSS')
+    ingest.add_argument('--rows', type=int, default=1_000_000)
+    ingest.add_argument('--compare', action='store_true', help='also run the read_csv/to_sql path')
+    ingest.set_defaults(func=bench_ingest)
+    
+    metadata = sub.add_parser('metadata', help='per-message bot_data.db overhead')
+    metadata.add_argument('--users', type=int, default=10_000)
+    metadata.add_argument('--messages', type=int, default=20_000)
+    metadata.set_defaults(func=bench_metadata)
+    
+    startup = sub.add_parser('startup', help='import time by module and initialization time')
+    startup.add_argument('--runs', type=int, default=3)
+    startup.add_argument('--top', type=int, default=10, help='modules to report')
+    startup.set_defaults(func=bench_startup)
+    
+    stages = sub.add_parser('stages', help='time each request stage on synthetic employee tables')
+    stages.add_argument('--rows', type=lambda v: [int(n) for n in v.split(',')],
+                        default=[10_000, 1_000_000, 10_000_000], help='comma-separated table sizes')
+    stages.add_argument('--repeat', type=int, default=5)
+    stages.add_argument('--llm-latency', type=float, default=0.0, help='seconds the stubbed LLM waits')
+    stages.set_defaults(func=bench_stages)
+    
+    load = sub.add_parser('load', help='simulated users driving the real handlers through a fake Bot API')
+    load.add_argument('--users', type=int, default=50)
+    load.add_argument('--loops', type=int, default=2, help='/start, upload, query rounds per user')
+    load.add_argument('--queries', type=int, default=5, help='questions per upload')
+    load.add_argument('--upload-rows', type=int, default=5000)
+    load.add_argument('--llm-latency', type=float, default=0.5, help='seconds the stub LLM takes per answer')
+    load.add_argument('--telegram-latency', type=float, default=0.0, help='seconds per Bot API call')
+    load.add_argument('--think-time', type=float, default=0.5, help='max seconds a user waits between queries')
+    load.add_argument('--ramp-up', type=float, default=2.0, help='seconds over which users arrive')
+    load.add_argument('--concurrent-updates', type=int, default=None,
+                      help='updates processed at once (0: one at a time; default: as in main())')
+    load.set_defaults(func=bench_load)
+    
+    engines = sub.add_parser('engines', help='SQLite vs columnar engine: result equivalence and speed')
+    engines.add_argument('--rows', type=int, default=1_000_000)
+    engines.add_argument('--repeat', type=int, default=3)
+    engines.set_defaults(func=bench_engines)
+    
+    isolation = sub.add_parser('isolation', help="one user's slow update doesn't hold up another user")
+    isolation.add_argument('--cases', type=lambda v: v.split(','), default=list(ISOLATION_CASES))
+    isolation.add_argument('--llm-latency', type=float, default=2.0, help='seconds the stub server waits per answer')
+    isolation.add_argument('--upload-rows', type=int, default=5000)
+    isolation.add_argument('--questions', type=int, default=3, help='LLM questions per user in fair_queue')
+    isolation.set_defaults(func=bench_isolation)
+    
+    export = sub.add_parser('export', help='streaming export of mixed-type results in every format')
+    export.add_argument('--rows', type=int, default=50_000)
+    export.add_argument('--chunk-rows', type=int, default=1000)
+    export.set_defaults(func=bench_export)
+    
+    rules = sub.add_parser('rules', help='rule-based translator: expected SQL per question and speed')
+    rules.add_argument('--repeat', type=int, default=100)
+    rules.set_defaults(func=bench_rules)
+    
+    stream = sub.add_parser('stream', help='time to SQL: blocking completions vs streaming with early stop')
+    stream.add_argument('--repeat', type=int, default=5)
+    stream.add_argument('--llm-latency', type=float, default=0.3, help='seconds before the first token')
+    stream.add_argument('--token-delay', type=float, default=0.02, help='seconds per generated token')
+    stream.set_defaults(func=bench_stream)
+    
+    args = parser.parse_args(argv)
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
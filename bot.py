@@ -1,24 +1,36 @@
 import os
+import argparse
 import logging
 import sqlite3
-import pandas as pd
+import importlib
 import tempfile
 import json
 import re
+import hashlib
+import threading
+import time
+import csv
+import gzip
+import shutil
+import zipfile
+import bisect
+import email.utils
+from contextlib import contextmanager
+from functools import lru_cache, partial
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from pathlib import Path
-from datetime import datetime
-import requests
+from datetime import datetime, timezone
+import asyncio
+import httpx
 import io
-import matplotlib.pyplot as plt
-import matplotlib
-matplotlib.use('Agg')
-import numpy as np
-from tabulate import tabulate
 import random
 
 from dotenv import load_dotenv
 from telegram import Update, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.request import HTTPXRequest
 from telegram.ext import Application, CommandHandler, MessageHandler, ContextTypes, filters, CallbackQueryHandler, ConversationHandler
+from telegram.ext import BaseUpdateProcessor
 
 # Configure logging
 logging.basicConfig(
@@ -27,17 +39,133 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+class _LazyModule:
+    """Module proxy that performs the import on first attribute access.
+
+    pandas alone costs several hundred milliseconds to import, and most
+    processes (chart workers, handlers that never touch a DataFrame) don't
+    need it at all.
+    """
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+pd = _LazyModule('pandas')
+np = _LazyModule('numpy')
+
+def tabulate(*args, **kwargs):
+    from tabulate import tabulate as _tabulate
+    return _tabulate(*args, **kwargs)
+
 load_dotenv()
 # Configuration - UPDATE THESE WITH YOUR KEYS!
 OPENROUTER_API_KEY = os.getenv('OPENROUTER_API_KEY')
 TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
-OPENROUTER_API_URL = "https://openrouter.ai/api/v1/chat/completions"
+OPENROUTER_API_URL = os.getenv('OPENROUTER_API_URL', "https://openrouter.ai/api/v1/chat/completions")
+
+# OpenRouter HTTP client tuning
+OPENROUTER_MAX_CONCURRENCY = int(os.getenv('OPENROUTER_MAX_CONCURRENCY', '8'))
+OPENROUTER_POOL_SIZE = int(os.getenv('OPENROUTER_POOL_SIZE', '16'))
+OPENROUTER_CONNECT_TIMEOUT = float(os.getenv('OPENROUTER_CONNECT_TIMEOUT', '5'))
+OPENROUTER_READ_TIMEOUT = float(os.getenv('OPENROUTER_READ_TIMEOUT', '30'))
+OPENROUTER_MODEL = os.getenv('OPENROUTER_MODEL', 'google/gemini-pro')
+
+# LLM request scheduling: tokens per minute across all users (0 = no budget) and 429 retries
+LLM_TOKENS_PER_MINUTE = int(os.getenv('LLM_TOKENS_PER_MINUTE', '0'))
+LLM_MAX_RETRIES = int(os.getenv('LLM_MAX_RETRIES', '3'))
+LLM_MAX_BACKOFF = float(os.getenv('LLM_MAX_BACKOFF', '60'))
+
+# Text-to-SQL prompts: schema size budget in estimated tokens and the completion cap for the SQL answer
+LLM_SCHEMA_TOKENS = int(os.getenv('LLM_SCHEMA_TOKENS', '1200'))
+LLM_SQL_MAX_TOKENS = int(os.getenv('LLM_SQL_MAX_TOKENS', '256'))
+# Stream SQL completions and stop reading at the end of the first statement
+LLM_STREAM = os.getenv('LLM_STREAM', '1') == '1'
+
+# Bot metadata database (user settings and uploaded databases)
+BOT_DB_PATH = os.getenv('BOT_DB_PATH', 'bot_data.db')
+
+# NL-to-SQL translation cache (stored next to bot_data.db)
+TRANSLATION_CACHE_DB = os.getenv('TRANSLATION_CACHE_DB', 'translation_cache.db')
+TRANSLATION_CACHE_MAX_ENTRIES = int(os.getenv('TRANSLATION_CACHE_MAX_ENTRIES', '5000'))
+TRANSLATION_CACHE_TTL = int(os.getenv('TRANSLATION_CACHE_TTL', str(7 * 24 * 3600)))
+
+# Query execution: worker threads and per-query wall-clock deadline (seconds)
+SQL_WORKERS = int(os.getenv('SQL_WORKERS', '4'))
+SQL_QUERY_TIMEOUT = float(os.getenv('SQL_QUERY_TIMEOUT', '20'))
+SQL_PROGRESS_STEPS = 10000
+
+# Rows per page for paginated table results
+RESULT_PAGE_SIZE = int(os.getenv('RESULT_PAGE_SIZE', '10'))
+
+# Full-result downloads: format (csv.gz, zip or parquet), rows per chunk and per-file size cap
+EXPORT_FORMAT = os.getenv('EXPORT_FORMAT', 'csv.gz')
+EXPORT_CHUNK_ROWS = int(os.getenv('EXPORT_CHUNK_ROWS', '20000'))
+EXPORT_TIMEOUT = float(os.getenv('EXPORT_TIMEOUT', '600'))
+TELEGRAM_UPLOAD_LIMIT = int(os.getenv('TELEGRAM_UPLOAD_LIMIT', str(50 * 1024 * 1024)))
+
+# Upload ingestion: rows per chunk, rows sampled for type inference, seconds between progress edits
+INGEST_WORKERS = int(os.getenv('INGEST_WORKERS', '2'))
+INGEST_CHUNK_ROWS = int(os.getenv('INGEST_CHUNK_ROWS', '20000'))
+INGEST_SAMPLE_ROWS = int(os.getenv('INGEST_SAMPLE_ROWS', '10000'))
+INGEST_PROGRESS_INTERVAL = float(os.getenv('INGEST_PROGRESS_INTERVAL', '2'))
+EXCEL_WORKERS = int(os.getenv('EXCEL_WORKERS', str(os.cpu_count() or 2)))
+
+# Chart rendering: worker processes and how many renders may be queued at once
+CHART_WORKERS = int(os.getenv('CHART_WORKERS', '2'))
+CHART_QUEUE_SIZE = int(os.getenv('CHART_QUEUE_SIZE', '16'))
+
+# Number of databases whose schema metadata is kept in memory
+SCHEMA_CACHE_SIZE = int(os.getenv('SCHEMA_CACHE_SIZE', '256'))
+
+# Metrics: Prometheus endpoint (METRICS_PORT=0 disables it), rolling window for percentiles,
+# and the Telegram user ids allowed to run /stats
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9464'))
+METRICS_WINDOW = int(os.getenv('METRICS_WINDOW', '300'))
+ADMIN_USER_IDS = {int(i) for i in os.getenv('ADMIN_USER_IDS', '').replace(',', ' ').split()}
+
+# Automatic indexing: a filter or sort column that is scanned AUTO_INDEX_SCAN_THRESHOLD times on a table
+# of at least AUTO_INDEX_MIN_ROWS rows gets an index, as long as a table has fewer than
+# AUTO_INDEX_MAX_PER_TABLE of them and their total size stays under AUTO_INDEX_BUDGET times the data size
+AUTO_INDEX = os.getenv('AUTO_INDEX', '1') == '1'
+AUTO_INDEX_MIN_ROWS = int(os.getenv('AUTO_INDEX_MIN_ROWS', '50000'))
+AUTO_INDEX_SCAN_THRESHOLD = int(os.getenv('AUTO_INDEX_SCAN_THRESHOLD', '3'))
+AUTO_INDEX_MAX_PER_TABLE = int(os.getenv('AUTO_INDEX_MAX_PER_TABLE', '4'))
+AUTO_INDEX_BUDGET = float(os.getenv('AUTO_INDEX_BUDGET', '0.5'))
+
+# Columnar engine: uploads of at least COLUMNAR_MIN_ROWS rows get a Parquet copy, and aggregate queries
+# on them run in DuckDB when it is installed. COLUMNAR_ENGINE=none keeps everything on SQLite.
+COLUMNAR_ENGINE = os.getenv('COLUMNAR_ENGINE', 'duckdb')
+COLUMNAR_MIN_ROWS = int(os.getenv('COLUMNAR_MIN_ROWS', '500000'))
+
+# Column profiles: distinct values tracked exactly per column before falling back to an estimate
+PROFILE_TRACKED_VALUES = int(os.getenv('PROFILE_TRACKED_VALUES', '2000'))
+
+# Warm-up after an upload: the suggested queries are answered ahead of time, WARMUP_QUESTIONS
+# ('|'-separated) are translated ahead of time and up to WARMUP_CACHE_BYTES of the database file
+# are read into the OS page cache. WARMUP=0 disables it.
+WARMUP = os.getenv('WARMUP', '1') == '1'
+WARMUP_QUESTIONS = [q.strip() for q in os.getenv(
+    'WARMUP_QUESTIONS', 'How many records are there?|Summary statistics|Missing values per column').split('|')
+    if q.strip()]
+WARMUP_CACHE_BYTES = int(os.getenv('WARMUP_CACHE_BYTES', str(256 * 1024 * 1024)))
+SUGGESTED_QUERIES = ("Show entire table", "Show first 10 records")
 
 # Conversation states
 LANGUAGE, MAIN_MENU, TEXT_TO_SQL, CREATE_DB = range(4)
 
-# User states to manage conversation flow
-USER_STATES = {}
+# Updates handled at once across users; each user's own updates still run one after another.
+# UPDATE_CONCURRENCY=0 handles every update one at a time.
+UPDATE_CONCURRENCY = int(os.getenv('UPDATE_CONCURRENCY', '64'))
+
+# Idle user sessions are written to bot_data.db and dropped from memory after SESSION_IDLE_TTL seconds
+SESSION_IDLE_TTL = int(os.getenv('SESSION_IDLE_TTL', '1800'))
+SESSION_MAINTENANCE_INTERVAL = int(os.getenv('SESSION_MAINTENANCE_INTERVAL', '60'))
 
 # Supported languages
 LANGUAGES = {
@@ -63,10 +191,12 @@ LANGUAGES = {
         'data_added': "✅ Data added successfully!",
         'no_db_selected': "⚠️ Please select or upload a database first.",
         'processing': "⏳ Processing your request...",
+        'processing_queued': "⏳ Processing your request... you are #{} in the queue (about {} s)",
         'error_general': "❌ Sorry, an error occurred. Please try again.",
         'error_db_creation': "❌ Couldn't create database. Please try again with a clearer description.",
         'error_query': "❌ Couldn't process your query. Please try again.",
         'error_api': "❌ API service is temporarily unavailable. Please try again later.",
+        'error_query_timeout': "⏱ The query took longer than {} seconds and was cancelled. Try a narrower question.",
         'help_text': """
 🤖 *Advanced Text-to-SQL Bot Help*
 
@@ -100,7 +230,15 @@ LANGUAGES = {
         'voice_processing': "🎤 Processing your voice message...",
         'voice_transcribed': "🎤 Voice transcribed: '{}'",
         'table_info': "📊 Table: {} ({} columns, {} rows)",
-        'language_changed': "🌐 Language changed to English"
+        'language_changed': "🌐 Language changed to English",
+        'page_header': "Page {} (rows {}–{})",
+        'prev_page': "⬅️ Prev",
+        'next_page': "Next ➡️",
+        'download_csv': "📁 Download CSV",
+        'export_caption': "📁 Full dataset download",
+        'export_part_caption': "📁 Full dataset download (part {} of {})",
+        'ingest_progress': "⏳ Loading data: {:,} rows ({}%)",
+        'page_expired': "This result is no longer available. Please run the query again."
     },
     'ru': {
         'welcome': "🚀 *Продвинутый Text-to-SQL Ассистент*\n\nЯ помогу вам работать с базами данных на естественном языке!",
@@ -124,10 +262,12 @@ LANGUAGES = {
         'data_added': "✅ Данные успешно добавлены!",
         'no_db_selected': "⚠️ Сначала выберите или загрузите базу данных.",
         'processing': "⏳ Обрабатываю ваш запрос...",
+        'processing_queued': "⏳ Обрабатываю ваш запрос... вы #{} в очереди (около {} с)",
         'error_general': "❌ Извините, произошла ошибка. Попробуйте еще раз.",
         'error_db_creation': "❌ Не удалось создать базу данных. Попробуйте еще раз с более четким описанием.",
         'error_query': "❌ Не удалось обработать запрос. Попробуйте еще раз.",
         'error_api': "❌ Сервис API временно недоступен. Попробуйте позже.",
+        'error_query_timeout': "⏱ Запрос выполнялся дольше {} секунд и был отменен. Попробуйте сузить вопрос.",
         'help_text': """
 🤖 *Помощь по Text-to-SQL боту*
 
@@ -161,11 +301,145 @@ LANGUAGES = {
         'voice_processing': "🎤 Обрабатываю ваше голосовое сообщение...",
         'voice_transcribed': "🎤 Голос расшифрован: '{}'",
         'table_info': "📊 Таблица: {} ({} столбцов, {} строк)",
-        'language_changed': "🌐 Язык изменен на Русский"
+        'language_changed': "🌐 Язык изменен на Русский",
+        'page_header': "Страница {} (строки {}–{})",
+        'prev_page': "⬅️ Назад",
+        'next_page': "Далее ➡️",
+        'download_csv': "📁 Скачать CSV",
+        'export_caption': "📁 Полный набор данных",
+        'export_part_caption': "📁 Полный набор данных (часть {} из {})",
+        'ingest_progress': "⏳ Загрузка данных: {:,} строк ({}%)",
+        'page_expired': "Этот результат больше недоступен. Выполните запрос еще раз."
     }
 }
 
+class LatencyHistogram:
+    """Cumulative Prometheus-style buckets plus a rolling window of recent samples"""
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, window=METRICS_WINDOW, max_samples=10000):
+        self.window = window
+        self.bucket_counts = [0] * len(self.BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.errors = 0
+        self.recent = deque(maxlen=max_samples)
+
+    def observe(self, seconds):
+        self.count += 1
+        self.sum += seconds
+        index = bisect.bisect_left(self.BUCKETS, seconds)
+        if index < len(self.bucket_counts):
+            self.bucket_counts[index] += 1
+        self.recent.append((time.monotonic(), seconds))
+
+    def quantiles(self, qs=(0.5, 0.95, 0.99)):
+        cutoff = time.monotonic() - self.window
+        while self.recent and self.recent[0][0] < cutoff:
+            self.recent.popleft()
+        values = sorted(seconds for _, seconds in self.recent)
+        if not values:
+            return {q: None for q in qs}
+        return {q: values[min(len(values) - 1, int(q * len(values)))] for q in qs}
+
+class Metrics:
+    """Per-stage latency histograms and error counts.
+
+    Stages are 'llm', 'llm_queue', 'sql', 'schema', 'visualize', 'chart',
+    'export', 'warmup' and 'telegram', the latter with the Bot API method as
+    detail.
+    """
+    def __init__(self):
+        self.histograms = {}
+        self.started = time.time()
+        self._lock = threading.Lock()
+
+    def _histogram(self, stage, detail):
+        key = (stage, detail)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self.histograms.setdefault(key, LatencyHistogram())
+        return histogram
+
+    def observe(self, stage, seconds, detail=''):
+        histogram = self._histogram(stage, detail)
+        with self._lock:
+            histogram.observe(seconds)
+
+    def error(self, stage, detail=''):
+        histogram = self._histogram(stage, detail)
+        with self._lock:
+            histogram.errors += 1
+
+    @contextmanager
+    def timer(self, stage, detail=''):
+        """Time a block; an exception escaping it also counts as an error"""
+        started = time.perf_counter()
+        try:
+            yield
+        except BaseException as e:
+            if not isinstance(e, (asyncio.CancelledError, GeneratorExit)):
+                self.error(stage, detail)
+            raise
+        finally:
+            self.observe(stage, time.perf_counter() - started, detail)
+
+    def snapshot(self):
+        """Rolling percentiles per stage, for /stats"""
+        with self._lock:
+            rows = []
+            for (stage, detail), histogram in sorted(self.histograms.items()):
+                q = histogram.quantiles()
+                rows.append({
+                    'stage': f"{stage}:{detail}" if detail else stage,
+                    'count': histogram.count,
+                    'errors': histogram.errors,
+                    'p50': q[0.5], 'p95': q[0.95], 'p99': q[0.99]
+                })
+            return rows
+
+    def prometheus(self, cache_stats):
+        """Render all metrics in the Prometheus text exposition format"""
+        lines = [
+            "# HELP textsql_stage_seconds Time spent per request stage",
+            "# TYPE textsql_stage_seconds histogram",
+        ]
+        errors = [
+            "# HELP textsql_stage_errors_total Failed operations per request stage",
+            "# TYPE textsql_stage_errors_total counter",
+        ]
+        with self._lock:
+            for (stage, detail), histogram in sorted(self.histograms.items()):
+                labels = f'stage="{stage}"' + (f',method="{detail}"' if detail else '')
+                cumulative = 0
+                for bound, n in zip(LatencyHistogram.BUCKETS, histogram.bucket_counts):
+                    cumulative += n
+                    lines.append(f'textsql_stage_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+                lines.append(f'textsql_stage_seconds_bucket{{{labels},le="+Inf"}} {histogram.count}')
+                lines.append(f'textsql_stage_seconds_sum{{{labels}}} {histogram.sum:.6f}')
+                lines.append(f'textsql_stage_seconds_count{{{labels}}} {histogram.count}')
+                errors.append(f'textsql_stage_errors_total{{{labels}}} {histogram.errors}')
+        lines += errors
+        for cache, stats in cache_stats.items():
+            for key, value in stats.items():
+                kind = 'gauge' if key in ('hit_rate', 'pending', 'in_memory', 'queued', 'window_tokens') else 'counter'
+                name = f"textsql_{cache}_{key}" + ('_total' if kind == 'counter' else '')
+                lines.append(f"# TYPE {name} {kind}")
+                lines.append(f"{name} {value}")
+        lines.append("# TYPE textsql_uptime_seconds gauge")
+        lines.append(f"textsql_uptime_seconds {time.time() - self.started:.0f}")
+        return "\n".join(lines) + "\n"
+
+METRICS = Metrics()
+
 class UserState:
+    # Fields that survive idle eviction and restarts
+    PERSISTED_FIELDS = ('language', 'mode', 'current_db', 'current_db_name', 'current_table',
+                        'creating_db_name', 'creating_db_columns', 'waiting_for_column_def',
+                        'waiting_for_data', 'pagination_id')
+    __slots__ = PERSISTED_FIELDS + ('pagination', 'last_seen', 'dirty')
+    
     def __init__(self):
         self.language = None
         self.mode = None
@@ -176,82 +450,398 @@ class UserState:
         self.creating_db_columns = []
         self.waiting_for_column_def = False
         self.waiting_for_data = False
+        self.pagination = None  # Cursor state of the last paginated result
+        self.pagination_id = 0
+        self.last_seen = time.time()
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        if name in UserState.PERSISTED_FIELDS:
+            object.__setattr__(self, 'dirty', True)
+
+    def to_record(self):
+        return json.dumps({field: getattr(self, field) for field in self.PERSISTED_FIELDS})
+
+    @classmethod
+    def from_record(cls, record):
+        state = cls()
+        for field, value in json.loads(record).items():
+            if field in cls.PERSISTED_FIELDS:
+                setattr(state, field, value)
+        state.dirty = False
+        return state
+
+class MetadataStore:
+    """Bot metadata (user settings and databases) in bot_data.db.
+
+    One long-lived WAL-mode connection is shared by all helpers, so each
+    lookup reuses SQLite's prepared statement cache instead of reopening
+    the file. Async code can use arun() to run a method on the store's own
+    worker thread.
+    """
+    def __init__(self, db_path=BOT_DB_PATH):
+        self.db_path = db_path
+        self._conn = None
+        self._lock = threading.RLock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='metadata')
+
+    def connect(self):
+        with self._lock:
+            if self._conn is not None:
+                return self._conn
+            conn = sqlite3.connect(self.db_path, check_same_thread=False, cached_statements=256)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute('''CREATE TABLE IF NOT EXISTS user_databases
+                            (user_id INTEGER, db_name TEXT, db_path TEXT, table_name TEXT, columns TEXT, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+            conn.execute('''CREATE TABLE IF NOT EXISTS user_settings
+                            (user_id INTEGER PRIMARY KEY, language TEXT DEFAULT 'en')''')
+            conn.execute('''CREATE TABLE IF NOT EXISTS user_sessions
+                            (user_id INTEGER PRIMARY KEY, state TEXT, updated_at REAL)''')
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_user_databases_user_path ON user_databases (user_id, db_path)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_user_databases_user_created ON user_databases (user_id, created_at)")
+            conn.commit()
+            self._conn = conn
+            return conn
+
+    def _fetchone(self, sql, params):
+        with self._lock:
+            return self.connect().execute(sql, params).fetchone()
+
+    def _fetchall(self, sql, params):
+        with self._lock:
+            return self.connect().execute(sql, params).fetchall()
+
+    def _write(self, sql, params):
+        with self._lock:
+            conn = self.connect()
+            with conn:
+                conn.execute(sql, params)
+
+    def get_user_language(self, user_id):
+        result = self._fetchone("SELECT language FROM user_settings WHERE user_id=?", (user_id,))
+        return result[0] if result else 'en'
+
+    def save_user_language(self, user_id, language):
+        self._write("INSERT OR REPLACE INTO user_settings (user_id, language) VALUES (?, ?)", (user_id, language))
+
+    def get_user_databases(self, user_id):
+        return self._fetchall("SELECT db_name, db_path, table_name FROM user_databases WHERE user_id=? "
+                              "ORDER BY created_at DESC", (user_id,))
+
+    def save_user_database(self, user_id, db_name, db_path, table_name, columns):
+        self._write("INSERT INTO user_databases (user_id, db_name, db_path, table_name, columns) VALUES (?, ?, ?, ?, ?)",
+                    (user_id, db_name, db_path, table_name, json.dumps(columns)))
+
+    def get_database_record(self, user_id, db_path):
+        """(table_name, columns_json) of a user's database, or None"""
+        return self._fetchone("SELECT table_name, columns FROM user_databases WHERE user_id=? AND db_path=?",
+                              (user_id, db_path))
+
+    def load_session(self, user_id):
+        result = self._fetchone("SELECT state FROM user_sessions WHERE user_id=?", (user_id,))
+        return result[0] if result else None
+
+    def save_sessions(self, records):
+        """Upsert (user_id, state, updated_at) session records in one transaction"""
+        with self._lock:
+            conn = self.connect()
+            with conn:
+                conn.executemany("INSERT OR REPLACE INTO user_sessions (user_id, state, updated_at) VALUES (?, ?, ?)",
+                                 records)
+
+    async def arun(self, method, *args):
+        """Run a store method on the store's worker thread"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, method, *args)
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+        self._executor.shutdown(wait=False)
+
+METADATA_STORE = MetadataStore()
 
 # Initialize database for storing user databases info
 def init_bot_database():
-    conn = sqlite3.connect('bot_data.db')
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS user_databases
-                 (user_id INTEGER, db_name TEXT, db_path TEXT, table_name TEXT, columns TEXT, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-    c.execute('''CREATE TABLE IF NOT EXISTS user_settings
-                 (user_id INTEGER PRIMARY KEY, language TEXT DEFAULT 'en')''')
-    conn.commit()
-    conn.close()
+    METADATA_STORE.connect()
+
+class SessionStore:
+    """Mapping of user_id -> UserState backed by bot_data.db.
+
+    Sessions idle for longer than idle_ttl are written out and dropped from
+    memory by maintain(); the next message from that user rehydrates them,
+    which also carries sessions across restarts.
+    """
+    def __init__(self, metadata=METADATA_STORE, idle_ttl=SESSION_IDLE_TTL):
+        self.metadata = metadata
+        self.idle_ttl = idle_ttl
+        self.rehydrated = 0
+        self.evicted = 0
+        self._sessions = {}
+
+    def _lookup(self, user_id):
+        state = self._sessions.get(user_id)
+        if state is None:
+            try:
+                record = self.metadata.load_session(user_id)
+            except sqlite3.Error as e:
+                logger.error(f"Error loading session for user {user_id}: {e}")
+                record = None
+            if record is None:
+                return None
+            state = UserState.from_record(record)
+            self._sessions[user_id] = state
+            self.rehydrated += 1
+        state.last_seen = time.time()
+        return state
+
+    def __contains__(self, user_id):
+        return self._lookup(user_id) is not None
+
+    def __getitem__(self, user_id):
+        state = self._lookup(user_id)
+        if state is None:
+            raise KeyError(user_id)
+        return state
+
+    def __setitem__(self, user_id, state):
+        state.last_seen = time.time()
+        self._sessions[user_id] = state
 
-init_bot_database()
+    def __len__(self):
+        return len(self._sessions)
+
+    def _dirty_records(self):
+        now = time.time()
+        return [(user_id, state.to_record(), now) for user_id, state in self._sessions.items() if state.dirty]
+
+    def _mark_saved(self, records):
+        """Clear dirty once records are written, unless the session changed since"""
+        for user_id, record, _ in records:
+            state = self._sessions.get(user_id)
+            if state is not None and state.to_record() == record:
+                state.dirty = False
+
+    async def maintain(self):
+        """Write back changed sessions and evict idle ones"""
+        records = self._dirty_records()
+        if records:
+            # A failed write raises here, so nothing is marked clean or evicted
+            await self.metadata.arun(self.metadata.save_sessions, records)
+            self._mark_saved(records)
+        # A session touched while we were writing stays dirty and is kept for the next round
+        cutoff = time.time() - self.idle_ttl
+        idle = [user_id for user_id, state in self._sessions.items()
+                if state.last_seen < cutoff and not state.dirty]
+        for user_id in idle:
+            del self._sessions[user_id]
+        self.evicted += len(idle)
+
+    def flush(self):
+        records = self._dirty_records()
+        if records:
+            self.metadata.save_sessions(records)
+            self._mark_saved(records)
+
+# User states to manage conversation flow
+USER_STATES = SessionStore()
 
 def get_user_language(user_id):
-    conn = sqlite3.connect('bot_data.db')
-    c = conn.cursor()
-    c.execute("SELECT language FROM user_settings WHERE user_id=?", (user_id,))
-    result = c.fetchone()
-    conn.close()
-    return result[0] if result else 'en'
+    return METADATA_STORE.get_user_language(user_id)
 
 def save_user_language(user_id, language):
-    conn = sqlite3.connect('bot_data.db')
-    c = conn.cursor()
-    c.execute("INSERT OR REPLACE INTO user_settings (user_id, language) VALUES (?, ?)", 
-              (user_id, language))
-    conn.commit()
-    conn.close()
+    METADATA_STORE.save_user_language(user_id, language)
 
 def get_user_databases(user_id):
-    conn = sqlite3.connect('bot_data.db')
-    c = conn.cursor()
-    c.execute("SELECT db_name, db_path, table_name FROM user_databases WHERE user_id=? ORDER BY created_at DESC", (user_id,))
-    dbs = c.fetchall()
-    conn.close()
-    return dbs
+    return METADATA_STORE.get_user_databases(user_id)
 
 def save_user_database(user_id, db_name, db_path, table_name, columns):
-    conn = sqlite3.connect('bot_data.db')
-    c = conn.cursor()
-    c.execute("INSERT INTO user_databases (user_id, db_name, db_path, table_name, columns) VALUES (?, ?, ?, ?, ?)",
-              (user_id, db_name, db_path, table_name, json.dumps(columns)))
-    conn.commit()
-    conn.close()
+    METADATA_STORE.save_user_database(user_id, db_name, db_path, table_name, columns)
 
-def get_database_info(db_path):
-    """Get information about the database including table names and structure"""
+def _estimate_row_count(conn, table_name):
+    """Cheap row count: sqlite_stat1 if ANALYZE has run, else max(rowid).
+
+    Returns (count, exact). Tables without a rowid fall back to COUNT(*).
+    """
     try:
-        conn = sqlite3.connect(db_path)
+        row = conn.execute("SELECT stat FROM sqlite_stat1 WHERE tbl=? ORDER BY idx IS NOT NULL LIMIT 1",
+                           (table_name,)).fetchone()
+        if row and row[0]:
+            return int(row[0].split()[0]), False
+    except sqlite3.OperationalError:
+        pass  # No sqlite_stat1 table
+    try:
+        row = conn.execute(f"SELECT max(rowid) FROM {_quote_identifier(table_name)}").fetchone()
+        return (row[0] or 0), False
+    except sqlite3.OperationalError:
+        row = conn.execute(f"SELECT COUNT(*) FROM {_quote_identifier(table_name)}").fetchone()
+        return row[0], True
+
+def _count_rows_exact(db_path, table_name):
+    conn = sqlite3.connect(db_path)
+    try:
+        return conn.execute(f"SELECT COUNT(*) FROM {_quote_identifier(table_name)}").fetchone()[0]
+    finally:
+        conn.close()
+
+class SchemaCache:
+    """In-memory cache of get_database_info results.
+
+    Entries are validated against the file's mtime and size and against
+    PRAGMA data_version on a long-lived connection, which also catches
+    commits that only touch a WAL file. Row counts start as estimates and
+    are replaced by exact counts computed in the background.
+    """
+    def __init__(self, max_entries=SCHEMA_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._counter = ThreadPoolExecutor(max_workers=1, thread_name_prefix='rowcount')
+
+    def _stamp(self, db_path, entry):
+        stat = os.stat(db_path)
+        data_version = entry['conn'].execute("PRAGMA data_version").fetchone()[0]
+        return stat.st_mtime_ns, stat.st_size, data_version
+
+    def _introspect(self, conn):
         c = conn.cursor()
+        # Skip SQLite's internal tables such as sqlite_stat1, which ANALYZE creates
+        c.execute("SELECT name FROM sqlite_master WHERE type='table' AND substr(name, 1, 7) != 'sqlite_'")
+        info = {}
+        for (table_name,) in c.fetchall():
+            c.execute(f"PRAGMA table_info({_quote_identifier(table_name)})")
+            table_columns = c.fetchall()
+            c.execute(f"PRAGMA foreign_key_list({_quote_identifier(table_name)})")
+            # (column, referenced table, referenced column); the latter is None for the primary key
+            foreign_keys = [(fk[3], fk[2], fk[4]) for fk in c.fetchall()]
+            row_count, exact = _estimate_row_count(conn, table_name)
+            info[table_name] = {'columns': [col[1] for col in table_columns],
+                                'types': [col[2] for col in table_columns],
+                                'foreign_keys': foreign_keys,
+                                'row_count': row_count, 'row_count_exact': exact}
+        return info
+
+    def get(self, db_path):
+        with self._lock:
+            entry = self._entries.get(db_path)
+            if entry is not None:
+                try:
+                    if self._stamp(db_path, entry) == entry['stamp']:
+                        self._entries.move_to_end(db_path)
+                        self.hits += 1
+                        return entry['info']
+                except (OSError, sqlite3.Error):
+                    pass
+                self._drop(db_path)
+            self.misses += 1
         
-        # Get all tables
-        c.execute("SELECT name FROM sqlite_master WHERE type='table';")
-        tables = c.fetchall()
-        
-        table_info = {}
-        for table in tables:
-            table_name = table[0]
-            c.execute(f"PRAGMA table_info({table_name})")
-            columns = c.fetchall()
-            c.execute(f"SELECT COUNT(*) FROM {table_name}")
-            row_count = c.fetchone()[0]
-            
-            table_info[table_name] = {
-                'columns': [col[1] for col in columns],
-                'row_count': row_count
-            }
-        
-        conn.close()
-        return table_info
+        # Introspect without the lock, so a miss doesn't hold up lookups of other databases
+        os.stat(db_path)  # Never create an empty database for a missing file
+        conn = sqlite3.connect(Path(db_path).resolve().as_uri() + '?mode=ro', uri=True, check_same_thread=False)
+        entry = {'conn': conn}
+        try:
+            # Stamp first: a write during introspection then fails the next validation
+            entry['stamp'] = self._stamp(db_path, entry)
+            entry['info'] = self._introspect(conn)
+        except Exception:
+            conn.close()
+            raise
+        with self._lock:
+            current = self._entries.get(db_path)
+            if current is not None:
+                # Another thread filled the entry in meanwhile; keep the one already shared
+                conn.close()
+                return current['info']
+            self._entries[db_path] = entry
+            while len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))
         
+        for table_name, table in entry['info'].items():
+            if not table['row_count_exact']:
+                self._counter.submit(self._refresh_count, db_path, entry, table_name)
+        return entry['info']
+
+    def samples(self, db_path, table_name, rows=50, per_column=3):
+        """A few distinct non-empty values per column from the first rows of a table"""
+        try:
+            self.get(db_path)
+        except (OSError, sqlite3.Error):
+            return {}
+        with self._lock:
+            entry = self._entries.get(db_path)
+            if entry is None:
+                return {}
+            cached = entry.setdefault('samples', {}).get(table_name)
+            if cached is not None:
+                return cached
+            try:
+                cursor = entry['conn'].execute(f"SELECT * FROM {_quote_identifier(table_name)} LIMIT {rows}")
+                table_rows = cursor.fetchall()
+            except sqlite3.Error as e:
+                logger.warning(f"Sampling {table_name} failed: {e}")
+                return {}
+            names = [d[0] for d in cursor.description]
+            values = {name: [] for name in names}
+            for row in table_rows:
+                for name, value in zip(names, row):
+                    if value not in (None, '') and value not in values[name] and len(values[name]) < per_column:
+                        values[name].append(value)
+            entry['samples'][table_name] = values
+            return values
+
+    def _refresh_count(self, db_path, entry, table_name):
+        try:
+            count = _count_rows_exact(db_path, table_name)
+        except sqlite3.Error as e:
+            logger.warning(f"Exact row count failed for {table_name}: {e}")
+            return
+        with self._lock:
+            # Only update if the entry is still the current one for this file
+            if self._entries.get(db_path) is entry:
+                entry['info'][table_name]['row_count'] = count
+                entry['info'][table_name]['row_count_exact'] = True
+
+    def _drop(self, db_path):
+        entry = self._entries.pop(db_path, None)
+        if entry is not None:
+            entry['conn'].close()
+
+    def invalidate(self, db_path):
+        with self._lock:
+            self._drop(db_path)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0
+        }
+
+SCHEMA_CACHE = SchemaCache()
+
+def get_database_info(db_path):
+    """Get information about the database including table names and structure.
+
+    Results come from SCHEMA_CACHE and must be treated as read-only.
+    """
+    try:
+        with METRICS.timer('schema'):
+            return SCHEMA_CACHE.get(db_path)
     except Exception as e:
         logger.error(f"Error getting database info: {e}")
         return {}
 
+def get_table_columns(db_path, table_name):
+    """Column names of a table, served from the schema cache"""
+    table = get_database_info(db_path).get(table_name)
+    return table['columns'] if table else []
+
 def detect_main_table(table_info):
     """Detect the main table to use for queries"""
     if not table_info:
@@ -268,8 +858,992 @@ def detect_main_table(table_info):
     # Fallback to first table
     return list(table_info.keys())[0] if table_info else None
 
+INGEST_EXECUTOR = ThreadPoolExecutor(max_workers=INGEST_WORKERS, thread_name_prefix='ingest')
+
+def _quote_identifier(name):
+    return '"' + str(name).replace('"', '""') + '"'
+
+def sqlite_column_type(dtype):
+    """Map a pandas dtype to the SQLite type affinity used for ingestion"""
+    if pd.api.types.is_bool_dtype(dtype) or pd.api.types.is_integer_dtype(dtype):
+        return 'INTEGER'
+    if pd.api.types.is_float_dtype(dtype):
+        return 'REAL'
+    return 'TEXT'
+
+def _apply_ingest_pragmas(conn):
+    # The target is a fresh file built from the upload, so durability can wait until the end
+    conn.execute("PRAGMA journal_mode=OFF")
+    conn.execute("PRAGMA synchronous=OFF")
+    conn.execute("PRAGMA locking_mode=EXCLUSIVE")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-65536")
+
+def _restore_default_pragmas(conn):
+    conn.execute("PRAGMA journal_mode=DELETE")
+    conn.execute("PRAGMA synchronous=FULL")
+    conn.execute("PRAGMA locking_mode=NORMAL")
+    # The exclusive lock is only released by the next access after leaving EXCLUSIVE mode
+    conn.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchall()
+
+def _chunk_records(chunk):
+    """Rows of a DataFrame chunk as tuples of Python scalars, NaN as NULL"""
+    values = []
+    for col in chunk.columns:
+        series = chunk[col]
+        if pd.api.types.is_datetime64_any_dtype(series.dtype):
+            series = series.dt.strftime('%Y-%m-%d %H:%M:%S')
+        if series.hasnans:
+            series = series.astype(object).where(series.notna(), None)
+        values.append(series.tolist())
+    return zip(*values)
+
+def _create_ingest_table(conn, table_name, sample):
+    """(Re)create a table typed from a sample frame and return its INSERT statement"""
+    column_defs = ", ".join(f"{_quote_identifier(col)} {sqlite_column_type(sample[col].dtype)}"
+                            for col in sample.columns)
+    conn.execute(f"DROP TABLE IF EXISTS {_quote_identifier(table_name)}")
+    conn.execute(f"CREATE TABLE {_quote_identifier(table_name)} ({column_defs})")
+    placeholders = ", ".join("?" for _ in sample.columns)
+    return f"INSERT INTO {_quote_identifier(table_name)} VALUES ({placeholders})"
+
+def ingest_csv(csv_path, db_path, table_name, chunk_rows=INGEST_CHUNK_ROWS,
+               sample_rows=INGEST_SAMPLE_ROWS, progress=None, profiler=None):
+    """Load a CSV into a SQLite table in bounded-memory chunks.
+
+    Column types are inferred from the first sample_rows rows, then the file
+    is streamed through executemany inside a single transaction. progress,
+    if given, is called with (rows_loaded, fraction_of_file_read) after each
+    chunk, and profiler, a ColumnProfiler, sees every chunk. Returns the
+    number of rows loaded.
+    """
+    sample = pd.read_csv(csv_path, nrows=sample_rows)
+    total_bytes = os.path.getsize(csv_path) or 1
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    row_count = 0
+    try:
+        _apply_ingest_pragmas(conn)
+        conn.execute("BEGIN")
+        insert_sql = _create_ingest_table(conn, table_name, sample)
+        del sample
+        with open(csv_path, 'rb') as f:
+            for chunk in pd.read_csv(f, chunksize=chunk_rows):
+                conn.executemany(insert_sql, _chunk_records(chunk))
+                if profiler:
+                    profiler.update(chunk)
+                row_count += len(chunk)
+                if progress:
+                    progress(row_count, min(f.tell() / total_bytes, 1.0))
+        conn.execute("COMMIT")
+        _restore_default_pragmas(conn)
+    except Exception:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+    return row_count
+
+def write_frame_to_sqlite(db_path, table_name, df, chunk_rows=INGEST_CHUNK_ROWS, profiler=None):
+    """Write an already parsed DataFrame into its own table using the ingest fast path"""
+    # Excel cells can hold times, decimals and other values sqlite3 cannot bind
+    for col in df.columns:
+        if df[col].dtype == object:
+            df[col] = df[col].map(lambda v: v if v is None or isinstance(v, (int, float, str, bytes)) else str(v))
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    try:
+        _apply_ingest_pragmas(conn)
+        conn.execute("BEGIN")
+        insert_sql = _create_ingest_table(conn, table_name, df)
+        for start in range(0, len(df), chunk_rows):
+            chunk = df.iloc[start:start + chunk_rows]
+            conn.executemany(insert_sql, _chunk_records(chunk))
+            if profiler:
+                profiler.update(chunk)
+        conn.execute("COMMIT")
+        _restore_default_pragmas(conn)
+    except Exception:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+    return len(df)
+
+class ColumnProfiler:
+    """Per-column statistics accumulated chunk by chunk during ingest.
+
+    Each chunk is processed with vectorized pandas operations: null counts,
+    min/max/sum and exact value counts. Once a column has more than
+    tracked_values distinct values, its top values are frozen and the
+    distinct count is estimated from a k-minimum-values sketch of value
+    hashes instead.
+    """
+    SKETCH_SIZE = 1024
+    TOP_K = 10
+
+    def __init__(self, tracked_values=PROFILE_TRACKED_VALUES):
+        self.tracked_values = tracked_values
+        self.rows = 0
+        self.columns = {}
+
+    def update(self, chunk):
+        self.rows += len(chunk)
+        for name in chunk.columns:
+            series = chunk[name]
+            column = self.columns.get(name)
+            if column is None:
+                column = self.columns[name] = {
+                    'numeric': True, 'count': 0, 'nulls': 0, 'sum': 0.0, 'min': None, 'max': None,
+                    'counts': pd.Series(dtype='int64'), 'overflow': False, 'sketch': np.array([], dtype='uint64')
+                }
+            values = series.dropna()
+            column['nulls'] += len(series) - len(values)
+            column['count'] += len(values)
+            if values.empty:
+                continue
+            
+            numeric = pd.api.types.is_numeric_dtype(values) and not pd.api.types.is_bool_dtype(values)
+            if column['numeric'] and not numeric:
+                # Text turned up: from here on the column is profiled as text
+                column['numeric'] = False
+                column['min'] = column['max'] = None
+            if column['numeric']:
+                column['sum'] += float(values.sum())
+            else:
+                values = values.astype(str)
+            low, high = self._plain(values.min()), self._plain(values.max())
+            if column['min'] is None:
+                column['min'], column['max'] = low, high
+            else:
+                column['min'], column['max'] = min(column['min'], low), max(column['max'], high)
+            
+            if not column['overflow']:
+                counts = column['counts'].add(values.value_counts(), fill_value=0)
+                if len(counts) <= self.tracked_values:
+                    column['counts'] = counts
+                    continue
+                # Too many values to count exactly: keep the top values seen so far and
+                # switch to the distinct sketch, seeded with every value seen up to here
+                column['overflow'] = True
+                column['counts'] = counts.nlargest(self.tracked_values)
+                values = counts.index.to_series()
+            hashes = pd.util.hash_array(values.to_numpy())
+            sketch = column['sketch']
+            if len(sketch) == self.SKETCH_SIZE:
+                hashes = hashes[hashes < sketch[-1]]  # Only hashes that can enter the sketch
+            column['sketch'] = np.unique(np.concatenate([sketch, hashes]))[:self.SKETCH_SIZE]
+
+    @staticmethod
+    def _plain(value):
+        return value.item() if hasattr(value, 'item') else value
+
+    def result(self):
+        columns = {}
+        for name, column in self.columns.items():
+            sketch = column['sketch']
+            if not column['overflow']:
+                distinct = len(column['counts'])
+            elif len(sketch) < self.SKETCH_SIZE:
+                distinct = len(sketch)
+            else:
+                # k-minimum-values estimate from the k-th smallest 64-bit hash
+                distinct = int((self.SKETCH_SIZE - 1) * 2.0**64 / float(sketch[-1]))
+            top = column['counts'].nlargest(self.TOP_K)
+            profile = {
+                'type': 'numeric' if column['numeric'] and column['count'] else 'text',
+                'count': column['count'],
+                'nulls': column['nulls'],
+                'distinct': distinct,
+                'distinct_exact': not column['overflow'],
+                'top_exact': not column['overflow'],
+                'min': column['min'],
+                'max': column['max'],
+                'top': [[self._plain(value), int(n)] for value, n in top.items()]
+            }
+            if profile['type'] == 'numeric':
+                profile['mean'] = column['sum'] / column['count']
+            columns[str(name)] = profile
+        return {'rows': self.rows, 'columns': columns}
+
+def profile_path(db_path):
+    return f"{db_path}.profile.json"
+
+def save_table_profile(db_path, table_name, profile):
+    """Store a table profile in the database's profile file"""
+    path = profile_path(db_path)
+    profiles = dict(load_profiles(db_path))
+    profiles[table_name] = profile
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(profiles, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+def save_profiler_result(db_path, table_name, profiler):
+    """Summarize a ColumnProfiler and store the profile; blocking, run it in INGEST_EXECUTOR"""
+    save_table_profile(db_path, table_name, profiler.result())
+
+@lru_cache(maxsize=256)
+def _read_profiles(path, mtime_ns):
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+def load_profiles(db_path):
+    """All table profiles of a database, or {} if it was never profiled.
+
+    The result is cached and must be treated as read-only.
+    """
+    path = profile_path(db_path)
+    try:
+        return _read_profiles(path, os.stat(path).st_mtime_ns)
+    except (OSError, ValueError):
+        return {}
+
+def get_table_profile(db_path, table_name):
+    """The profile of a table, or None if missing or out of date"""
+    profile = load_profiles(db_path).get(table_name)
+    if profile is None:
+        return None
+    info = get_database_info(db_path).get(table_name)
+    # Rows added after the upload make the profile stale
+    if not info or info['row_count'] != profile['rows']:
+        return None
+    return profile
+
+def _hint_value(value):
+    text = str(value)
+    return repr(text[:30]) if isinstance(value, str) else text
+
+def profile_hint(column):
+    """Short description of a profiled column's values for the schema prompt, or None"""
+    if column['type'] == 'numeric':
+        hint = f"{column['min']:g} to {column['max']:g}"
+    elif not column['top']:
+        return "always empty" if column['nulls'] else None
+    elif column['distinct_exact'] and column['distinct'] <= len(column['top']):
+        hint = f"one of {', '.join(_hint_value(v) for v, _ in column['top'])}"
+    else:
+        hint = f"e.g. {', '.join(_hint_value(v) for v, _ in column['top'][:2])}"
+    if column['nulls']:
+        hint += f" ({column['nulls']} empty)"
+    return hint
+
+_PROFILE_PREFIX = (r"(?:(?:what is|what's|show|show me|find|get|calculate|give me|tell me|"
+                   r"какая|какой|каково|покажи|найди|посчитай|вычисли)\s+)?(?:the\s+)?")
+_PROFILE_QUESTIONS = [
+    ('avg', re.compile(_PROFILE_PREFIX + r"(?:average|mean|avg|средн\w*)\s+(?:value\s+of\s+|of\s+)?(?:the\s+)?(.+)")),
+    ('max', re.compile(_PROFILE_PREFIX + r"(?:max|maximum|highest|largest|максимальн\w*|наибольш\w*)\s+"
+                       r"(?:value\s+of\s+|of\s+)?(?:the\s+)?(.+)")),
+    ('min', re.compile(_PROFILE_PREFIX + r"(?:min|minimum|lowest|smallest|минимальн\w*|наименьш\w*)\s+"
+                       r"(?:value\s+of\s+|of\s+)?(?:the\s+)?(.+)")),
+    ('count', re.compile(r"(?:how many|number of|count of|count|сколько)\s+(?:different\s+|distinct\s+|unique\s+|"
+                         r"разных\s+|уникальных\s+)?(.+?)(?:\s+(?:are there|there are|do we have|есть|всего))?")),
+]
+_ROW_WORDS = {'rows', 'records', 'entries', 'lines', 'строк', 'записей', 'строки', 'записи'}
+
+# Russian words for common column names, tried when a word doesn't name a column itself
+_COLUMN_LEXICON = [(re.compile(pattern + r'$'), names) for pattern, names in [
+    (r'зарплат\w*|заработн\w*|оклад\w*|зп', ('salary', 'wage', 'pay')),
+    (r'сотрудник\w*|работник\w*|персонал\w*', ('employees', 'employee', 'staff')),
+    (r'отдел\w*|департамент\w*|подразделени\w*', ('department', 'dept', 'division')),
+    (r'должност\w*|позици\w*', ('position', 'title', 'job_title', 'role')),
+    (r'возраст\w*', ('age',)),
+    (r'имя|имени|имена|имен\w*', ('name', 'first_name', 'full_name')),
+    (r'фамили\w*', ('last_name', 'surname')),
+    (r'город\w*', ('city',)),
+    (r'стран\w*', ('country',)),
+    (r'регион\w*', ('region',)),
+    (r'дат\w*', ('date',)),
+    (r'год|года|году|годам|лет', ('year',)),
+    (r'месяц\w*', ('month',)),
+    (r'цен\w*|стоимост\w*', ('price', 'cost')),
+    (r'продаж\w*', ('sales',)),
+    (r'выручк\w*|доход\w*', ('revenue', 'income')),
+    (r'товар\w*|продукт\w*', ('product', 'products')),
+    (r'категори\w*', ('category',)),
+    (r'клиент\w*|покупател\w*', ('customer', 'client', 'customers')),
+    (r'заказ\w*', ('orders', 'order')),
+    (r'стаж\w*|опыт\w*', ('experience', 'years_experience')),
+    (r'пол', ('gender', 'sex')),
+    (r'почт\w*', ('email',)),
+    (r'телефон\w*', ('phone',)),
+    (r'статус\w*', ('status',)),
+    (r'рейтинг\w*', ('rating',)),
+    (r'оценк\w*|балл\w*', ('score', 'grade', 'rating')),
+    (r'бонус\w*|преми\w*', ('bonus',)),
+]]
+
+def _phrase_forms(phrase):
+    """Spellings a phrase may take as a column name: as is, singular, or via the Russian lexicon"""
+    key = re.sub(r'\s+', '_', phrase.strip().lower())
+    forms = [key]
+    for suffix, replacement in (('ies', 'y'), ('es', ''), ('s', '')):
+        if key.endswith(suffix):
+            forms.append(key[:-len(suffix)] + replacement)
+    if re.fullmatch('[а-яё]+', key):
+        for pattern, names in _COLUMN_LEXICON:
+            if pattern.match(key):
+                forms.extend(names)
+    return forms
+
+def resolve_column(phrase, columns):
+    """Match a phrase like 'departments', 'hire date' or 'зарплатой' to one of columns.
+
+    Russian column names are matched on their stem, so inflected forms
+    resolve too. Returns None when nothing or more than one column matches.
+    """
+    by_key = {}
+    for name in columns:
+        by_key.setdefault(re.sub(r'[\s_]+', '_', name.lower()), []).append(name)
+    for form in _phrase_forms(phrase):
+        if form in by_key:
+            matches = by_key[form]
+            return matches[0] if len(matches) == 1 else None
+    key = phrase.strip().lower()
+    if len(key) >= 4 and ' ' not in key and re.search('[а-яё]', key):
+        matches = [name for keyed, names in by_key.items() for name in names
+                   if len(keyed) >= 4 and len(os.path.commonprefix([keyed, key])) >= max(4, len(keyed) - 1)]
+        if len(matches) == 1:
+            return matches[0]
+    return None
+
+def _profile_column(phrase, profile):
+    """Match a phrase like 'departments' or 'hire date' to a profiled column"""
+    return resolve_column(phrase, profile['columns'])
+
+def _sql_literal(value):
+    if isinstance(value, str):
+        return "'" + value.replace("'", "''") + "'"
+    return repr(value)
+
+def answer_from_profile(question, table_name, profile):
+    """SQL returning the answer to a simple whole-table aggregate read from the profile.
+
+    Only full-question matches are answered ("average salary", "how many
+    departments"), so anything with a filter or grouping goes to the LLM.
+    Returns None when the profile can't answer exactly.
+    """
+    text = normalize_question(question)
+    for kind, pattern in _PROFILE_QUESTIONS:
+        match = pattern.fullmatch(text)
+        if not match:
+            continue
+        phrase = match.group(1)
+        if kind == 'count' and (phrase in _ROW_WORDS or phrase in (table_name.lower(), table_name.lower() + 's')):
+            return f'SELECT {profile["rows"]} AS "COUNT(*)"'
+        name = _profile_column(phrase, profile)
+        if name is None:
+            return None
+        column = profile['columns'][name]
+        if kind == 'count':
+            if not column['distinct_exact']:
+                return None
+            value, label = column['distinct'], f"COUNT(DISTINCT {name})"
+        elif column['type'] != 'numeric' or not column['count']:
+            return None
+        elif kind == 'avg':
+            value, label = column['mean'], f"AVG({name})"
+        else:
+            value, label = column[kind], f"{kind.upper()}({name})"
+        return f"SELECT {_sql_literal(value)} AS {_quote_identifier(label)}"
+    return None
+
+_EXCEL_POOL = None
+
+def get_excel_pool():
+    """Process pool for CPU-bound workbook parsing, created on first use"""
+    global _EXCEL_POOL
+    if _EXCEL_POOL is None:
+        _EXCEL_POOL = ProcessPoolExecutor(max_workers=EXCEL_WORKERS)
+    return _EXCEL_POOL
+
+def excel_engine():
+    """Fastest installed Excel engine, or None for the pandas default"""
+    try:
+        import python_calamine  # noqa: F401
+        return 'calamine'
+    except ImportError:
+        # pandas already opens .xlsx files with openpyxl in read-only mode
+        return None
+
+def list_excel_sheets(xls_path, engine=None):
+    with pd.ExcelFile(xls_path, engine=engine) as workbook:
+        return workbook.sheet_names
+
+def parse_excel_sheet(xls_path, sheet_name, engine=None):
+    """Parse a single worksheet (runs in a worker process)"""
+    return pd.read_excel(xls_path, sheet_name=sheet_name, engine=engine)
+
+def sanitize_table_name(name, default="data"):
+    return re.sub(r'[^a-zA-Z0-9_]', '_', name) or default
+
+async def ingest_excel(xls_path, db_path, base_table_name):
+    """Load every sheet of a workbook into its own table.
+
+    Sheets are parsed in parallel worker processes and written to SQLite one
+    at a time as they finish. Returns {table_name: row_count}.
+    """
+    loop = asyncio.get_running_loop()
+    engine = excel_engine()
+    sheets = await loop.run_in_executor(INGEST_EXECUTOR, list_excel_sheets, xls_path, engine)
+    
+    table_names = {}
+    for sheet in sheets:
+        # A single-sheet workbook keeps the plain file-based table name
+        name = base_table_name if len(sheets) == 1 else f"{base_table_name}_{sanitize_table_name(str(sheet))}"
+        while name in table_names.values():
+            name += "_"
+        table_names[sheet] = name
+    
+    pool = get_excel_pool()
+    
+    async def parse(sheet):
+        return sheet, await loop.run_in_executor(pool, parse_excel_sheet, xls_path, sheet, engine)
+    
+    tasks = [asyncio.ensure_future(parse(sheet)) for sheet in sheets]
+    counts = {}
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            sheet, df = await next_done
+            if df.columns.empty:
+                continue
+            table_name = table_names[sheet]
+            profiler = ColumnProfiler()
+            counts[table_name] = await loop.run_in_executor(
+                INGEST_EXECUTOR, partial(write_frame_to_sqlite, db_path, table_name, df, profiler=profiler)
+            )
+            await loop.run_in_executor(INGEST_EXECUTOR, save_profiler_result, db_path, table_name, profiler)
+    except Exception:
+        for task in tasks:
+            task.cancel()
+        raise
+    return counts
+
+def make_progress_reporter(message, lang_dict, loop, interval=INGEST_PROGRESS_INTERVAL):
+    """Progress callback for worker threads that edits a Telegram message"""
+    last_update = [time.monotonic()]
+    
+    def report(rows, fraction):
+        now = time.monotonic()
+        if now - last_update[0] < interval:
+            return
+        last_update[0] = now
+        text = lang_dict['ingest_progress'].format(rows, int(fraction * 100))
+        asyncio.run_coroutine_threadsafe(message.edit_text(text), loop)
+    
+    return report
+
+@lru_cache(maxsize=1)
+def columnar_available():
+    if COLUMNAR_ENGINE != 'duckdb':
+        return False
+    try:
+        import duckdb  # noqa: F401
+        import pyarrow  # noqa: F401
+    except ImportError:
+        logger.warning("duckdb or pyarrow is not installed, running all queries on SQLite")
+        return False
+    return True
+
+def columnar_path(db_path, table_name):
+    return f"{db_path}.{table_name}.parquet"
+
+def write_columnar_copy(db_path, table_name, chunk_rows=INGEST_CHUNK_ROWS):
+    """Write a table to Parquet next to its database for the columnar engine.
+
+    Column types follow the declared SQLite types. If a value doesn't fit its
+    column type no copy is written, and the table stays on SQLite. Returns
+    the number of rows written, or None.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    
+    path = columnar_path(db_path, table_name)
+    tmp_path = path + '.tmp'
+    arrow_types = {'INTEGER': pa.int64(), 'REAL': pa.float64()}
+    conn = sqlite3.connect(db_path)
+    writer = None
+    rows_written = 0
+    try:
+        c = conn.cursor()
+        columns = c.execute(f"PRAGMA table_info({_quote_identifier(table_name)})").fetchall()
+        schema = pa.schema([(col[1], arrow_types.get(col[2].upper(), pa.string())) for col in columns])
+        writer = pq.ParquetWriter(tmp_path, schema)
+        c.execute(f"SELECT * FROM {_quote_identifier(table_name)}")
+        while True:
+            rows = c.fetchmany(chunk_rows)
+            if not rows:
+                break
+            arrays = [pa.array(values, type=field.type) for values, field in zip(zip(*rows), schema)]
+            writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=schema))
+            rows_written += len(rows)
+        writer.close()
+        writer = None
+        os.replace(tmp_path, path)
+        return rows_written
+    except (pa.ArrowException, sqlite3.Error, OSError) as e:
+        logger.warning(f"No columnar copy of {table_name}: {e}")
+        return None
+    finally:
+        if writer is not None:
+            writer.close()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        conn.close()
+
+def schedule_columnar_copies(db_path, counts):
+    """Queue Parquet copies of freshly ingested large tables on the ingest pool"""
+    for table_name, count in counts.items():
+        path = columnar_path(db_path, table_name)
+        if os.path.exists(path):
+            os.remove(path)  # Never serve a copy of the table this upload replaced
+        if count >= COLUMNAR_MIN_ROWS and columnar_available():
+            INGEST_EXECUTOR.submit(write_columnar_copy, db_path, table_name)
+
+@lru_cache(maxsize=1024)
+def _parquet_row_count(path, mtime_ns):
+    import pyarrow.parquet as pq
+    return pq.read_metadata(path).num_rows
+
+_COLUMNAR_AGGREGATE = re.compile(r'\bGROUP\s+BY\b|\b(?:COUNT|SUM|AVG|MIN|MAX)\s*\(', re.IGNORECASE)
+# Constructs whose results differ between SQLite and DuckDB (case-insensitive LIKE, integer
+# division, date and string functions) or that involve more than one table stay on SQLite
+_COLUMNAR_UNSAFE = re.compile(r'\b(?:LIKE|GLOB|JOIN|UNION|INTERSECT|EXCEPT|ROWID|STRFTIME|DATE|TIME|DATETIME|'
+                              r'JULIANDAY|SUBSTR|INSTR|PRINTF|TYPEOF|TOTAL|GROUP_CONCAT)\b|/|\|\|', re.IGNORECASE)
+
+def columnar_route(db_path, sql_query):
+    """(table_name, parquet_path) if the query should run on the columnar copy, else None"""
+    if COLUMNAR_ENGINE != 'duckdb' or not _COLUMNAR_AGGREGATE.search(sql_query):
+        return None
+    sql = _SQL_STRING_LITERAL.sub("''", sql_query)
+    if _COLUMNAR_UNSAFE.search(sql) or len(re.findall(r'\bSELECT\b', sql, re.IGNORECASE)) != 1:
+        return None
+    # Without ORDER BY, SQLite's LIMIT picks the first groups in key order; DuckDB has no such order
+    if (re.search(r'\bLIMIT\b', sql, re.IGNORECASE) and re.search(r'\bGROUP\s+BY\b', sql, re.IGNORECASE)
+            and not re.search(r'\bORDER\s+BY\b', sql, re.IGNORECASE)):
+        return None
+    tables = set(query_table_aliases(sql).values())
+    if len(tables) != 1:
+        return None
+    table_name = tables.pop()
+    info = get_database_info(db_path).get(table_name)
+    if not info or info['row_count'] < COLUMNAR_MIN_ROWS:
+        return None
+    path = columnar_path(db_path, table_name)
+    try:
+        mtime_ns = os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+    if not columnar_available() or _parquet_row_count(path, mtime_ns) != info['row_count']:
+        return None  # Missing engine or a stale copy
+    return table_name, path
+
+_DUCKDB = None
+_DUCKDB_LOCK = threading.Lock()
+
+def _columnar_database():
+    global _DUCKDB
+    with _DUCKDB_LOCK:
+        if _DUCKDB is None:
+            import duckdb
+            _DUCKDB = duckdb.connect()
+            # SQLite sorts NULLs as the smallest value
+            _DUCKDB.execute("SET GLOBAL default_null_order = 'nulls_first_on_asc_last_on_desc'")
+        return _DUCKDB
+
+def run_columnar_query(parquet_path, table_name, sql_query, column_names=None, timeout=SQL_QUERY_TIMEOUT,
+                       handle=None):
+    """Run a SQLite-dialect aggregate over a Parquet copy in DuckDB.
+
+    Each query gets its own cursor with a temporary view named after the
+    table, so users with identically named tables never see each other's data.
+    """
+    import duckdb
+    
+    cursor = _columnar_database().cursor()
+    if handle is not None:
+        handle['conn'] = cursor  # interrupt() on cancellation, like a sqlite3 connection
+    deadline = time.monotonic() + timeout
+    timer = threading.Timer(timeout, cursor.interrupt)
+    timer.start()
+    try:
+        escaped_path = parquet_path.replace("'", "''")
+        cursor.execute(f"CREATE TEMP VIEW {_quote_identifier(table_name)} AS "
+                       f"SELECT * FROM read_parquet('{escaped_path}')")
+        sql = sql_query.strip().rstrip(';')
+        # SQLite returns groups in key order; keep it so tables and charts look the same
+        masked = _SQL_STRING_LITERAL.sub(lambda m: "'" + ' ' * (len(m.group()) - 2) + "'", sql)
+        group_by = re.search(r'\bGROUP\s+BY\b(.*?)(?=\bHAVING\b|$)', masked, re.IGNORECASE | re.DOTALL)
+        if group_by and not re.search(r'\bORDER\s+BY\b', masked, re.IGNORECASE):
+            sql = f"{sql} ORDER BY {sql[group_by.start(1):group_by.end(1)].strip()}"
+        cursor.execute(sql)
+        kinds = [str(d[1]) for d in cursor.description]
+        df = cursor.fetchdf()
+        # DuckDB sums integers into HUGEINT, which arrives as float; SQLite returns integers
+        for i, kind in enumerate(kinds):
+            if kind == 'HUGEINT' and df.iloc[:, i].notna().all():
+                df.isetitem(i, df.iloc[:, i].astype('int64'))
+        if column_names and len(column_names) == len(df.columns):
+            df.columns = column_names
+        return df
+    except duckdb.InterruptException as e:
+        if time.monotonic() >= deadline:
+            raise QueryTimeoutError(f"Query exceeded {timeout:g}s deadline") from e
+        raise QueryCancelledError("Query was cancelled") from e
+    finally:
+        timer.cancel()
+        cursor.close()
+
+class OpenRouterClient:
+    """Pooled asyncio HTTP client for the OpenRouter API.
+
+    Keeps keep-alive connections open between requests, so slow completions
+    never block the event loop. How many requests are in flight is decided by
+    LLM_SCHEDULER, which every call goes through.
+    """
+    def __init__(self, pool_size=OPENROUTER_POOL_SIZE,
+                 connect_timeout=OPENROUTER_CONNECT_TIMEOUT, read_timeout=OPENROUTER_READ_TIMEOUT):
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self._client = None
+        self._loop = None
+
+    def _ensure_client(self):
+        # The client is bound to the loop it was created on
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._loop is not loop:
+            self._client = httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=self.pool_size,
+                                    max_keepalive_connections=self.pool_size,
+                                    keepalive_expiry=60),
+                timeout=httpx.Timeout(self.read_timeout, connect=self.connect_timeout)
+            )
+            self._loop = loop
+        return self._client
+
+    async def post(self, url, headers, payload, stream=False):
+        """POST payload as JSON; with stream=True the body is left unread and the caller must aclose()"""
+        client = self._ensure_client()
+        request = client.build_request('POST', url, headers=headers, json=payload)
+        return await client.send(request, stream=stream)
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+            self._loop = None
+
+OPENROUTER_CLIENT = OpenRouterClient()
+
+class LLMScheduler:
+    """Fair admission of LLM requests across users.
+
+    Every user has a FIFO queue and free slots go round-robin over the users
+    with waiting requests, so one heavy user can't starve the rest. Dispatch
+    is held back by a sliding one-minute token budget and by the Retry-After
+    pause of a 429. Identical requests in flight share one upstream call.
+    """
+    def __init__(self, max_concurrency=OPENROUTER_MAX_CONCURRENCY, tokens_per_minute=LLM_TOKENS_PER_MINUTE):
+        self.max_concurrency = max_concurrency
+        self.tokens_per_minute = tokens_per_minute
+        self.dispatched = 0
+        self.coalesced = 0
+        self.rate_limited = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self._loop = None
+        self._reset()
+
+    def _reset(self):
+        self._queues = OrderedDict()  # user -> deque of waiting tickets, in round-robin order
+        self._running = 0
+        self._usage = deque()  # [time, tokens] charged in the last minute
+        self._paused_until = 0.0
+        self._wakeup = None
+        self._inflight = {}
+        self._service_time = 2.0  # moving average of seconds per request, for wait estimates
+
+    def _bind(self):
+        # Futures and timers belong to the loop they were created on
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._reset()
+            self._loop = loop
+
+    def _budget_wait(self, tokens, now):
+        """Seconds until tokens fit in the per-minute budget"""
+        while self._usage and self._usage[0][0] <= now - 60:
+            self._usage.popleft()
+        used = sum(t for _, t in self._usage)
+        if not self.tokens_per_minute or not self._usage or used + tokens <= self.tokens_per_minute:
+            return 0
+        for stamp, t in self._usage:
+            used -= t
+            if used + tokens <= self.tokens_per_minute:
+                return stamp + 60 - now
+        return 60
+
+    def _dispatch(self):
+        now = time.monotonic()
+        delay = 0
+        while self._running < self.max_concurrency and self._queues:
+            if now < self._paused_until:
+                delay = self._paused_until - now
+                break
+            user_id, queue = next(iter(self._queues.items()))
+            ticket = queue[0]
+            delay = self._budget_wait(ticket['tokens'], now)
+            if delay:
+                break
+            queue.popleft()
+            if queue:
+                self._queues.move_to_end(user_id)
+            else:
+                del self._queues[user_id]
+            ticket['usage'] = [now, ticket['tokens']]
+            ticket['started'] = now
+            self._usage.append(ticket['usage'])
+            self._running += 1
+            self.dispatched += 1
+            ticket['future'].set_result(None)
+        if delay and self._wakeup is None:
+            self._wakeup = self._loop.call_later(delay, self._wake)
+
+    def _wake(self):
+        self._wakeup = None
+        self._dispatch()
+
+    def position(self, user_id, ticket):
+        """Place in line and estimated wait in seconds of a queued ticket"""
+        mine = self._queues[user_id].index(ticket) + 1
+        ahead = mine - 1 + sum(min(len(q), mine) for u, q in self._queues.items() if u != user_id)
+        pause = max(self._paused_until - time.monotonic(), 0)
+        return ahead + 1, pause + (ahead // self.max_concurrency + 1) * self._service_time
+
+    async def acquire(self, user_id, tokens, on_queued=None):
+        """Wait for a slot; returns the ticket to hand back to release().
+
+        on_queued(position, wait_seconds) is awaited once if the request
+        can't start right away.
+        """
+        self._bind()
+        ticket = {'tokens': tokens, 'future': self._loop.create_future(), 'queued': time.perf_counter()}
+        self._queues.setdefault(user_id, deque()).append(ticket)
+        self._dispatch()
+        try:
+            if not ticket['future'].done() and on_queued:
+                try:
+                    await on_queued(*self.position(user_id, ticket))
+                except Exception as e:
+                    logger.error(f"Error reporting LLM queue position: {e}")
+            await ticket['future']
+        except asyncio.CancelledError:
+            if ticket['future'].done() and not ticket['future'].cancelled():
+                self.release(ticket)
+            elif ticket in self._queues.get(user_id, ()):
+                self._queues[user_id].remove(ticket)
+                if not self._queues[user_id]:
+                    del self._queues[user_id]
+            raise
+        METRICS.observe('llm_queue', time.perf_counter() - ticket['queued'])
+        return ticket
+
+    def release(self, ticket, usage=None):
+        """Free a slot, charging the tokens actually used when known"""
+        self._running -= 1
+        if usage is not None:
+            ticket['usage'][1] = usage['prompt_tokens'] + usage['completion_tokens']
+            self.prompt_tokens += usage['prompt_tokens']
+            self.completion_tokens += usage['completion_tokens']
+        self._service_time = 0.8 * self._service_time + 0.2 * (time.monotonic() - ticket['started'])
+        self._dispatch()
+
+    def backoff(self, seconds):
+        """Hold all dispatch for seconds after a 429"""
+        self.rate_limited += 1
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def single_flight(self, key, call):
+        """Await call() once for all concurrent callers with the same key"""
+        self._bind()
+        while key in self._inflight:
+            future = self._inflight[key]
+            self.coalesced += 1
+            await asyncio.wait([future])
+            # A cancelled leader leaves the call to the next caller in line
+            if not future.cancelled():
+                return future.result()
+        future = self._inflight[key] = self._loop.create_future()
+        try:
+            result = await call()
+        except BaseException:
+            future.cancel()
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            if self._inflight.get(key) is future:
+                del self._inflight[key]
+
+    def stats(self):
+        return {
+            'dispatched': self.dispatched,
+            'coalesced': self.coalesced,
+            'rate_limited': self.rate_limited,
+            'prompt_tokens': self.prompt_tokens,
+            'completion_tokens': self.completion_tokens,
+            'queued': sum(len(q) for q in self._queues.values()),
+            'window_tokens': sum(t for _, t in self._usage),
+        }
+
+LLM_SCHEDULER = LLMScheduler()
+
+def retry_after_seconds(response, attempt):
+    """Delay requested by a 429's Retry-After header, or exponential backoff"""
+    value = response.headers.get('Retry-After')
+    try:
+        delay = float(value)
+    except (TypeError, ValueError):
+        try:
+            delay = (email.utils.parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds()
+        except (TypeError, ValueError):
+            delay = 2 ** attempt
+    return min(max(delay, 0), LLM_MAX_BACKOFF)
+
+_SQL_START = re.compile(r'```[ \t]*(?:sqlite|sql)?[ \t]*\n?|\b(?:SELECT|WITH)\b', re.IGNORECASE)
+
+def complete_sql_statement(text):
+    """The first complete SQL statement in a partial LLM answer, or None while it may still grow.
+
+    A statement ends at a semicolon outside quotes and comments, or at the
+    closing markdown fence when the answer opened one.
+    """
+    start = _SQL_START.search(text)
+    if not start:
+        return None
+    fenced = start.group().startswith('```')
+    begin = i = start.end() if fenced else start.start()
+    quote = None
+    while i < len(text):
+        if quote:
+            if text[i] == quote:
+                quote = None
+        elif text.startswith('```', i):
+            if not fenced:
+                # Prose mentioning SELECT came before the fenced answer
+                return complete_sql_statement(text[i:])
+            return text[begin:i].strip()
+        elif text[i] in '\'"`':
+            quote = text[i]
+        elif text.startswith('--', i) or text.startswith('/*', i):
+            terminator = '\n' if text[i] == '-' else '*/'
+            end = text.find(terminator, i + 2)
+            if end < 0:
+                return None
+            i = end + len(terminator)
+            continue
+        elif text[i] == ';':
+            return text[begin:i].strip()
+        i += 1
+    return None
+
+async def _read_sql_stream(response):
+    """Read server-sent completion chunks until the first SQL statement is complete.
+
+    Returns (text, usage); usage is only reported when the stream runs to
+    its end. Leaving early and closing the response cancels the generation.
+    """
+    text = ''
+    usage = {}
+    async for line in response.aiter_lines():
+        # Skip blank separators and ": OPENROUTER PROCESSING" keep-alive comments
+        if not line.startswith('data:'):
+            continue
+        data = line[5:].strip()
+        if data == '[DONE]':
+            break
+        chunk = json.loads(data)
+        if 'error' in chunk:
+            raise ValueError(f"stream error: {chunk['error']}")
+        usage = chunk.get('usage') or usage
+        delta = ((chunk.get('choices') or [{}])[0].get('delta') or {}).get('content') or ''
+        text += delta
+        if ';' in delta or '`' in delta:
+            sql = complete_sql_statement(text)
+            if sql:
+                return sql, usage
+    return text, usage
+
+async def _post_completion(headers, payload, user_id, on_queued):
+    """(completion text, token usage) for one request, or (None, None) on failure"""
+    # Rough prompt size plus the completion cap, corrected from usage once answered
+    prompt_estimate = estimate_tokens(payload['messages'][0]['content'])
+    estimate = prompt_estimate + payload['max_tokens']
+    try:
+        for attempt in range(LLM_MAX_RETRIES + 1):
+            ticket = await LLM_SCHEDULER.acquire(user_id, estimate, on_queued if attempt == 0 else None)
+            used = None
+            try:
+                with METRICS.timer('llm'):
+                    response = await OPENROUTER_CLIENT.post(OPENROUTER_API_URL, headers, payload,
+                                                            stream=payload.get('stream', False))
+                    try:
+                        if response.status_code == 429:
+                            used = {'prompt_tokens': 0, 'completion_tokens': 0}
+                            delay = retry_after_seconds(response, attempt)
+                            LLM_SCHEDULER.backoff(delay)
+                            if attempt < LLM_MAX_RETRIES:
+                                logger.warning(f"OpenRouter API: Rate limited, retrying in {delay:.1f}s")
+                                continue
+                        response.raise_for_status()
+                        if payload.get('stream'):
+                            content, reported = await _read_sql_stream(response)
+                        else:
+                            result = response.json()
+                            content = result['choices'][0]['message']['content']
+                            reported = result.get('usage') or {}
+                    finally:
+                        await response.aclose()
+                    used = {'prompt_tokens': reported.get('prompt_tokens', prompt_estimate),
+                            'completion_tokens': reported.get('completion_tokens', estimate_tokens(content or ''))}
+                    logger.info(f"OpenRouter request for user {user_id}: {used['prompt_tokens']} prompt, "
+                                f"{used['completion_tokens']} completion tokens")
+                    return content, used
+            finally:
+                LLM_SCHEDULER.release(ticket, used)
+    except httpx.HTTPStatusError as e:
+        if e.response.status_code == 400:
+            logger.error("OpenRouter API: Bad Request - Prompt might be too long or malformed")
+        elif e.response.status_code == 401:
+            logger.error("OpenRouter API: Unauthorized - Check your API key")
+        elif e.response.status_code == 429:
+            logger.error("OpenRouter API: Rate limit exceeded")
+        else:
+            logger.error(f"OpenRouter API HTTP Error: {e}")
+        return None, None
+    except httpx.TimeoutException as e:
+        logger.error(f"OpenRouter API Timeout: {e!r}")
+        return None, None
+    except httpx.HTTPError as e:
+        logger.error(f"OpenRouter API Request Error: {e}")
+        return None, None
+    except Exception as e:
+        logger.error(f"OpenRouter API Unexpected Error: {e}")
+        return None, None
+
 # Enhanced OpenRouter API call function with better error handling
-def call_openrouter(prompt, model="google/gemini-pro", max_tokens=1000, temperature=0.1):
+async def call_openrouter(prompt, model=OPENROUTER_MODEL, max_tokens=1000, temperature=0.1, user_id=None,
+                          on_queued=None, usage=None, stop_at_sql=False):
+    """Completion text for prompt, or None on failure.
+
+    Requests go through LLM_SCHEDULER under user_id; on_queued is passed
+    on to LLMScheduler.acquire. A usage dict, if given, receives the
+    request's prompt_tokens and completion_tokens. With stop_at_sql and
+    LLM_STREAM the answer is streamed and only its first SQL statement is
+    returned, as soon as it is complete.
+    """
     # Check if API key is set
     if not OPENROUTER_API_KEY:
         logger.error("OpenRouter API key not configured properly")
@@ -288,32 +1862,761 @@ def call_openrouter(prompt, model="google/gemini-pro", max_tokens=1000, temperat
         "max_tokens": max_tokens,
         "temperature": temperature
     }
+    if stop_at_sql and LLM_STREAM:
+        payload["stream"] = True
     
-    try:
-        response = requests.post(OPENROUTER_API_URL, headers=headers, json=payload, timeout=30)
-        response.raise_for_status()
-        result = response.json()
-        return result['choices'][0]['message']['content']
-    except requests.exceptions.HTTPError as e:
-        if response.status_code == 400:
-            logger.error("OpenRouter API: Bad Request - Prompt might be too long or malformed")
-        elif response.status_code == 401:
-            logger.error("OpenRouter API: Unauthorized - Check your API key")
-        elif response.status_code == 429:
-            logger.error("OpenRouter API: Rate limit exceeded")
+    content, used = await LLM_SCHEDULER.single_flight(
+        (model, prompt, max_tokens, temperature, payload.get("stream", False)),
+        partial(_post_completion, headers, payload, user_id, on_queued))
+    if usage is not None and used:
+        usage.update(used)
+    return content
+
+def normalize_question(text):
+    """Normalize a natural-language question for cache lookups"""
+    text = re.sub(r'\s+', ' ', text.lower()).strip()
+    return text.rstrip('?!. ')
+
+def schema_fingerprint(table_name, columns):
+    """Stable fingerprint of a table schema built from table and column names"""
+    raw = json.dumps([table_name, list(columns)], ensure_ascii=False)
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+class TranslationCache:
+    """SQLite-backed NL-to-SQL cache with LRU and TTL eviction.
+
+    Every lookup touches last_used and commits, so handlers go through arun()
+    to keep that disk I/O on the cache's worker thread, off the event loop.
+    """
+    def __init__(self, db_path=TRANSLATION_CACHE_DB, max_entries=TRANSLATION_CACHE_MAX_ENTRIES,
+                 ttl=TRANSLATION_CACHE_TTL):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._conn = None
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='translation-cache')
+
+    @staticmethod
+    def make_key(question, language, fingerprint, model):
+        raw = "\x1f".join([normalize_question(question), language, fingerprint, model])
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def _connection(self):
+        if self._conn is None:
+            conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute('''CREATE TABLE IF NOT EXISTS translation_cache
+                            (cache_key TEXT PRIMARY KEY, sql_query TEXT, query_type TEXT,
+                             created_at REAL, last_used REAL, hit_count INTEGER DEFAULT 0)''')
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_translation_cache_last_used ON translation_cache (last_used)")
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            try:
+                conn = self._connection()
+                row = conn.execute("SELECT sql_query, query_type, created_at FROM translation_cache WHERE cache_key=?",
+                                   (key,)).fetchone()
+                if row and now - row[2] > self.ttl:
+                    conn.execute("DELETE FROM translation_cache WHERE cache_key=?", (key,))
+                    conn.commit()
+                    self.evictions += 1
+                    row = None
+                if not row:
+                    self.misses += 1
+                    return None
+                conn.execute("UPDATE translation_cache SET last_used=?, hit_count=hit_count+1 WHERE cache_key=?",
+                             (now, key))
+                conn.commit()
+                self.hits += 1
+                return row[0], row[1]
+            except sqlite3.Error as e:
+                logger.error(f"Translation cache lookup failed: {e}")
+                self.misses += 1
+                return None
+
+    def put(self, key, sql_query, query_type):
+        now = time.time()
+        with self._lock:
+            try:
+                conn = self._connection()
+                conn.execute("INSERT OR REPLACE INTO translation_cache (cache_key, sql_query, query_type, created_at, last_used) "
+                             "VALUES (?, ?, ?, ?, ?)", (key, sql_query, query_type, now, now))
+                # Drop expired entries, then the least recently used ones over the limit
+                cur = conn.execute("DELETE FROM translation_cache WHERE created_at < ?", (now - self.ttl,))
+                self.evictions += cur.rowcount
+                cur = conn.execute("DELETE FROM translation_cache WHERE cache_key IN "
+                                   "(SELECT cache_key FROM translation_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                                   (self.max_entries,))
+                self.evictions += cur.rowcount
+                conn.commit()
+            except sqlite3.Error as e:
+                logger.error(f"Translation cache store failed: {e}")
+
+    def discard(self, key):
+        with self._lock:
+            try:
+                conn = self._connection()
+                conn.execute("DELETE FROM translation_cache WHERE cache_key=?", (key,))
+                conn.commit()
+            except sqlite3.Error as e:
+                logger.error(f"Translation cache delete failed: {e}")
+
+    async def arun(self, method, *args):
+        """Run a cache method on the cache's worker thread"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, method, *args)
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+        self._executor.shutdown(wait=False)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / total if total else 0.0
+        }
+
+TRANSLATION_CACHE = TranslationCache()
+
+def translation_cache_key(query_text, language, table_name, columns=None, schema_info=None):
+    """Cache key for a question asked against a given table schema"""
+    fingerprint = schema_fingerprint(table_name, columns if columns is not None else [schema_info])
+    return TranslationCache.make_key(query_text, language, fingerprint, OPENROUTER_MODEL)
+
+@lru_cache(maxsize=256)
+def _question_token_pattern(columns):
+    """Regex matching quoted strings, numbers and column references in a question"""
+    alternatives = [
+        r"'(?P<s1>[^']+)'", r'"(?P<s2>[^"]+)"', r'«(?P<s3>[^»]+)»',
+        r'(?P<n>(?<![\w.])-?\d+(?:\.\d+)?(?![\w.]))'
+    ]
+    names = sorted({name for col in columns for name in (col.lower(), col.lower().replace('_', ' '))},
+                   key=len, reverse=True)
+    if names:
+        alternatives.append(r'(?P<c>(?<!\w)(?:' + '|'.join(re.escape(n) for n in names) + r')(?!\w))')
+    return re.compile('|'.join(alternatives), re.IGNORECASE)
+
+def question_shape(question, columns):
+    """Split a question into its shape and the literal/column slots it fills.
+
+    "employees with salary greater than 5000" becomes
+    ("employees with {c} greater than {n}", {'c': ['salary'], 'n': ['5000'], 's': []}).
+    """
+    text = re.sub(r'\s+', ' ', question).strip().rstrip('?!. ')
+    by_name = {}
+    for col in columns:
+        by_name[col.lower()] = col
+        by_name[col.lower().replace('_', ' ')] = col
+    
+    parts = []
+    slots = {'c': [], 'n': [], 's': []}
+    pos = 0
+    for match in _question_token_pattern(tuple(columns)).finditer(text):
+        parts.append(text[pos:match.start()].lower())
+        if match.group('c'):
+            kind, value = 'c', by_name[match.group('c').lower()]
+        elif match.group('n'):
+            kind, value = 'n', match.group('n')
         else:
-            logger.error(f"OpenRouter API HTTP Error: {e}")
+            kind, value = 's', match.group('s1') or match.group('s2') or match.group('s3')
+        parts.append('{' + kind + '}')
+        slots[kind].append(value)
+        pos = match.end()
+    parts.append(text[pos:].lower())
+    return ''.join(parts), slots
+
+def _sql_identifier(name):
+    return name if re.fullmatch(r'[A-Za-z_]\w*', name) else '"' + name.replace('"', '""') + '"'
+
+def extract_sql_template(sql_query, table_name, slots):
+    """Turn a concrete SQL answer into a template with {table}/{cN}/{nN}/{sN} slots.
+
+    Returns None unless every slot maps unambiguously onto the SQL.
+    """
+    values = slots['c'] + slots['n'] + slots['s']
+    if not values or len(set(values)) != len(values):
         return None
-    except requests.exceptions.RequestException as e:
-        logger.error(f"OpenRouter API Request Error: {e}")
+    
+    # Odd segments are string literals, even segments are SQL code
+    segments = re.split(r"('(?:[^']|'')*')", sql_query)
+    segments = [seg.replace('{', '{{').replace('}', '}}') for seg in segments]
+    
+    for i, value in enumerate(slots['s']):
+        literal = "'" + value.replace("'", "''") + "'"
+        positions = [j for j in range(1, len(segments), 2) if segments[j] == literal]
+        if len(positions) != 1:
+            return None
+        segments[positions[0]] = "'{s%d}'" % i
+    
+    replacements = [(r'"%s"|(?<![\w"])%s(?![\w"])' % (re.escape(table_name), re.escape(table_name)), '{table}', None)]
+    for i, col in enumerate(slots['c']):
+        replacements.append((r'"%s"|(?<![\w"])%s(?![\w"])' % (re.escape(col), re.escape(col)), '{c%d}' % i, 'c'))
+    for i, number in enumerate(slots['n']):
+        replacements.append((r'(?<![\w.])%s(?![\w.])' % re.escape(number), '{n%d}' % i, 'n'))
+    
+    for pattern, placeholder, kind in replacements:
+        regex = re.compile(pattern, re.IGNORECASE)
+        count = 0
+        for j in range(0, len(segments), 2):
+            segments[j], n = regex.subn(placeholder, segments[j])
+            count += n
+        # Columns may be referenced several times, numbers must map one-to-one
+        if (kind == 'c' and count == 0) or (kind == 'n' and count != 1):
+            return None
+    return ''.join(segments)
+
+def fill_sql_template(template, table_name, slots):
+    values = {'table': table_name}
+    for i, col in enumerate(slots['c']):
+        values['c%d' % i] = _sql_identifier(col)
+    for i, number in enumerate(slots['n']):
+        values['n%d' % i] = number
+    for i, literal in enumerate(slots['s']):
+        values['s%d' % i] = literal.replace("'", "''")
+    return template.format(**values)
+
+class QueryTemplateStore:
+    """Parameterized SQL templates learned from successful LLM answers.
+
+    Templates are keyed on (language, schema fingerprint, question shape), so
+    "average salary by department" teaches the bot "average salary by position".
+    Matches bump a hit count and commit, so handlers call through arun().
+    """
+    def __init__(self, db_path=TRANSLATION_CACHE_DB):
+        self.db_path = db_path
+        self.hits = 0
+        self.misses = 0
+        self.learned = 0
+        self._templates = None
+        self._conn = None
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='query-templates')
+
+    @staticmethod
+    def make_key(language, fingerprint, shape):
+        raw = "\x1f".join([language, fingerprint, shape])
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def _load(self):
+        if self._templates is None:
+            conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute('''CREATE TABLE IF NOT EXISTS query_templates
+                            (template_key TEXT PRIMARY KEY, language TEXT, shape TEXT, sql_template TEXT,
+                             created_at REAL, hit_count INTEGER DEFAULT 0)''')
+            conn.commit()
+            self._templates = dict(conn.execute("SELECT template_key, sql_template FROM query_templates"))
+            self._conn = conn
+        return self._templates
+
+    def learn(self, language, fingerprint, question, sql_query, table_name, columns):
+        shape, slots = question_shape(question, columns)
+        template = extract_sql_template(sql_query, table_name, slots)
+        if template is None:
+            return False
+        key = self.make_key(language, fingerprint, shape)
+        with self._lock:
+            try:
+                templates = self._load()
+                if templates.get(key) == template:
+                    return True
+                templates[key] = template
+                self._conn.execute("INSERT OR REPLACE INTO query_templates (template_key, language, shape, sql_template, created_at) "
+                                   "VALUES (?, ?, ?, ?, ?)", (key, language, shape, template, time.time()))
+                self._conn.commit()
+                self.learned += 1
+                return True
+            except sqlite3.Error as e:
+                logger.error(f"Query template store failed: {e}")
+                return False
+
+    def match(self, language, fingerprint, question, table_name, columns):
+        shape, slots = question_shape(question, columns)
+        key = self.make_key(language, fingerprint, shape)
+        with self._lock:
+            try:
+                template = self._load().get(key)
+                if template is None:
+                    self.misses += 1
+                    return None
+                self._conn.execute("UPDATE query_templates SET hit_count=hit_count+1 WHERE template_key=?", (key,))
+                self._conn.commit()
+            except sqlite3.Error as e:
+                logger.error(f"Query template lookup failed: {e}")
+                self.misses += 1
+                return None
+        self.hits += 1
+        return fill_sql_template(template, table_name, slots)
+
+    def discard(self, language, fingerprint, question, columns):
+        shape, _ = question_shape(question, columns)
+        key = self.make_key(language, fingerprint, shape)
+        with self._lock:
+            try:
+                self._load().pop(key, None)
+                self._conn.execute("DELETE FROM query_templates WHERE template_key=?", (key,))
+                self._conn.commit()
+            except sqlite3.Error as e:
+                logger.error(f"Query template delete failed: {e}")
+
+    async def arun(self, method, *args):
+        """Run a store method on the store's worker thread"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, method, *args)
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+                self._templates = None
+        self._executor.shutdown(wait=False)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'learned': self.learned,
+            'hit_rate': self.hits / total if total else 0.0
+        }
+
+QUERY_TEMPLATES = QueryTemplateStore()
+
+async def forget_translation(query_text, language, table_name, columns):
+    """Drop cached answers for a question whose SQL failed to execute"""
+    await TRANSLATION_CACHE.arun(TRANSLATION_CACHE.discard,
+                                 translation_cache_key(query_text, language, table_name, columns))
+    await QUERY_TEMPLATES.arun(QUERY_TEMPLATES.discard, language, schema_fingerprint(table_name, columns),
+                               query_text, columns)
+
+# Question phrases the rule-based translator understands, tried in order at each position
+_RULE_PHRASES = [(kind, value, re.compile(r'(?:%s)(?!\w)' % pattern, re.IGNORECASE)) for kind, value, pattern in [
+    ('agg', 'COUNT', r"how many|number of|count of|count|сколько|количеств\w*|число"),
+    ('agg', 'AVG', r"average|mean|avg|средн\w*"),
+    ('agg', 'SUM', r"total|sum of|sum|суммарн\w*|сумм\w*|общ(?:ая|ий|ее|ую|ей|ие|их)"),
+    ('agg', 'MAX', r"maximum|max|highest|largest|biggest|максимальн\w*|наибольш\w*|сам\w+ (?:высок|больш)\w*"),
+    ('agg', 'MIN', r"minimum|min|lowest|smallest|минимальн\w*|наименьш\w*|сам\w+ (?:низк|маленьк|меньш)\w*"),
+    ('distinct', None, r"different|distinct|unique|разн\w*|различн\w*|уникальн\w*"),
+    ('order', None, r"(?:sorted|ordered|sort|order) by|(?:от)?сортир\w* по|упорядоч\w* по"),
+    ('direction', 'DESC', r"(?:in )?descending(?: order)?|desc|по убыванию"),
+    ('direction', 'ASC', r"(?:in )?ascending(?: order)?|asc|по возрастанию"),
+    ('limit', 'DESC', r"top|топ"),
+    ('limit', 'ASC', r"first|первы\w*"),
+    ('group', None, r"grouped by|group by|by|per|for each|for every|in each|по|для кажд\w*|в кажд\w*|на кажд\w*"),
+    ('op', '>=', r">=|at least|no less than|не менее|не меньше"),
+    ('op', '<=', r"<=|at most|no more than|не более|не больше"),
+    ('op', '!=', r"!=|<>|not equal to|is not|не равн\w*"),
+    ('op', '>', r">|(?:is )?(?:greater|more|higher|bigger|larger) than|above|over|больше(?: чем)?|более|выше|свыше"),
+    ('op', '<', r"<|(?:is )?(?:less|lower|smaller) than|below|under|меньше(?: чем)?|менее|ниже"),
+    ('op', '=', r"==|=|equals|(?:is )?equal to|равн\w*"),
+    ('op', 'BETWEEN', r"between|от"),
+]]
+_RULE_STOPWORDS = {
+    'what', "what's", 'is', 'are', 'the', 'a', 'an', 'show', 'me', 'list', 'find', 'get', 'give', 'display',
+    'all', 'of', 'there', 'which', 'who', 'with', 'where', 'that', 'have', 'has', 'whose', 'in', 'for', 'from',
+    'do', 'does', 'we', 'please', 'and', 'calculate', 'compute', 'tell', 'return', 'select', 'table', 'value',
+    'покажи', 'выведи', 'найди', 'посчитай', 'вычисли', 'подсчитай', 'какая', 'какой', 'какое', 'какие',
+    'каково', 'каков', 'все', 'всех', 'всё', 'с', 'со', 'у', 'которых', 'которые', 'где', 'для', 'в', 'и',
+    'из', 'есть', 'всего', 'мне', 'пожалуйста', 'таблица', 'таблицы', 'таблице', 'значение',
+}
+_RULE_NUMBER = re.compile(r'-?\d+(?:\.\d+)?(?![\w.])')
+_RULE_QUOTED = re.compile(r"'([^']*)'|\"([^\"]*)\"|«([^»]*)»")
+_RULE_WORD = re.compile(r'[^\s,]+')
+_RULE_RANGE_JOIN = re.compile(r'(?:and|и|до|to)(?!\w)', re.IGNORECASE)
+
+def _known_values(profile):
+    """Lower-cased value -> (column, value) for columns whose every value the profile knows"""
+    known = {}
+    for name, column in (profile or {}).get('columns', {}).items():
+        if column['type'] == 'text' and column['distinct_exact'] and column['distinct'] <= len(column['top']):
+            for value, _ in column['top']:
+                known.setdefault(str(value).lower(), []).append((name, value))
+    return known
+
+def _is_table_noun(phrase, table_name):
+    forms = {table_name.lower(), table_name.lower().rstrip('s'), table_name.lower() + 's'}
+    return phrase.lower() in _ROW_WORDS or any(form in forms for form in _phrase_forms(phrase))
+
+def rule_based_sql(question, table_name, columns, profile=None):
+    """Translate a common question shape into SQL without the LLM.
+
+    Understands counts, sum/avg/min/max, grouping, comparison filters and
+    ordering with a limit, in English and Russian, e.g. "average salary by
+    department" or "сотрудники с зарплатой больше 5000". Every word has to
+    be accounted for by the grammar or resolve to a column of the live
+    schema; anything else returns None and goes to the LLM.
+    """
+    text = re.sub(r'(>=|<=|!=|<>|==|=|>|<)', r' \1 ', question)
+    text = re.sub(r'\s+', ' ', text).strip().rstrip('?!. ')
+    known = _known_values(profile)
+    types = {name: column['type'] for name, column in (profile or {}).get('columns', {}).items()}
+    
+    agg = agg_col = group = order_col = order_dir = limit = absorb = None
+    distinct = noun_before_agg = False
+    mode = None  # what the next column is for: 'agg', 'group' or 'order'
+    pending = []  # columns whose role is decided by what follows them
+    filters = []
+    
+    def value_at(pos, column):
+        """SQL literal for the value starting at pos and its end, or None"""
+        match = _RULE_NUMBER.match(text, pos)
+        if match:
+            return match.group(), match.end()
+        match = _RULE_QUOTED.match(text, pos)
+        if match:
+            return _sql_literal(next(g for g in match.groups() if g is not None)), match.end()
+        match = _RULE_WORD.match(text, pos)
+        if match:
+            candidates = [value for name, value in known.get(match.group().lower(), []) if name == column]
+            if len(candidates) == 1:
+                return _sql_literal(candidates[0]), match.end()
         return None
-    except Exception as e:
-        logger.error(f"OpenRouter API Unexpected Error: {e}")
+    
+    pos = 0
+    while True:
+        while pos < len(text) and text[pos] in ' ,':
+            pos += 1
+        if pos >= len(text):
+            break
+        words = [m for m in _RULE_WORD.finditer(text, pos)][:3]
+        
+        # Multi-word column names win over keywords ("first name", "order date")
+        column = None
+        for n in (3, 2):
+            if len(words) >= n:
+                column = resolve_column(' '.join(w.group() for w in words[:n]), columns)
+                if column:
+                    end = words[n - 1].end()
+                    break
+        
+        phrase = None
+        if column is None:
+            for kind, value, pattern in _RULE_PHRASES:
+                match = pattern.match(text, pos)
+                if match:
+                    phrase = (kind, value)
+                    end = match.end()
+                    break
+        
+        if phrase:
+            kind, value = phrase
+            if kind == 'agg':
+                if limit and not agg and value in ('MAX', 'MIN'):
+                    # "top 10 highest salaries" sorts, it doesn't aggregate
+                    order_dir = 'DESC' if value == 'MAX' else 'ASC'
+                elif agg:
+                    return None
+                else:
+                    agg, mode = value, 'agg'
+            elif kind == 'distinct':
+                distinct = True
+            elif kind == 'order':
+                mode, order_dir = 'order', order_dir or 'ASC'
+            elif kind == 'direction':
+                if not order_col:
+                    return None
+                order_dir = value
+            elif kind == 'limit':
+                number = _RULE_NUMBER.match(text, end + 1)
+                if limit or not number or '.' in number.group():
+                    return None
+                limit, order_dir, end = int(number.group()), value, number.end()
+            elif kind == 'group':
+                # "top 5 employees by salary" orders instead of grouping
+                if limit and not agg and not order_col:
+                    mode = 'order'
+                elif group:
+                    return None
+                else:
+                    mode = 'group'
+            else:
+                if not pending:
+                    return None
+                subject = pending.pop()
+                low = value_at(end + 1, subject)
+                if not low:
+                    return None
+                literal, end = low
+                if value == 'BETWEEN':
+                    join = _RULE_RANGE_JOIN.match(text, end + 1)
+                    high = join and value_at(join.end() + 1, subject)
+                    if not high:
+                        return None
+                    literal, end = f"{literal} AND {high[0]}", high[1]
+                filters.append((subject, value, literal))
+            pos = end
+            continue
+        
+        if column is None:
+            word = words[0]
+            end = word.end()
+            column = resolve_column(word.group(), columns)
+            if column is None:
+                lowered = word.group().lower()
+                number = _RULE_NUMBER.match(text, pos)
+                quoted = _RULE_QUOTED.match(text, pos)
+                if quoted:
+                    # "department 'IT'" filters on the column just named
+                    if not pending:
+                        return None
+                    filters.append((pending.pop(), '=', value_at(pos, None)[0]))
+                    end = quoted.end()
+                elif number:
+                    return None
+                elif _is_table_noun(word.group(), table_name):
+                    if mode == 'agg':
+                        if agg != 'COUNT' or agg_col:
+                            return None
+                        agg_col, mode = '*', None
+                    elif not agg:
+                        noun_before_agg = True
+                elif lowered in _RULE_STOPWORDS:
+                    pass
+                elif lowered in known:
+                    # A known value filters on its column: "department IT", "IT department"
+                    owners = {name for name, _ in known[lowered]}
+                    if pending and pending[-1] in owners:
+                        subject = pending.pop()
+                    elif len(owners) == 1:
+                        subject = absorb = owners.pop()
+                    else:
+                        return None
+                    filters.append((subject, '=', value_at(pos, subject)[0]))
+                else:
+                    return None
+                pos = end
+                continue
+        
+        # A column named right after a value of it ("IT department") was already used
+        if column == absorb:
+            absorb = None
+        elif mode == 'agg':
+            if agg_col:
+                return None
+            agg_col, mode = column, None
+        elif mode == 'group':
+            group, mode = column, None
+        elif mode == 'order':
+            order_col, mode = column, None
+        else:
+            pending.append(column)
+        pos = end
+    
+    if mode:
+        return None
+    projection = []
+    if pending:
+        if agg and not agg_col and len(pending) == 1:
+            agg_col = pending.pop()
+        elif agg:
+            return None
+        projection = pending
+    if not (agg or group or filters or order_col or projection):
         return None
+    if limit and not order_col:
+        # A limit only means something with an order: "top 3 salaries" sorts by the one column named
+        if agg or group or len(projection) != 1:
+            return None
+        order_col = projection[0]
+        if noun_before_agg:
+            projection = []
+    
+    table = _sql_identifier(table_name)
+    where = " AND ".join(f"{_sql_identifier(col)} {op} {literal}" for col, op, literal in filters)
+    if agg:
+        if agg_col in (None, '*'):
+            if agg != 'COUNT' or distinct:
+                return None
+            expr = "COUNT(*)"
+        elif agg == 'COUNT':
+            # "count of salary" could mean rows or values; only "how many different" is clear
+            if not distinct:
+                return None
+            expr = f"COUNT(DISTINCT {_sql_identifier(agg_col)})"
+        elif agg in ('SUM', 'AVG') and types.get(agg_col, 'numeric') != 'numeric':
+            return None
+        else:
+            expr = f"{agg}({_sql_identifier(agg_col)})"
+        if agg in ('MIN', 'MAX') and noun_before_agg and not group:
+            # "employee with the highest salary" wants the rows, ties included
+            condition = f"{_sql_identifier(agg_col)} = (SELECT {expr} FROM {table}" + (f" WHERE {where})" if where else ")")
+            where = f"{where} AND {condition}" if where else condition
+            select = "*"
+        else:
+            select = f"{_sql_identifier(group)}, {expr}" if group else expr
+    elif group:
+        if projection:
+            return None
+        select = f"{_sql_identifier(group)}, COUNT(*)"
+    else:
+        select = ", ".join(_sql_identifier(col) for col in projection) or "*"
+    
+    sql_query = f"SELECT {select} FROM {table}"
+    if where:
+        sql_query += f" WHERE {where}"
+    if group:
+        sql_query += f" GROUP BY {_sql_identifier(group)}"
+    if order_col:
+        sql_query += f" ORDER BY {_sql_identifier(order_col)} {order_dir}"
+    if limit:
+        sql_query += f" LIMIT {limit}"
+    return sql_query
+
+def estimate_tokens(text):
+    """Rough token count for budgeting: about four bytes of UTF-8 per token"""
+    return len(text.encode('utf-8')) // 4 + 1
+
+def _question_terms(question):
+    """Words of a question, their singular and lexicon forms, and adjacent word pairs"""
+    words = re.findall(r'\w+', question.lower())
+    terms = set()
+    for word in words:
+        terms.update(_phrase_forms(word))
+    terms.update(f"{a}_{b}" for a, b in zip(words, words[1:]))
+    return terms
+
+def _name_score(name, terms):
+    """How strongly a table or column name is mentioned among question terms"""
+    key = re.sub(r'[\s_]+', '_', re.sub(r'([a-z])([A-Z])', r'\1_\2', name).lower())
+    if key in terms or key.rstrip('s') in terms:
+        return 3
+    if re.search('[а-яё]', key) and any(len(os.path.commonprefix([key, t])) >= max(4, len(key) - 1) for t in terms):
+        return 3
+    return sum(1 for part in key.split('_') if len(part) > 1 and (part in terms or part.rstrip('s') in terms))
+
+def build_schema_info(db_path, table_name, columns, question=None, budget=LLM_SCHEMA_TOKENS):
+    """Schema description for the LLM prompt, packed into budget estimated tokens.
+
+    Tables and columns are scored against the question. table_name always
+    comes first, tables linked to it by foreign keys next, and the rest
+    only if room is left. Columns the question mentions win over the others,
+    and each kept column may carry sample values from the upload profile or
+    the table's first rows. Columns that don't fit are counted but not listed.
+    """
+    info = get_database_info(db_path)
+    terms = _question_terms(question) if question else set()
+    profiles = load_profiles(db_path)
+    tables = dict(info)
+    if table_name not in tables:
+        tables[table_name] = {'columns': list(columns), 'types': [''] * len(columns), 'foreign_keys': [],
+                              'row_count': 0}
+    
+    related = {table_name}
+    for name, table in tables.items():
+        for column, ref_table, _ in table.get('foreign_keys', ()):
+            if name == table_name:
+                related.add(ref_table)
+            elif ref_table == table_name:
+                related.add(name)
+    
+    # (priority, table, kind, column, text); higher priorities are packed first
+    items = []
+    for name, table in tables.items():
+        names = list(columns) if name == table_name else table['columns']
+        types = dict(zip(table['columns'], table.get('types', ())))
+        keys = {fk[0] for fk in table.get('foreign_keys', ())}
+        for other, other_table in tables.items():
+            keys.update(fk[2] or 'id' for fk in other_table.get('foreign_keys', ()) if fk[1] == name)
+        scores = {col: _name_score(col, terms) for col in names}
+        relevance = _name_score(name, terms) + max(scores.values(), default=0)
+        # Mentioned columns first, then join keys, then the rest of the current and related tables
+        base = 10 if name == table_name else 5 if name in related else 0
+        items.append((base + relevance + 0.5, name, 'table', None, f"Table {name} ({table['row_count']} rows): "))
+        
+        profile = profiles.get(name)
+        samples = None if profile or not (base or relevance) else SCHEMA_CACHE.samples(db_path, name)
+        for col in names:
+            if scores[col]:
+                priority = 20 + scores[col] + relevance
+            elif col in keys and (base or relevance):
+                priority = 20
+            else:
+                priority = base + relevance
+            items.append((priority, name, 'column', col, f"{col} {types.get(col, '')}".strip()))
+            if profile and col in profile['columns']:
+                hint = profile_hint(profile['columns'][col])
+            elif samples and samples.get(col):
+                hint = f"e.g. {', '.join(_hint_value(v) for v in samples[col])}"
+            else:
+                hint = None
+            if hint:
+                priority = 19 + scores[col] if scores[col] else base / 5
+                items.append((priority, name, 'hint', col, f"  {col}: {hint}"))
+        for column, ref_table, ref_column in table.get('foreign_keys', ()):
+            items.append((19, name, 'fk', (column, ref_table),
+                          f"  {name}.{column} -> {ref_table}.{ref_column or 'id'}"))
+    
+    used = 0
+    kept = set()
+    # Headers leave room for the "(+N more columns)" note, columns for their separator
+    headers = {name: text + " (+999 more columns)" for _, name, kind, _, text in items if kind == 'table'}
+    for priority, name, kind, col, text in sorted(items, key=lambda item: -item[0]):
+        if (name, kind, col) in kept or kind == 'hint' and (name, 'column', col) not in kept:
+            continue
+        cost = estimate_tokens(headers[name] if kind == 'table' else text + ", ")
+        needs_header = (name, 'table', None) not in kept
+        if kind != 'table' and needs_header:
+            cost += estimate_tokens(headers[name])
+        if used + cost > budget:
+            continue
+        used += cost
+        kept.add((name, kind, col))
+        if needs_header:
+            kept.add((name, 'table', None))
+    
+    lines = []
+    for name, table in sorted(tables.items(), key=lambda t: t[0] != table_name):
+        if (name, 'table', None) not in kept:
+            continue
+        names = list(columns) if name == table_name else table['columns']
+        types = dict(zip(table['columns'], table.get('types', ())))
+        shown = [f"{col} {types.get(col, '')}".strip() for col in names if (name, 'column', col) in kept]
+        line = f"Table {name} ({table['row_count']} rows): " + ", ".join(shown)
+        if len(shown) < len(names):
+            line += f" (+{len(names) - len(shown)} more columns)"
+        lines.append(line)
+        # Foreign keys are only worth listing when the referenced table made it in
+        lines.extend(text for _, n, kind, col, text in items if n == name and (n, kind, col) in kept
+                     and (kind == 'hint' or kind == 'fk' and (col[1], 'table', None) in kept))
+    return "\n".join(lines) + "\n"
+
+def load_query_context(db_path, table_name, question):
+    """(columns, schema_info, profile) for answering a question.
+
+    A schema cache miss opens and introspects the database, so async callers
+    run this in a worker thread.
+    """
+    columns = get_table_columns(db_path, table_name)
+    schema_info = build_schema_info(db_path, table_name, columns, question)
+    profile = get_table_profile(db_path, table_name)
+    return columns, schema_info, profile
 
 # Enhanced SQL generator with better table detection
-def generate_sql_with_visualization(schema_info, query_text, table_name, language='en'):
-    """Generate SQL with special handling for table display requests"""
+async def generate_sql_with_visualization(schema_info, query_text, table_name, language='en', columns=None,
+                                          profile=None, user_id=None, on_queued=None, usage=None):
+    """Generate SQL with special handling for table display requests.
+
+    profile, the table's column profile, answers simple whole-table
+    aggregates without scanning the table and lets the rule-based
+    translator recognise known column values. user_id, on_queued and
+    usage are passed on to call_openrouter.
+    """
     query_lower = query_text.lower()
     lang_dict = LANGUAGES[language]
     
@@ -324,6 +2627,18 @@ def generate_sql_with_visualization(schema_info, query_text, table_name, languag
     if any(keyword in query_lower for keyword in show_all_keywords):
         return f"SELECT * FROM {table_name}", "full_table"
     
+    # Whole-table aggregates come straight from the upload profile
+    if profile:
+        sql_query = answer_from_profile(query_text, table_name, profile)
+        if sql_query:
+            return sql_query, "profile"
+    
+    # Common question shapes are translated locally
+    if columns:
+        sql_query = rule_based_sql(query_text, table_name, columns, profile)
+        if sql_query:
+            return sql_query, "rule_based"
+    
     # Handle requests with limits
     if any(word in query_lower for word in ['first', 'top', 'первые', 'топ']):
         limit_match = re.search(r'(first|top|первые|топ)\s+(\d+)', query_lower)
@@ -331,6 +2646,20 @@ def generate_sql_with_visualization(schema_info, query_text, table_name, languag
             limit = limit_match.group(2)
             return f"SELECT * FROM {table_name} LIMIT {limit}", "limited_table"
     
+    # Reuse an earlier translation of the same question against the same schema
+    cache_key = translation_cache_key(query_text, language, table_name, columns, schema_info)
+    cached = await TRANSLATION_CACHE.arun(TRANSLATION_CACHE.get, cache_key)
+    if cached:
+        return cached
+    
+    # Fill in a template learned from an earlier question of the same shape
+    if columns:
+        fingerprint = schema_fingerprint(table_name, columns)
+        sql_query = await QUERY_TEMPLATES.arun(QUERY_TEMPLATES.match, language, fingerprint, query_text,
+                                               table_name, columns)
+        if sql_query:
+            return sql_query, "template"
+    
     # Use OpenRouter for complex queries
     prompt = f"""
     Database schema:
@@ -343,12 +2672,14 @@ def generate_sql_with_visualization(schema_info, query_text, table_name, languag
     Keep the query simple and avoid complex joins unless necessary.
     """
     
-    sql_query = call_openrouter(prompt)
+    sql_query = await call_openrouter(prompt, max_tokens=LLM_SQL_MAX_TOKENS, user_id=user_id, on_queued=on_queued,
+                                      usage=usage, stop_at_sql=True)
     if not sql_query:
         # Fallback to simple query
         return f"SELECT * FROM {table_name} LIMIT 10", "fallback"
     
-    # Clean up the SQL query
+    # Clean up the SQL query; explanations after the statement are dropped
+    sql_query = complete_sql_statement(sql_query) or sql_query
     if sql_query.startswith("```sql"):
         sql_query = sql_query[6:]
     if sql_query.startswith("```"):
@@ -359,8 +2690,646 @@ def generate_sql_with_visualization(schema_info, query_text, table_name, languag
     # Ensure the query uses the correct table name
     sql_query = sql_query.replace('FROM data', f'FROM {table_name}')
     sql_query = sql_query.replace('from data', f'from {table_name}')
+    sql_query = sql_query.strip()
+    
+    await TRANSLATION_CACHE.arun(TRANSLATION_CACHE.put, cache_key, sql_query, "ai_generated")
+    if columns:
+        await QUERY_TEMPLATES.arun(QUERY_TEMPLATES.learn, language, schema_fingerprint(table_name, columns),
+                                   query_text, sql_query, table_name, columns)
+    return sql_query, "ai_generated"
+
+_SQL_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_SQL_IDENTIFIER = r'(?:(\w+)\.)?("[^"]+"|`[^`]+`|\[[^\]]+\]|\w+)'
+_SQL_CLAUSE_KEYWORDS = {'WHERE', 'JOIN', 'LEFT', 'RIGHT', 'INNER', 'OUTER', 'CROSS', 'NATURAL', 'FULL', 'ON',
+                        'USING', 'GROUP', 'ORDER', 'LIMIT', 'HAVING', 'WINDOW', 'UNION', 'EXCEPT', 'INTERSECT'}
+_PLAN_STEP = re.compile(r'(SCAN|SEARCH)(?: TABLE)? (\S+)(?: AS (\S+))?(?: USING (AUTOMATIC )?(?:PARTIAL )?'
+                        r'(?:COVERING )?INDEX (\S+))?')
+
+def _unquote_identifier(name):
+    return name[1:-1] if name[:1] in '"`[' else name
+
+def query_table_aliases(sql_query):
+    """Map lowercase table names and aliases in FROM/JOIN clauses to table names"""
+    aliases = {}
+    pattern = r'\b(?:FROM|JOIN)\s+("[^"]+"|`[^`]+`|\[[^\]]+\]|\w+)(?:\s+(?:AS\s+)?(\w+))?'
+    for match in re.finditer(pattern, sql_query, re.IGNORECASE):
+        table = _unquote_identifier(match.group(1))
+        aliases[table.lower()] = table
+        alias = match.group(2)
+        if alias and alias.upper() not in _SQL_CLAUSE_KEYWORDS:
+            aliases[alias.lower()] = table
+    return aliases
+
+def query_column_references(sql_query):
+    """(qualifier, column, kind) for columns compared in WHERE ('filter') or leading ORDER BY ('sort')"""
+    sql = _SQL_STRING_LITERAL.sub("''", sql_query)
+    references = []
+    where = re.search(r'\bWHERE\b(.*?)(?=\bGROUP\s+BY\b|\bORDER\s+BY\b|\bLIMIT\b|\bHAVING\b|$)',
+                      sql, re.IGNORECASE | re.DOTALL)
+    if where:
+        # Only operators an index can serve; <> and leading-wildcard LIKE can't
+        comparison = r'\s*(?:<=|>=|==|=|<|>|\bIN\b|\bBETWEEN\b|\bIS\b)'
+        for match in re.finditer(_SQL_IDENTIFIER + comparison, where.group(1), re.IGNORECASE):
+            references.append((match.group(1), _unquote_identifier(match.group(2)), 'filter'))
+    order = re.search(r'\bORDER\s+BY\s+' + _SQL_IDENTIFIER, sql, re.IGNORECASE)
+    if order:
+        references.append((order.group(1), _unquote_identifier(order.group(2)), 'sort'))
+    return references
+
+class IndexAdvisor:
+    """Creates indexes on user databases for columns that keep getting scanned.
+
+    observe() runs EXPLAIN QUERY PLAN for each generated query on the SQL
+    worker. Tables that are scanned without an index have their filter and
+    sort columns counted. Once a column crosses the threshold on a large
+    table, an index is built on a background thread within the per-table
+    and size budgets. Index usage is counted from the same plans.
+    """
+    PREFIX = 'autoidx_'
+
+    def __init__(self, enabled=AUTO_INDEX, min_rows=AUTO_INDEX_MIN_ROWS, threshold=AUTO_INDEX_SCAN_THRESHOLD,
+                 max_per_table=AUTO_INDEX_MAX_PER_TABLE, budget=AUTO_INDEX_BUDGET):
+        self.enabled = enabled
+        self.min_rows = min_rows
+        self.threshold = threshold
+        self.max_per_table = max_per_table
+        self.budget = budget
+        self.scans = 0
+        self.searches = 0
+        self.skipped = 0
+        self.column_scans = {}   # (db_path, table, column, kind) -> count
+        self.index_uses = {}     # (db_path, index) -> count
+        self.created = {}        # (db_path, index) -> details of indexes built by us
+        self._done = set()       # (db_path, table, column) already indexed or rejected
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='autoindex')
+
+    def observe(self, conn, db_path, sql_query):
+        """Record scans and index use for a query; never raises"""
+        if not self.enabled:
+            return
+        try:
+            plan = [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql_query}")]
+        except sqlite3.Error:
+            return  # Not a single valid statement; the real execution reports the error
+        
+        aliases = query_table_aliases(sql_query)
+        if not aliases:
+            return  # No table to index, e.g. a constant answered from a profile
+        references = query_column_references(sql_query)
+        temp_sort = any('TEMP B-TREE FOR ORDER BY' in step for step in plan)
+        steps = [m for m in map(_PLAN_STEP.match, plan) if m]
+        candidates = []
+        with self._lock:
+            for step in steps:
+                table = aliases.get((step.group(3) or step.group(2)).lower(), step.group(2))
+                index = None if step.group(4) else step.group(5)
+                if index:
+                    self.searches += 1
+                    self.index_uses[(db_path, index)] = self.index_uses.get((db_path, index), 0) + 1
+                    continue
+                if step.group(1) == 'SEARCH':
+                    self.searches += 1  # rowid lookup
+                    continue
+                self.scans += 1
+                for qualifier, column, kind in references:
+                    if qualifier and aliases.get(qualifier.lower()) != table:
+                        continue
+                    # A sort only costs a scan when SQLite has to sort in a temp b-tree
+                    if kind == 'sort' and not (temp_sort and len(steps) == 1):
+                        continue
+                    key = (db_path, table, column.lower(), kind)
+                    self.column_scans[key] = self.column_scans.get(key, 0) + 1
+                    if self.column_scans[key] >= self.threshold and (db_path, table, column.lower()) not in self._done:
+                        self._done.add((db_path, table, column.lower()))
+                        candidates.append((table, column))
+        
+        for table, column in candidates:
+            self._executor.submit(self._create_index, db_path, table, column)
+
+    def _auto_index_bytes(self, conn, row_count):
+        """Size of the indexes we created, from dbstat where available"""
+        try:
+            return conn.execute("SELECT COALESCE(SUM(pgsize), 0) FROM dbstat WHERE name LIKE ?",
+                                (self.PREFIX + '%',)).fetchone()[0]
+        except sqlite3.OperationalError:
+            count = conn.execute("SELECT COUNT(*) FROM sqlite_master WHERE type='index' AND name LIKE ?",
+                                 (self.PREFIX + '%',)).fetchone()[0]
+            return count * row_count * 16
+
+    def _create_index(self, db_path, table_name, column):
+        info = get_database_info(db_path).get(table_name)
+        if not info:
+            return
+        columns = {c.lower(): c for c in info['columns']}
+        column = columns.get(column.lower())
+        row_count = info['row_count']
+        if column is None or row_count < self.min_rows:
+            return
+        
+        conn = sqlite3.connect(db_path, timeout=30)
+        try:
+            quoted_table = _quote_identifier(table_name)
+            ours = 0
+            for (index_name,) in conn.execute("SELECT name FROM pragma_index_list(?)", (table_name,)).fetchall():
+                leading = conn.execute("SELECT name FROM pragma_index_info(?) WHERE seqno = 0",
+                                       (index_name,)).fetchone()
+                if leading and leading[0] == column:
+                    return  # Already indexed; the planner chose not to use it
+                ours += index_name.startswith(self.PREFIX)
+            if ours >= self.max_per_table:
+                self.skipped += 1
+                logger.info(f"Not indexing {table_name}.{column}: table already has {ours} automatic indexes")
+                return
+            
+            avg_width = conn.execute(f"SELECT AVG(LENGTH({_quote_identifier(column)})) FROM "
+                                     f"(SELECT {_quote_identifier(column)} FROM {quoted_table} LIMIT 1000)").fetchone()[0]
+            estimate = row_count * ((avg_width or 8) + 12)
+            used = self._auto_index_bytes(conn, row_count)
+            data_size = os.path.getsize(db_path) - used
+            if used + estimate > self.budget * data_size:
+                self.skipped += 1
+                logger.info(f"Not indexing {table_name}.{column}: ~{estimate / 2**20:.1f} MB exceeds the index budget")
+                return
+            
+            index_name = self.PREFIX + re.sub(r'\W', '_', f"{table_name}_{column}")
+            started = time.perf_counter()
+            conn.execute(f"CREATE INDEX IF NOT EXISTS {_quote_identifier(index_name)} "
+                         f"ON {quoted_table}({_quote_identifier(column)})")
+            conn.execute(f"ANALYZE {_quote_identifier(index_name)}")
+            conn.commit()
+            seconds = time.perf_counter() - started
+            size = self._auto_index_bytes(conn, row_count) - used
+            with self._lock:
+                self.created[(db_path, index_name)] = {'table': table_name, 'column': column,
+                                                       'bytes': size, 'seconds': seconds}
+            logger.info(f"Created {index_name} on {table_name}({column}) in {seconds:.1f}s, {size / 2**20:.1f} MB")
+        except sqlite3.Error as e:
+            logger.warning(f"Automatic index on {table_name}.{column} failed: {e}")
+        finally:
+            conn.close()
+        SCHEMA_CACHE.invalidate(db_path)
+
+    def report(self, db_path=None):
+        """Automatic indexes with the number of query plans that used them"""
+        with self._lock:
+            return [{'index': index, 'uses': self.index_uses.get((path, index), 0), **details}
+                    for (path, index), details in self.created.items() if db_path in (None, path)]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'scans': self.scans,
+                'searches': self.searches,
+                'created': len(self.created),
+                'skipped': self.skipped,
+                'used': sum(self.index_uses.get(key, 0) for key in self.created)
+            }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+INDEX_ADVISOR = IndexAdvisor()
+
+class QueryTimeoutError(Exception):
+    """Raised when a query runs past its deadline and is interrupted"""
+
+class QueryCancelledError(Exception):
+    """Raised when a query is interrupted because its caller went away"""
+
+SQL_EXECUTOR = ThreadPoolExecutor(max_workers=SQL_WORKERS, thread_name_prefix='sql')
+
+def _connect_with_deadline(db_path, timeout, handle=None):
+    """Open a connection whose statements abort once the deadline passes"""
+    conn = sqlite3.connect(db_path, check_same_thread=False)
+    if handle is not None:
+        handle['conn'] = conn
+    deadline = time.monotonic() + timeout
+    # SQLite calls this every SQL_PROGRESS_STEPS VM instructions; non-zero aborts the statement
+    conn.set_progress_handler(lambda: int(time.monotonic() > deadline), SQL_PROGRESS_STEPS)
+    return conn, deadline
+
+def _deadline_exceeded(error, deadline):
+    return 'interrupted' in str(error) and time.monotonic() > deadline
+
+def run_sql_query(db_path, sql_query, timeout=SQL_QUERY_TIMEOUT, handle=None):
+    """Run a query on the calling thread with a wall-clock deadline.
+
+    Aggregates over large tables with a columnar copy run in DuckDB; if it
+    rejects the query, SQLite runs it instead. A timed out or cancelled
+    columnar query is not run again.
+    """
+    conn, deadline = _connect_with_deadline(db_path, timeout, handle)
+    try:
+        route = columnar_route(db_path, sql_query)
+        if route:
+            try:
+                # Also checks that SQLite accepts the query; LIMIT 0 returns before the aggregate runs
+                cursor = conn.execute(f"SELECT * FROM ({sql_query.strip().rstrip(';')}) LIMIT 0")
+                column_names = [d[0] for d in cursor.description]
+                with METRICS.timer('columnar'):
+                    return run_columnar_query(route[1], route[0], sql_query, column_names,
+                                              max(deadline - time.monotonic(), 0.001), handle)
+            except (QueryTimeoutError, QueryCancelledError):
+                raise
+            except Exception as e:
+                logger.warning(f"Columnar engine failed, running on SQLite: {e}")
+                if handle is not None:
+                    handle['conn'] = conn
+        INDEX_ADVISOR.observe(conn, db_path, sql_query)
+        return pd.read_sql_query(sql_query, conn)
+    except Exception as e:
+        if _deadline_exceeded(e, deadline):
+            raise QueryTimeoutError(f"Query exceeded {timeout:g}s deadline") from e
+        raise
+    finally:
+        conn.close()
+
+def new_pagination(db_path, sql_query, table_name, query_type, pagination_id, page_size=RESULT_PAGE_SIZE):
+    """Cursor state for a paginated result.
+
+    Whole-table requests page by rowid (keyset), so every page costs the same
+    no matter how deep the user goes; anything else pages with LIMIT/OFFSET.
+    """
+    return {
+        'id': pagination_id,
+        'db_path': db_path,
+        'sql': sql_query.strip().rstrip(';'),
+        'table': table_name,
+        'mode': 'keyset' if query_type == "full_table" else 'offset',
+        'page': 0,
+        'page_size': page_size,
+        'keys': [None]  # rowid after which each visited page starts
+    }
+
+def fetch_result_page(pagination, timeout=SQL_QUERY_TIMEOUT, page=None, handle=None):
+    """Fetch a page (the current one by default) without materializing the full result set.
+
+    Returns (DataFrame, has_next).
+    """
+    conn, deadline = _connect_with_deadline(pagination['db_path'], timeout, handle)
+    if page is None:
+        page = pagination['page']
+    size = pagination['page_size']
+    try:
+        c = conn.cursor()
+        if pagination['mode'] == 'keyset':
+            after = pagination['keys'][page]
+            table = _quote_identifier(pagination['table'])
+            try:
+                if after is None:
+                    c.execute(f"SELECT rowid AS _page_key, * FROM {table} ORDER BY rowid LIMIT ?", (size + 1,))
+                else:
+                    c.execute(f"SELECT rowid AS _page_key, * FROM {table} WHERE rowid > ? "
+                              f"ORDER BY rowid LIMIT ?", (after, size + 1))
+            except sqlite3.OperationalError as e:
+                if _deadline_exceeded(e, deadline):
+                    raise
+                # WITHOUT ROWID tables and views have no keyset to page on
+                pagination['mode'] = 'offset'
+        if pagination['mode'] == 'offset':
+            c.execute(f"SELECT * FROM ({pagination['sql']}) LIMIT ? OFFSET ?", (size + 1, page * size))
+        
+        rows = c.fetchall()
+        columns = [d[0] for d in c.description]
+        has_next = len(rows) > size
+        rows = rows[:size]
+        if columns and columns[0] == '_page_key':
+            if has_next and len(pagination['keys']) == page + 1:
+                pagination['keys'].append(rows[-1][0])
+            rows = [row[1:] for row in rows]
+            columns = columns[1:]
+        return pd.DataFrame(rows, columns=columns), has_next
+    except Exception as e:
+        if _deadline_exceeded(e, deadline):
+            raise QueryTimeoutError(f"Query exceeded {timeout:g}s deadline") from e
+        raise
+    finally:
+        conn.close()
+
+async def _run_sql_job(func, *args, executor=None, stage='sql'):
+    """Run a blocking SQLite job in the SQL worker pool"""
+    loop = asyncio.get_running_loop()
+    handle = {}
+    future = loop.run_in_executor(executor or SQL_EXECUTOR, partial(func, *args, handle=handle))
+    try:
+        with METRICS.timer(stage):
+            return await future
+    except asyncio.CancelledError:
+        # Stop the statement if the caller goes away
+        if 'conn' in handle:
+            handle['conn'].interrupt()
+        raise
+
+async def execute_query(db_path, sql_query, timeout=SQL_QUERY_TIMEOUT, executor=None):
+    """Run a query in the SQL worker pool without blocking the event loop"""
+    return await _run_sql_job(run_sql_query, db_path, sql_query, timeout, executor=executor)
+
+async def fetch_page(pagination, timeout=SQL_QUERY_TIMEOUT, executor=None, page=None):
+    return await _run_sql_job(fetch_result_page, pagination, timeout, page, executor=executor)
+
+class _ExportPart:
+    """One output file of a streaming export"""
+    def __init__(self, path, fmt, columns, entry_name, arrow_schema=None):
+        self.path = path
+        self.raw = open(path, 'wb')
+        self.zip = None
+        self.parquet = None
+        if fmt == 'parquet':
+            import pyarrow.parquet as pq
+            self.parquet = pq.ParquetWriter(self.raw, arrow_schema, compression='zstd')
+            return
+        if fmt == 'zip':
+            self.zip = zipfile.ZipFile(self.raw, 'w', compression=zipfile.ZIP_DEFLATED)
+            binary = self.zip.open(entry_name, 'w', force_zip64=True)
+        else:
+            binary = gzip.GzipFile(fileobj=self.raw, mode='wb', compresslevel=6)
+        self.text = io.TextIOWrapper(binary, encoding='utf-8', newline='')
+        self.writer = csv.writer(self.text)
+        self.writer.writerow(columns)
+
+    def write(self, rows, columns):
+        if self.parquet is not None:
+            import pyarrow as pa
+            schema = self.parquet.schema
+            arrays = []
+            for values, field in zip(zip(*rows) if rows else [()] * len(schema), schema):
+                if field.type == pa.string():
+                    values = [v if v is None or isinstance(v, str) else str(v) for v in values]
+                arrays.append(pa.array(values, type=field.type))
+            self.parquet.write_batch(pa.RecordBatch.from_arrays(arrays, schema=schema))
+        else:
+            self.writer.writerows(rows)
+
+    def size(self):
+        # Compressed bytes that have reached the file so far
+        return self.raw.tell()
+
+    def close(self):
+        if self.parquet is not None:
+            self.parquet.close()
+        else:
+            self.text.close()
+            if self.zip is not None:
+                self.zip.close()
+        self.raw.close()
+
+def _export_arrow_schema(cursor, sql_query, columns):
+    """Arrow schema that holds every value of a query result.
+
+    SQLite types values rather than columns, so one pass over the result
+    collects the storage classes each column holds: integers only stay
+    int64, integers and reals become float64, blobs only stay binary and
+    anything else is written as text.
+    """
+    import pyarrow as pa
+    # Duplicate names can't be told apart from outside the query; they are written as text
+    unique = [col for col in columns if columns.count(col) == 1]
+    classes = {}
+    if unique:
+        probes = ", ".join(f"GROUP_CONCAT(DISTINCT typeof({_quote_identifier(col)}))" for col in unique)
+        row = cursor.execute(f"SELECT {probes} FROM ({sql_query.strip().rstrip(';')})").fetchone()
+        classes = {col: set((found or '').split(',')) - {'', 'null'} for col, found in zip(unique, row)}
+    fields = []
+    for col in columns:
+        found = classes.get(col, {'text'})
+        if found == {'integer'}:
+            arrow_type = pa.int64()
+        elif found and found <= {'integer', 'real'}:
+            arrow_type = pa.float64()
+        elif found == {'blob'}:
+            arrow_type = pa.binary()
+        else:
+            arrow_type = pa.string()
+        fields.append(pa.field(col, arrow_type))
+    return pa.schema(fields)
+
+def export_query_results(db_path, sql_query, out_dir, base_name, fmt=EXPORT_FORMAT,
+                         chunk_rows=EXPORT_CHUNK_ROWS, part_limit=TELEGRAM_UPLOAD_LIMIT,
+                         timeout=EXPORT_TIMEOUT, handle=None):
+    """Stream a query result from the cursor into compressed files.
+
+    Rows are written in fixed-size chunks, so memory stays bounded by
+    chunk_rows regardless of result size. A new part is started whenever the
+    next chunk could push the current file past part_limit. Returns the list
+    of written file paths.
+    """
+    if fmt == 'parquet':
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            logger.warning("pyarrow is not installed, exporting as csv.gz instead")
+            fmt = 'csv.gz'
+    extension = {'zip': '.csv.zip', 'parquet': '.parquet'}.get(fmt, '.csv.gz')
+    
+    conn, deadline = _connect_with_deadline(db_path, timeout, handle)
+    paths = []
+    part = None
+    try:
+        c = conn.cursor()
+        c.execute(sql_query)
+        columns = [d[0] for d in c.description]
+        arrow_schema = None
+        if fmt == 'parquet':
+            arrow_schema = _export_arrow_schema(conn.cursor(), sql_query, columns)
+        largest_chunk = 0
+        while True:
+            rows = c.fetchmany(chunk_rows)
+            if not rows and part is not None:
+                break
+            # Leave headroom for the next chunk based on the largest one seen so far
+            if part is not None and part.size() + largest_chunk * 1.5 + 65536 > part_limit:
+                part.close()
+                part = None
+            if part is None:
+                path = os.path.join(out_dir, f"{base_name}_part{len(paths) + 1}{extension}")
+                part = _ExportPart(path, fmt, columns, f"{base_name}.csv", arrow_schema)
+                paths.append(path)
+            before = part.size()
+            part.write(rows, columns)
+            largest_chunk = max(largest_chunk, part.size() - before)
+            if not rows:
+                break
+        part.close()
+        part = None
+        # A single file doesn't need a part number
+        if len(paths) == 1:
+            single = os.path.join(out_dir, f"{base_name}{extension}")
+            os.replace(paths[0], single)
+            paths = [single]
+        return paths
+    except Exception as e:
+        if _deadline_exceeded(e, deadline):
+            raise QueryTimeoutError(f"Export exceeded {timeout:g}s deadline") from e
+        raise
+    finally:
+        if part is not None:
+            part.close()
+        conn.close()
+
+async def send_query_export(message, db_path, sql_query, table_name, lang_dict, fmt=EXPORT_FORMAT):
+    """Export a full query result off the event loop and upload it in parts"""
+    out_dir = tempfile.mkdtemp(prefix='export_')
+    try:
+        base_name = f"{table_name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        paths = await _run_sql_job(export_query_results, db_path, sql_query, out_dir, base_name, fmt,
+                                  stage='export')
+        for i, path in enumerate(paths, 1):
+            if len(paths) == 1:
+                caption = lang_dict['export_caption']
+            else:
+                caption = lang_dict['export_part_caption'].format(i, len(paths))
+            with open(path, 'rb') as f:
+                await message.reply_document(document=f, filename=os.path.basename(path), caption=caption)
+    finally:
+        shutil.rmtree(out_dir, ignore_errors=True)
+
+def render_result_page(df, pagination, has_next, lang_dict):
+    """Format a result page and its navigation keyboard"""
+    first_row = pagination['page'] * pagination['page_size'] + 1
+    header = lang_dict['page_header'].format(pagination['page'] + 1, first_row, first_row + len(df) - 1)
+    table = tabulate(df, headers='keys', tablefmt='grid', showindex=False)
+    text = f"📋 **{header}**\n\n```\n{table}\n```"
     
-    return sql_query.strip(), "ai_generated"
+    if pagination['page'] == 0 and not has_next:
+        return text, None
+    
+    nav = []
+    if pagination['page'] > 0:
+        nav.append(InlineKeyboardButton(lang_dict['prev_page'], callback_data=f"page_prev_{pagination['id']}"))
+    if has_next:
+        nav.append(InlineKeyboardButton(lang_dict['next_page'], callback_data=f"page_next_{pagination['id']}"))
+    keyboard = [nav, [InlineKeyboardButton(lang_dict['download_csv'], callback_data=f"page_csv_{pagination['id']}")]]
+    return text, InlineKeyboardMarkup(keyboard)
+
+class WarmResultCache:
+    """First result pages of the suggested queries, prepared right after an upload.
+
+    Entries are keyed by database, table, language and normalized question
+    and are dropped as soon as the database file changes.
+    """
+
+    def __init__(self, max_entries=64):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    @staticmethod
+    def _stamp(db_path):
+        stat = os.stat(db_path)
+        return stat.st_mtime_ns, stat.st_size
+
+    def put(self, db_path, table_name, language, question, result):
+        key = (db_path, table_name, language, normalize_question(question))
+        self._entries[key] = (self._stamp(db_path), result)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def get(self, db_path, table_name, language, question):
+        key = (db_path, table_name, language, normalize_question(question))
+        entry = self._entries.get(key)
+        try:
+            valid = entry is not None and entry[0] == self._stamp(db_path)
+        except OSError:
+            valid = False
+        if not valid:
+            self._entries.pop(key, None)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'in_memory': len(self._entries),
+        }
+
+WARM_RESULTS = WarmResultCache()
+
+def warm_page_cache(db_path, max_bytes=WARMUP_CACHE_BYTES):
+    """Read the database file once so its first queries are served from the OS page cache"""
+    read = 0
+    with open(db_path, 'rb') as f:
+        while read < max_bytes:
+            chunk = f.read(min(1024 * 1024, max_bytes - read))
+            if not chunk:
+                break
+            read += len(chunk)
+    return read
+
+async def warm_up(db_path, table_name, language, pagination_id):
+    """Prepare the first interaction after an upload.
+
+    pagination_id is the id the user's next result will get, so the
+    suggested queries can be rendered with the right keyboard up front.
+    Common questions are only translated here, which fills the translation
+    cache; their results are computed when they are asked.
+    """
+    lang_dict = LANGUAGES[language]
+    try:
+        with METRICS.timer('warmup'):
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(INGEST_EXECUTOR, warm_page_cache, db_path)
+            columns, _, profile = await loop.run_in_executor(
+                INGEST_EXECUTOR, load_query_context, db_path, table_name, None)
+
+            for question in SUGGESTED_QUERIES:
+                sql_query, query_type = await generate_sql_with_visualization(
+                    None, question, table_name, language, columns=columns, profile=profile)
+                if query_type not in ("full_table", "limited_table"):
+                    continue
+                pagination = new_pagination(db_path, sql_query, table_name, query_type, pagination_id)
+                df, has_next = await fetch_page(pagination)
+                if df.empty:
+                    text, reply_markup = lang_dict['no_results'], None
+                else:
+                    text, reply_markup = render_result_page(df, pagination, has_next, lang_dict)
+                WARM_RESULTS.put(db_path, table_name, language, question, {
+                    'pagination': pagination, 'df': df, 'has_next': has_next,
+                    'text': text, 'reply_markup': reply_markup
+                })
+
+            for question in WARMUP_QUESTIONS:
+                schema_info = await loop.run_in_executor(
+                    INGEST_EXECUTOR, build_schema_info, db_path, table_name, columns, question)
+                await generate_sql_with_visualization(schema_info, question, table_name, language,
+                                                      columns=columns, profile=profile, user_id='warmup')
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logger.error(f"Error warming up {db_path}: {e}")
+
+def schedule_warm_up(application, db_path, table_name, language, pagination_id):
+    """Run warm_up in the background; shutdown_services cancels whatever is still running"""
+    tasks = application.bot_data.setdefault('warmup_tasks', set())
+    task = asyncio.create_task(warm_up(db_path, table_name, language, pagination_id))
+    tasks.add(task)
+    task.add_done_callback(tasks.discard)
+    return task
+
+async def reply_warm_result(message, user_state, text, lang_dict):
+    """Answer from the warm-up cache; returns False when nothing was prepared for this question"""
+    warm = WARM_RESULTS.get(user_state.current_db, user_state.current_table, user_state.language, text)
+    if warm is None:
+        return False
+
+    user_state.pagination_id += 1
+    pagination = dict(warm['pagination'], id=user_state.pagination_id, keys=list(warm['pagination']['keys']))
+    user_state.pagination = pagination
+    if warm['df'].empty or pagination['id'] == warm['pagination']['id']:
+        page_text, reply_markup = warm['text'], warm['reply_markup']
+    else:
+        page_text, reply_markup = render_result_page(warm['df'], pagination, warm['has_next'], lang_dict)
+    await message.reply_text(page_text, parse_mode=None if warm['df'].empty else 'Markdown',
+                             reply_markup=reply_markup)
+    return True
 
 # Enhanced visualization with beautiful table formatting
 def create_enhanced_visualization(df, query_type, table_name, language='en'):
@@ -389,7 +3358,7 @@ def create_enhanced_visualization(df, query_type, table_name, language='en'):
         # For single value results
         elif len(df) == 1 and len(df.columns) == 1:
             value = df.iloc[0, 0]
-            if pd.api.types.is_numeric_dtype(df.dtypes[0]):
+            if pd.api.types.is_numeric_dtype(df.dtypes.iloc[0]):
                 return f"📊 **{lang_dict['visualization_title']}**\n\nResult: `{value:.2f}`"
             else:
                 return f"📊 **{lang_dict['visualization_title']}**\n\nResult: `{value}`"
@@ -401,10 +3370,17 @@ def create_enhanced_visualization(df, query_type, table_name, language='en'):
             if len(numeric_columns) >= 1 and len(df) > 1:
                 # Create visualization
                 return create_chart_visualization(df, numeric_columns, lang_dict)
-            else:
+            elif len(df) <= 20:
                 # Format as table
                 table = tabulate(df, headers='keys', tablefmt='grid', showindex=False)
                 return f"📋 **{lang_dict['visualization_title']}**\n\n```\n{table}\n```"
+            else:
+                # Too long for a message: show a sample and send the full result as a file
+                sample = tabulate(df.head(10), headers='keys', tablefmt='grid', showindex=False)
+                return {
+                    'text': f"📋 **{lang_dict['visualization_title']}**\n\n{lang_dict['showing_sample'].format(10)}\n\n```\n{sample}\n```",
+                    'full_data': True
+                }
                 
     except Exception as e:
         logger.error(f"Error creating enhanced visualization: {e}")
@@ -412,39 +3388,42 @@ def create_enhanced_visualization(df, query_type, table_name, language='en'):
         return f"```\n{df.to_string(index=False)}\n```"
 
 def create_chart_visualization(df, numeric_columns, lang_dict):
-    """Create chart visualization for numeric data"""
+    """Create chart visualization for numeric data.
+
+    Returns a chart spec; the PNG itself is drawn by CHART_RENDERER.
+    """
     try:
-        plt.figure(figsize=(10, 6))
+        values = df[numeric_columns[0]]
         
         if len(df) <= 15:  # Bar chart
-            x = range(len(df))
-            y = df[numeric_columns[0]]
-            
-            plt.bar(x, y)
-            plt.xticks(x, [str(i) for i in x], rotation=45)
-            plt.title(lang_dict['visualization_title'])
-            plt.tight_layout()
-            
+            chart = {
+                'kind': 'bar',
+                'values': values.tolist(),
+                'labels': [str(i) for i in range(len(df))],
+                'title': lang_dict['visualization_title']
+            }
         else:  # Histogram
-            plt.hist(df[numeric_columns[0]], bins=min(20, len(df)//5), alpha=0.7, edgecolor='black')
-            plt.title(lang_dict['visualization_title'])
-            plt.xlabel(numeric_columns[0])
-            plt.ylabel('Frequency')
-        
-        # Save the chart
-        chart_path = f"chart_{datetime.now().strftime('%Y%m%d_%H%M%S')}.png"
-        plt.savefig(chart_path)
-        plt.close()
+            chart = {
+                'kind': 'hist',
+                'values': values.dropna().tolist(),
+                'bins': min(20, len(df)//5),
+                'title': lang_dict['visualization_title'],
+                'xlabel': str(numeric_columns[0]),
+                'ylabel': 'Frequency'
+            }
         
         # Prepare stats summary
         stats = []
         for col in numeric_columns:
             stats.append(f"{col}: {df[col].mean():.2f} (avg), {df[col].max():.2f} (max)")
         
+        table = tabulate(df.head(10), headers='keys', tablefmt='grid', showindex=False)
         return {
-            'chart': chart_path,
+            'chart': chart,
             'stats': lang_dict['stats_summary'].format(len(df), "; ".join(stats)),
-            'sample': f"```\n{tabulate(df.head(5), headers='keys', tablefmt='grid', showindex=False)}\n```" if len(df) > 10 else None
+            'sample': f"```\n{tabulate(df.head(5), headers='keys', tablefmt='grid', showindex=False)}\n```" if len(df) > 10 else None,
+            'fallback': f"📋 **{lang_dict['visualization_title']}**\n\n```\n{table}\n```",
+            'full_data': len(df) > 20
         }
         
     except Exception as e:
@@ -453,6 +3432,82 @@ def create_chart_visualization(df, numeric_columns, lang_dict):
         table = tabulate(df.head(10), headers='keys', tablefmt='grid', showindex=False)
         return f"📋 **{lang_dict['visualization_title']}**\n\n```\n{table}\n```"
 
+def render_chart_png(chart):
+    """Draw a chart spec to PNG bytes (runs in a worker process).
+
+    Uses the object-oriented Figure API, so no pyplot global state is shared
+    between renders. Returns (png_bytes, render_seconds).
+    """
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    
+    started = time.perf_counter()
+    fig = Figure(figsize=(10, 6))
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+    if chart['kind'] == 'bar':
+        x = range(len(chart['values']))
+        ax.bar(x, chart['values'])
+        ax.set_xticks(list(x), chart['labels'], rotation=45)
+        ax.set_title(chart['title'])
+        fig.tight_layout()
+    else:
+        ax.hist(chart['values'], bins=chart['bins'], alpha=0.7, edgecolor='black')
+        ax.set_title(chart['title'])
+        ax.set_xlabel(chart['xlabel'])
+        ax.set_ylabel(chart['ylabel'])
+    
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format='png')
+    return buffer.getvalue(), time.perf_counter() - started
+
+class ChartQueueFullError(Exception):
+    """Raised when too many charts are already waiting to be rendered"""
+
+class ChartRenderer:
+    """Renders chart specs to PNG bytes in a process pool with a bounded queue"""
+    def __init__(self, workers=CHART_WORKERS, max_pending=CHART_QUEUE_SIZE):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.pending = 0
+        self.renders = 0
+        self.rejected = 0
+        self.render_seconds = 0.0
+        self._pool = None
+
+    async def render(self, chart):
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            METRICS.error('chart')
+            raise ChartQueueFullError(f"{self.pending} charts already queued")
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers)
+        
+        loop = asyncio.get_running_loop()
+        self.pending += 1
+        queued = time.perf_counter()
+        try:
+            with METRICS.timer('chart'):
+                png, render_seconds = await loop.run_in_executor(self._pool, render_chart_png, chart)
+        finally:
+            self.pending -= 1
+        total = time.perf_counter() - queued
+        self.renders += 1
+        self.render_seconds += render_seconds
+        logger.info(f"Rendered {chart['kind']} chart in {render_seconds * 1000:.0f} ms "
+                    f"({total * 1000:.0f} ms including queue and transfer)")
+        return png
+
+    def stats(self):
+        return {'pending': self.pending, 'renders': self.renders, 'rejected': self.rejected}
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+CHART_RENDERER = ChartRenderer()
+
 # Improved voice transcription with language detection
 def transcribe_voice(audio_file_path, language='en'):
     """Simulated voice transcription with language detection"""
@@ -489,6 +3544,148 @@ def transcribe_voice(audio_file_path, language='en'):
         logger.error(f"Error in voice transcription: {e}")
         return "show all data"  # Fallback
 
+class TextToSQLEngine:
+    """Headless text-to-SQL pipeline: schema lookup, translation, execution, formatting.
+
+    Runs the same steps as process_query without Telegram, with its own caps
+    on concurrent LLM translations and SQLite queries. LLM calls still pass
+    through LLM_SCHEDULER, whose limit applies to all callers together.
+    """
+    def __init__(self, db_path, table_name=None, language='en', llm_concurrency=OPENROUTER_MAX_CONCURRENCY,
+                 sql_concurrency=SQL_WORKERS, max_rows=20, sql_timeout=SQL_QUERY_TIMEOUT):
+        table_info = get_database_info(db_path)
+        if not table_info:
+            raise ValueError(f"No tables found in {db_path}")
+        self.db_path = db_path
+        self.table_name = table_name or detect_main_table(table_info)
+        if self.table_name not in table_info:
+            raise ValueError(f"Table {self.table_name} not found in {db_path}")
+        self.language = language
+        self.max_rows = max_rows
+        self.sql_timeout = sql_timeout
+        self._llm_slots = asyncio.Semaphore(llm_concurrency)
+        self._sql_executor = ThreadPoolExecutor(max_workers=sql_concurrency, thread_name_prefix='engine-sql')
+
+    async def answer(self, question):
+        """Answer one question; errors are reported in the result instead of raised"""
+        result = {'question': question, 'table': self.table_name}
+        timings = {}
+        started = time.perf_counter()
+        stage_start = started
+        
+        def lap(stage):
+            nonlocal stage_start
+            now = time.perf_counter()
+            timings[stage] = round((now - stage_start) * 1000, 2)
+            stage_start = now
+        
+        try:
+            loop = asyncio.get_running_loop()
+            columns, schema_info, profile = await loop.run_in_executor(
+                self._sql_executor, load_query_context, self.db_path, self.table_name, question)
+            lap('schema_ms')
+            
+            usage = {}
+            async with self._llm_slots:
+                sql_query, query_type = await generate_sql_with_visualization(
+                    schema_info, question, self.table_name, self.language, columns=columns, profile=profile,
+                    usage=usage
+                )
+            result['sql'] = sql_query
+            result['query_type'] = query_type
+            if usage:
+                result['tokens'] = usage
+            lap('translate_ms')
+            
+            if query_type in ("full_table", "limited_table"):
+                # Only the rows that will be reported are ever fetched
+                pagination = new_pagination(self.db_path, sql_query, self.table_name, query_type, 0,
+                                            page_size=self.max_rows)
+                df, truncated = await fetch_page(pagination, self.sql_timeout, executor=self._sql_executor)
+            else:
+                df = await execute_query(self.db_path, sql_query, self.sql_timeout, executor=self._sql_executor)
+                truncated = len(df) > self.max_rows
+            lap('execute_ms')
+            
+            if df.empty:
+                text = LANGUAGES[self.language]['no_results']
+            else:
+                visualization = create_enhanced_visualization(df, query_type, self.table_name, self.language)
+                text = visualization if isinstance(visualization, str) else visualization.get('stats') or visualization.get('text')
+            lap('visualize_ms')
+            
+            result.update({
+                'row_count': len(df),
+                'truncated': truncated,
+                'columns': [str(col) for col in df.columns],
+                'rows': json.loads(df.head(self.max_rows).to_json(orient='values', date_format='iso')),
+                'text': text
+            })
+        except QueryTimeoutError as e:
+            result['error'] = f"timeout: {e}"
+        except Exception as e:
+            result['error'] = str(e)
+        timings['total_ms'] = round((time.perf_counter() - started) * 1000, 2)
+        result['timings'] = timings
+        return result
+
+    def close(self):
+        self._sql_executor.shutdown(wait=False, cancel_futures=True)
+
+def load_questions(path):
+    """Questions from a text file (one per line) or JSONL with a "question" field"""
+    questions = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            questions.append(json.loads(line)['question'] if line.startswith('{') else line)
+    return questions
+
+async def run_batch(engine, questions, out_file, concurrency):
+    """Answer questions concurrently, writing one JSON line per result as it completes"""
+    queue = asyncio.Queue()
+    for index, question in enumerate(questions):
+        queue.put_nowait((index, question))
+    summary = {'questions': len(questions), 'errors': 0}
+    started = time.perf_counter()
+    
+    async def worker():
+        while True:
+            try:
+                index, question = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            result = await engine.answer(question)
+            result['index'] = index
+            if 'error' in result:
+                summary['errors'] += 1
+            out_file.write(json.dumps(result, ensure_ascii=False, default=str) + "\n")
+    
+    await asyncio.gather(*(worker() for _ in range(max(1, concurrency))))
+    out_file.flush()
+    summary['seconds'] = round(time.perf_counter() - started, 3)
+    summary['questions_per_sec'] = round(len(questions) / summary['seconds'], 2) if summary['seconds'] else None
+    return summary
+
+async def run_batch_cli(args):
+    initialize()
+    # The scheduler is the only LLM concurrency limit; the client is created lazily, so its pool can still grow
+    LLM_SCHEDULER.max_concurrency = args.llm_concurrency
+    OPENROUTER_CLIENT.pool_size = max(OPENROUTER_CLIENT.pool_size, args.llm_concurrency)
+    engine = TextToSQLEngine(args.db, table_name=args.table, language=args.language,
+                             llm_concurrency=args.llm_concurrency, sql_concurrency=args.sql_concurrency,
+                             max_rows=args.max_rows, sql_timeout=args.timeout)
+    try:
+        questions = load_questions(args.questions)
+        with open(args.out, 'w', encoding='utf-8') as out_file:
+            summary = await run_batch(engine, questions, out_file, args.llm_concurrency + args.sql_concurrency)
+        logger.info(f"Batch finished: {json.dumps(summary)}")
+    finally:
+        engine.close()
+        await OPENROUTER_CLIENT.aclose()
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     
@@ -526,11 +3723,11 @@ async def language_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     if "English" in text or "🇺🇸" in text:
         USER_STATES[user_id].language = 'en'
-        save_user_language(user_id, 'en')
+        await METADATA_STORE.arun(save_user_language, user_id, 'en')
         lang_text = LANGUAGES['en']['language_selected']
     elif "Русский" in text or "🇷🇺" in text:
         USER_STATES[user_id].language = 'ru'
-        save_user_language(user_id, 'ru')
+        await METADATA_STORE.arun(save_user_language, user_id, 'ru')
         lang_text = LANGUAGES['ru']['language_selected']
     else:
         await update.message.reply_text("Please choose a valid language option.")
@@ -681,31 +3878,41 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
             # Create SQLite database from file
             db_path = user_state.current_db + '.db'
             
-            if file_extension == '.csv':
-                df = pd.read_csv(user_state.current_db)
-            else:  # Excel files
-                df = pd.read_excel(user_state.current_db)
-            
-            conn = sqlite3.connect(db_path)
             # Use the original file name as table name (sanitized)
-            table_name = re.sub(r'[^a-zA-Z0-9_]', '_', file_name.split('.')[0])
-            if not table_name:
-                table_name = "data"
+            table_name = sanitize_table_name(file_name.split('.')[0])
+            extra_info = ""
             
-            df.to_sql(table_name, conn, if_exists='replace', index=False)
-            conn.close()
+            if file_extension == '.csv':
+                # Stream the CSV in chunks off the event loop, reporting progress as we go
+                processing_msg = await update.message.reply_text(lang_dict['processing'])
+                loop = asyncio.get_running_loop()
+                progress = make_progress_reporter(processing_msg, lang_dict, loop)
+                profiler = ColumnProfiler()
+                count = await loop.run_in_executor(
+                    INGEST_EXECUTOR, partial(ingest_csv, user_state.current_db, db_path, table_name,
+                                             progress=progress, profiler=profiler)
+                )
+                await loop.run_in_executor(INGEST_EXECUTOR, save_profiler_result, db_path, table_name, profiler)
+                schedule_columnar_copies(db_path, {table_name: count})
+                try:
+                    await processing_msg.delete()
+                except Exception:
+                    pass
+            else:  # Excel files: one table per sheet
+                counts = await ingest_excel(user_state.current_db, db_path, table_name)
+                if not counts:
+                    await update.message.reply_text("No data found in the workbook.")
+                    return
+                schedule_columnar_copies(db_path, counts)
+                table_name = detect_main_table({name: {'row_count': n} for name, n in counts.items()})
+                count = counts[table_name]
+                if len(counts) > 1:
+                    extra_info = f", {len(counts)} sheets loaded as tables: {', '.join(counts)}"
             
             user_state.current_db = db_path
             user_state.current_table = table_name
             
-            # Get record count for message
-            conn = sqlite3.connect(db_path)
-            c = conn.cursor()
-            c.execute(f"SELECT COUNT(*) FROM {table_name}")
-            count = c.fetchone()[0]
-            conn.close()
-            
-            record_info = f"{count} records in table '{table_name}'"
+            record_info = f"{count} records in table '{table_name}'{extra_info}"
             
         except Exception as e:
             logger.error(f"Error processing file: {e}")
@@ -721,12 +3928,7 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 
             main_table = detect_main_table(table_info)
             user_state.current_table = main_table
-            
-            conn = sqlite3.connect(user_state.current_db)
-            c = conn.cursor()
-            c.execute(f"SELECT COUNT(*) FROM {main_table}")
-            count = c.fetchone()[0]
-            conn.close()
+            count = table_info[main_table]['row_count']
             
             record_info = f"{count} records in table '{main_table}'"
             
@@ -750,13 +3952,18 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # Ask for query
     keyboard = [
-        [KeyboardButton("Show entire table"), KeyboardButton("Show first 10 records")],
+        [KeyboardButton(query) for query in SUGGESTED_QUERIES],
         [KeyboardButton(lang_dict['query_prompt'])],
         [KeyboardButton(lang_dict['voice_query_prompt'])],
         [KeyboardButton(lang_dict['back_button'])]
     ]
     reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
     await update.message.reply_text(lang_dict['query_prompt'], reply_markup=reply_markup)
+    
+    # Prepare the suggested queries while the user reads the table summary
+    if WARMUP and user_state.current_table:
+        schedule_warm_up(context.application, user_state.current_db, user_state.current_table, language,
+                         user_state.pagination_id + 1)
 
 async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
@@ -825,69 +4032,92 @@ async def process_query(update: Update, context: ContextTypes.DEFAULT_TYPE, text
         await update.message.reply_text(lang_dict['no_db_selected'])
         return
     
+    # Suggested queries are usually answered by the warm-up that ran after the upload
+    if await reply_warm_result(update.message, user_state, text, lang_dict):
+        return
+    
     # Show processing message
     processing_msg = await update.message.reply_text(lang_dict['processing'])
     
     try:
-        # Get database schema
-        conn = sqlite3.connect(user_state.current_db)
-        c = conn.cursor()
-        
-        # Get table info
-        c.execute(f"PRAGMA table_info({user_state.current_table})")
-        columns = c.fetchall()
+        # Get database schema (cached); a miss reads the database, so not on the event loop
+        loop = asyncio.get_running_loop()
+        columns, schema_info, profile = await loop.run_in_executor(
+            SQL_EXECUTOR, load_query_context, user_state.current_db, user_state.current_table, text)
         
-        schema_info = f"Table {user_state.current_table}: {', '.join([col[1] for col in columns])}\n"
-        
-        conn.close()
+        # Tell the user where they are when the LLM queue is backed up
+        async def show_queue_position(position, wait):
+            await processing_msg.edit_text(lang_dict['processing_queued'].format(position, f"{wait:.0f}"))
         
         # Generate SQL query with visualization type
-        sql_query, query_type = generate_sql_with_visualization(
-            schema_info, text, user_state.current_table, language
+        sql_query, query_type = await generate_sql_with_visualization(
+            schema_info, text, user_state.current_table, language, columns=columns, profile=profile,
+            user_id=user_id, on_queued=show_queue_position
         )
         
+        # Table listings are paginated instead of loading the whole result
+        if query_type in ("full_table", "limited_table"):
+            user_state.pagination_id += 1
+            user_state.pagination = new_pagination(user_state.current_db, sql_query, user_state.current_table,
+                                                   query_type, user_state.pagination_id)
+            df, has_next = await fetch_page(user_state.pagination)
+            if df.empty:
+                await processing_msg.edit_text(lang_dict['no_results'])
+            else:
+                page_text, reply_markup = render_result_page(df, user_state.pagination, has_next, lang_dict)
+                await processing_msg.edit_text(page_text, parse_mode='Markdown', reply_markup=reply_markup)
+            return
+        
         # Execute the query
-        conn = sqlite3.connect(user_state.current_db)
-        df = pd.read_sql_query(sql_query, conn)
-        conn.close()
+        try:
+            df = await execute_query(user_state.current_db, sql_query)
+        except QueryTimeoutError:
+            raise
+        except Exception:
+            # Never serve a translation that doesn't run from the cache again
+            if query_type in ("ai_generated", "template"):
+                await forget_translation(text, language, user_state.current_table, columns)
+            raise
         
         # Format and send results
         if df.empty:
             await processing_msg.edit_text(lang_dict['no_results'])
         else:
             # Create enhanced visualization
-            visualization = create_enhanced_visualization(df, query_type, user_state.current_table, language)
+            with METRICS.timer('visualize'):
+                visualization = create_enhanced_visualization(df, query_type, user_state.current_table, language)
             
             if isinstance(visualization, dict):
+                if 'text' in visualization:
+                    await processing_msg.edit_text(visualization['text'], parse_mode='Markdown')
+                
                 # We have a chart to send
                 if 'chart' in visualization:
-                    await update.message.reply_photo(
-                        photo=open(visualization['chart'], 'rb'),
-                        caption=visualization['stats']
-                    )
-                    # Clean up chart file
                     try:
-                        os.remove(visualization['chart'])
-                    except:
-                        pass
-                
+                        png = await CHART_RENDERER.render(visualization['chart'])
+                        await update.message.reply_photo(photo=png, caption=visualization['stats'])
+                    except Exception as e:
+                        logger.error(f"Error rendering chart: {e}")
+                        await processing_msg.edit_text(visualization['fallback'], parse_mode='Markdown')
+                    else:
+                        # The chart is the answer; don't leave "Processing..." above it
+                        await processing_msg.delete()
+
                 if 'sample' in visualization and visualization['sample']:
                     await update.message.reply_text(visualization['sample'], parse_mode='Markdown')
                 
-                # For full data, offer download
+                # Results too long to show in full are sent as a streamed export
                 if visualization.get('full_data', False):
-                    with tempfile.NamedTemporaryFile(mode='w', suffix='.csv', delete=False) as f:
-                        df.to_csv(f.name, index=False)
-                        await update.message.reply_document(
-                            document=open(f.name, 'rb'), 
-                            caption="📁 Full dataset download"
-                        )
-                        os.unlink(f.name)
+                    await send_query_export(update.message, user_state.current_db, sql_query,
+                                            user_state.current_table, lang_dict)
                         
             else:
                 # Text-based response
                 await processing_msg.edit_text(visualization, parse_mode='Markdown')
                 
+    except QueryTimeoutError as e:
+        logger.warning(f"Query cancelled for user {user_id}: {e}")
+        await processing_msg.edit_text(lang_dict['error_query_timeout'].format(f"{SQL_QUERY_TIMEOUT:g}"))
     except Exception as e:
         logger.error(f"Error processing query: {e}")
         await processing_msg.edit_text(lang_dict['error_query'])
@@ -939,7 +4169,7 @@ async def process_column_definition(update: Update, context: ContextTypes.DEFAUL
     Example: {{"db_name": "myexpenses", "columns": ["id INTEGER PRIMARY KEY", "date TEXT", "amount REAL", "category TEXT"]}}
     """
     
-    response = call_openrouter(prompt)
+    response = await call_openrouter(prompt, user_id=update.effective_user.id)
     
     # Fallback if API is unavailable
     if not response:
@@ -991,7 +4221,7 @@ async def process_column_definition(update: Update, context: ContextTypes.DEFAUL
         conn.close()
         
         # Store database info
-        save_user_database(user_id, db_name, db_path, "data", columns)
+        await METADATA_STORE.arun(save_user_database, user_id, db_name, db_path, "data", columns)
         
         user_state.current_db = db_path
         user_state.current_db_name = db_name
@@ -1067,13 +4297,8 @@ async def process_data_addition(update: Update, context: ContextTypes.DEFAULT_TY
     
     try:
         # Get column information
-        conn = sqlite3.connect('bot_data.db')
-        c = conn.cursor()
-        c.execute("SELECT columns FROM user_databases WHERE user_id=? AND db_path=?", 
-                 (user_id, user_state.current_db))
-        columns_json = c.fetchone()[0]
+        columns_json = METADATA_STORE.get_database_record(user_id, user_state.current_db)[1]
         columns = json.loads(columns_json)
-        conn.close()
         
         # Use OpenRouter to parse the data
         prompt = f"""
@@ -1084,7 +4309,7 @@ async def process_data_addition(update: Update, context: ContextTypes.DEFAULT_TY
         Example: {{"values": [1, "2023-05-15", 50.0, "groceries"]}}
         """
         
-        response = call_openrouter(prompt)
+        response = await call_openrouter(prompt, user_id=update.effective_user.id)
         if not response:
             await processing_msg.edit_text(lang_dict['error_general'])
             return
@@ -1158,17 +4383,42 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             user_state.current_db = dbs[db_index][1]
             user_state.current_db_name = dbs[db_index][0]
             # Get the table name for this database
-            conn = sqlite3.connect('bot_data.db')
-            c = conn.cursor()
-            c.execute("SELECT table_name FROM user_databases WHERE user_id=? AND db_path=?", 
-                     (user_id, user_state.current_db))
-            table_name = c.fetchone()[0]
-            conn.close()
+            table_name = METADATA_STORE.get_database_record(user_id, user_state.current_db)[0]
             
             user_state.current_table = table_name
             await query.edit_message_text(f"Selected database: {dbs[db_index][0]}. You can now add data.")
         else:
             await query.edit_message_text("Database selection failed.")
+    
+    elif query.data.startswith("page_"):
+        _, action, pagination_id = query.data.split("_", 2)
+        pagination = user_state.pagination
+        if not pagination or str(pagination['id']) != pagination_id:
+            await query.edit_message_text(lang_dict['page_expired'])
+            return
+        
+        try:
+            if action == "csv":
+                await send_query_export(query.message, pagination['db_path'], pagination['sql'],
+                                        pagination['table'], lang_dict)
+                return
+            
+            page = pagination['page']
+            if action == "next":
+                page += 1
+            elif action == "prev" and page > 0:
+                page -= 1
+            df, has_next = await fetch_page(pagination, page=page)
+            # Only move once the page is fetched, so a timeout leaves the position unchanged
+            pagination['page'] = page
+            page_text, reply_markup = render_result_page(df, pagination, has_next, lang_dict)
+            await query.edit_message_text(page_text, parse_mode='Markdown', reply_markup=reply_markup)
+        except QueryTimeoutError as e:
+            logger.warning(f"Page fetch cancelled for user {user_id}: {e}")
+            await query.message.reply_text(lang_dict['error_query_timeout'].format(f"{SQL_QUERY_TIMEOUT:g}"))
+        except Exception as e:
+            logger.error(f"Error fetching result page: {e}")
+            await query.message.reply_text(lang_dict['error_query'])
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
@@ -1205,6 +4455,38 @@ async def change_language(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     return LANGUAGE
 
+async def resume_session(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Pick up where a user left off when the conversation state was lost (e.g. after a restart)"""
+    user_id = update.effective_user.id
+    
+    if user_id not in USER_STATES or not USER_STATES[user_id].language:
+        return await start(update, context)
+    
+    user_state = USER_STATES[user_id]
+    lang_dict = LANGUAGES[user_state.language]
+    message = update.message
+    menu_buttons = {lang_dict[key] for key in ('text_to_sql_mode', 'create_db_mode', 'help_mode', 'settings_mode')}
+    
+    if message.text == lang_dict['back_button']:
+        return await handle_back(update, context)
+    if message.text in menu_buttons or user_state.mode not in ("text_to_sql", "create_db"):
+        return await main_menu_handler(update, context)
+    
+    if user_state.mode == "text_to_sql":
+        if message.document:
+            await handle_document(update, context)
+        elif message.voice:
+            await handle_voice(update, context)
+        else:
+            await process_query(update, context)
+        return TEXT_TO_SQL
+    
+    if message.voice:
+        await handle_voice(update, context)
+    else:
+        await process_column_definition(update, context)
+    return CREATE_DB
+
 # Error handler
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.error(f"Exception while handling an update: {context.error}")
@@ -1227,13 +4509,196 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except Exception as e:
         logger.error(f"Error in error handler: {e}")
 
-def main():
-    # Create the Application
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Handle updates from different users concurrently, each user's in order.
+
+    A slow LLM answer, query or chart for one user no longer holds up
+    everybody else, while one user's messages still see the conversation
+    state and session the previous message left behind.
+    """
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        self._locks = {}  # user or chat id -> [lock, updates holding or waiting for it]
+
+    @staticmethod
+    def _key(update):
+        if isinstance(update, Update):
+            if update.effective_user:
+                return update.effective_user.id
+            if update.effective_chat:
+                return update.effective_chat.id
+        return None
+
+    async def do_process_update(self, update, coroutine):
+        key = self._key(update)
+        if key is None:
+            await coroutine
+            return
+        entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+class InstrumentedRequest(HTTPXRequest):
+    """Bot API transport that times every call (replies, uploads, edits) by method"""
+    async def do_request(self, url, method, request_data=None, *args, **kwargs):
+        endpoint = url.rsplit('/', 1)[-1] if method == 'POST' else 'download'
+        with METRICS.timer('telegram', endpoint):
+            code, payload = await super().do_request(url, method, request_data, *args, **kwargs)
+        if code >= 400:
+            METRICS.error('telegram', endpoint)
+        return code, payload
+
+def cache_stats():
+    return {
+        'schema_cache': SCHEMA_CACHE.stats(),
+        'translation_cache': TRANSLATION_CACHE.stats(),
+        'query_templates': QUERY_TEMPLATES.stats(),
+        'chart_renderer': CHART_RENDERER.stats(),
+        'auto_index': INDEX_ADVISOR.stats(),
+        'llm_scheduler': LLM_SCHEDULER.stats(),
+        'warm_results': WARM_RESULTS.stats(),
+        'sessions': {'in_memory': len(USER_STATES)},
+    }
+
+async def serve_metrics(reader, writer):
+    """Answer GET /metrics with the Prometheus text format"""
+    try:
+        request_line = await reader.readline()
+        await reader.readuntil(b'\r\n\r\n')
+        parts = request_line.split()
+        if len(parts) >= 2 and parts[0] == b'GET' and parts[1].split(b'?')[0] == b'/metrics':
+            status, body = b'200 OK', METRICS.prometheus(cache_stats()).encode()
+        else:
+            status, body = b'404 Not Found', b'not found\n'
+        writer.write(b'HTTP/1.1 ' + status + b'\r\nContent-Type: text/plain; version=0.0.4\r\n'
+                     b'Content-Length: ' + str(len(body)).encode() + b'\r\nConnection: close\r\n\r\n' + body)
+        await writer.drain()
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+        pass
+    except Exception as e:
+        logger.error(f"Error serving metrics: {e}")
+    finally:
+        writer.close()
+
+def _format_ms(seconds):
+    return f"{seconds * 1000:.0f}" if seconds is not None else "-"
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Admin-only summary of stage latencies, errors and cache hit rates"""
+    if update.effective_user.id not in ADMIN_USER_IDS:
+        return
+    
+    rows = [[r['stage'], r['count'], r['errors'], _format_ms(r['p50']), _format_ms(r['p95']), _format_ms(r['p99'])]
+            for r in METRICS.snapshot()]
+    table = tabulate(rows, headers=['stage', 'n', 'err', 'p50', 'p95', 'p99'], tablefmt='simple')
+    stats = cache_stats()
+    caches = "\n".join(f"{name}: {stats[name]['hit_rate']:.0%} hit rate ({stats[name]['hits']} hits)"
+                       for name in ('schema_cache', 'translation_cache', 'query_templates', 'warm_results'))
+    renderer = stats['chart_renderer']
+    indexes = "\n".join(f"  {i['table']}({i['column']}): {i['uses']} uses, {i['bytes'] / 2**20:.1f} MB"
+                        for i in INDEX_ADVISOR.report())
+    text = (f"Latency over the last {METRICS_WINDOW // 60} min (ms)\n{table}\n\n{caches}\n"
+            f"charts: {renderer['renders']} rendered, {renderer['pending']} pending, {renderer['rejected']} rejected\n"
+            f"sessions in memory: {stats['sessions']['in_memory']}\n"
+            f"llm: {stats['llm_scheduler']['dispatched']} calls, {stats['llm_scheduler']['coalesced']} coalesced, "
+            f"{stats['llm_scheduler']['rate_limited']} rate limited, {stats['llm_scheduler']['queued']} queued\n"
+            f"automatic indexes: {stats['auto_index']['created']} ({stats['auto_index']['skipped']} skipped)"
+            + (f"\n{indexes}" if indexes else ""))
+    await update.message.reply_text(f"```\n{text}\n```", parse_mode='Markdown')
+
+async def session_maintenance(interval=SESSION_MAINTENANCE_INTERVAL):
+    """Periodically write back and evict idle user sessions"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await USER_STATES.maintain()
+        except Exception as e:
+            logger.error(f"Session maintenance failed: {e}")
+
+async def start_services(application: Application):
+    """Start background tasks once the application is initialized"""
+    application.bot_data['session_task'] = asyncio.create_task(session_maintenance())
+    if METRICS_PORT:
+        try:
+            application.bot_data['metrics_server'] = await asyncio.start_server(serve_metrics, METRICS_HOST, METRICS_PORT)
+            logger.info(f"Serving metrics on http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+        except OSError as e:
+            logger.error(f"Could not start metrics endpoint: {e}")
+
+async def shutdown_services(application: Application):
+    """Release shared resources when the application stops"""
+    session_task = application.bot_data.pop('session_task', None)
+    if session_task:
+        session_task.cancel()
+    for task in application.bot_data.pop('warmup_tasks', ()):
+        task.cancel()
+    metrics_server = application.bot_data.pop('metrics_server', None)
+    if metrics_server:
+        metrics_server.close()
+    await OPENROUTER_CLIENT.aclose()
+    SQL_EXECUTOR.shutdown(wait=False, cancel_futures=True)
+    INGEST_EXECUTOR.shutdown(wait=False, cancel_futures=True)
+    CHART_RENDERER.shutdown()
+    INDEX_ADVISOR.shutdown()
+    if _DUCKDB is not None:
+        _DUCKDB.close()
+    USER_STATES.flush()
+    METADATA_STORE.close()
+    TRANSLATION_CACHE.close()
+    QUERY_TEMPLATES.close()
+    if _EXCEL_POOL is not None:
+        _EXCEL_POOL.shutdown(wait=False, cancel_futures=True)
+
+def preload_modules():
+    """Import the modules handlers use lazily, so the first query doesn't import them on the event loop"""
+    for name in ('numpy', 'pandas', 'tabulate'):
+        try:
+            importlib.import_module(name)
+        except ImportError as e:
+            logger.error(f"Could not preload {name}: {e}")
+
+def initialize():
+    """Explicit startup phase: everything that touches disk happens here, not at import"""
+    init_bot_database()
+    # In the background: import stays fast, and the bot can start polling meanwhile
+    threading.Thread(target=preload_modules, name='preload', daemon=True).start()
+
+def build_application(token=TELEGRAM_BOT_TOKEN, request=None, concurrent_updates=UPDATE_CONCURRENCY):
+    """Create the Application with all handlers registered.
+
+    request replaces the HTTP transport to the Bot API (InstrumentedRequest
+    by default), which lets the load harness in benchmarks.py drive the real
+    handler wiring without Telegram. concurrent_updates is how many updates
+    run at once (PerUserUpdateProcessor); 0 runs them one at a time.
+    """
+    builder = (
+        Application.builder()
+        .token(token)
+        .concurrent_updates(PerUserUpdateProcessor(concurrent_updates) if concurrent_updates else False)
+        .post_init(start_services)
+        .post_shutdown(shutdown_services)
+    )
+    application = builder.request(request or InstrumentedRequest()).build()
     
     # Create conversation handler with states
     conv_handler = ConversationHandler(
-        entry_points=[CommandHandler('start', start)],
+        entry_points=[
+            CommandHandler('start', start),
+            # Sessions outlive the in-memory conversation state, so resume instead of requiring /start
+            MessageHandler((filters.TEXT & ~filters.COMMAND) | filters.VOICE | filters.Document.ALL, resume_session)
+        ],
         states={
             LANGUAGE: [MessageHandler(filters.TEXT & ~filters.COMMAND, language_handler)],
             MAIN_MENU: [
@@ -1265,12 +4730,39 @@ def main():
     # Add handlers
     application.add_handler(conv_handler)
     application.add_handler(CallbackQueryHandler(handle_callback))
+    application.add_handler(CommandHandler('stats', stats_command))
     
     # Add error handler
     application.add_error_handler(error_handler)
+    return application
+
+def main():
+    initialize()
     
     # Start the bot
-    application.run_polling()
+    build_application().run_polling()
+
+def cli(argv=None):
+    """Command line entry point: runs the bot by default, or a headless batch"""
+    parser = argparse.ArgumentParser(description="Text-to-SQL Telegram bot")
+    sub = parser.add_subparsers(dest='command')
+    
+    batch = sub.add_parser('batch', help='answer a file of questions against a database without Telegram')
+    batch.add_argument('--db', required=True, help='SQLite database file')
+    batch.add_argument('--questions', required=True, help='text file (one question per line) or JSONL')
+    batch.add_argument('--out', required=True, help='JSONL file to write results to')
+    batch.add_argument('--table', help='table to query (default: detected main table)')
+    batch.add_argument('--language', default='en', choices=sorted(LANGUAGES))
+    batch.add_argument('--llm-concurrency', type=int, default=OPENROUTER_MAX_CONCURRENCY)
+    batch.add_argument('--sql-concurrency', type=int, default=SQL_WORKERS)
+    batch.add_argument('--max-rows', type=int, default=20, help='result rows kept per question')
+    batch.add_argument('--timeout', type=float, default=SQL_QUERY_TIMEOUT, help='per-query deadline in seconds')
+    
+    args = parser.parse_args(argv)
+    if args.command == 'batch':
+        asyncio.run(run_batch_cli(args))
+    else:
+        main()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    cli()
\ No newline at end of file